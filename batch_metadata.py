@@ -0,0 +1,159 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import sys
+import os
+import io
+import json
+import struct
+import logging
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+from image_processing import process_image
+from video_processing import mp4_creation_datetime, video_creation_datetime, ffprobe_creation_datetime, file_reader
+from onedrive_processor import new_file_details, video_filename, video_file_details, image_folder_constant, get_extension
+
+
+IMAGE_EXTENSIONS = ("jpg", "heic", "png")
+VIDEO_EXTENSIONS = ("mp4", "mov")
+
+
+#
+# Name and folder of one file, as the processor would compute them.
+# item is the path of a local file, or a tuple (filename, bytes) for a file in memory.
+# Runs in the worker processes, so it returns plain dictionaries.
+#
+def file_metadata(item):
+    if(isinstance(item, str)):
+        path = item
+        filename = os.path.basename(item)
+        data = None
+    else:
+        path = None
+        filename, data = item
+
+    extension = get_extension(filename)
+
+    try:
+        if(extension in IMAGE_EXTENSIONS):
+            image_data = process_image(path if path != None else filename, None if data == None else io.BytesIO(data))
+            processed_data = new_file_details(filename, image_data["originaltime"], image_data["offset"], image_data["originalsubsecond"])
+
+            return {
+                "status": True,
+                "source": filename if path == None else path,
+                "type": "image",
+                "filename": processed_data.filename,
+                "year": processed_data.year if processed_data.year != None else "0000",
+                "month": processed_data.month if processed_data.month != None else "00",
+                "naming": processed_data.status,
+                "folder": image_folder_constant(filename, processed_data.status)
+            }
+
+        if(extension in VIDEO_EXTENSIONS):
+            if(data == None):
+                date_obj = video_creation_datetime(path)
+            else:
+                date_obj = video_buffer_datetime(filename, data)
+
+            details = video_file_details(filename, video_filename(filename, date_obj) if date_obj != None else None)
+
+            return {
+                "status": True,
+                "source": filename if path == None else path,
+                "type": "video",
+                "filename": details["filename"],
+                "year": details["year"],
+                "month": details["month"],
+                "naming": details["naming"],
+                "folder": "videos_folder_name"
+            }
+
+    except Exception as ex:
+        logging.exception("file_metadata(): Error reading metadata of %s", filename)
+        return {"status": False, "source": filename if path == None else path, "message": str(ex)}
+
+    return {"status": False, "source": filename if path == None else path, "message": "File type not supported."}
+
+
+#
+# Creation date-time of a video in memory. FFprobe needs a file, so the buffer is written to disk only for that fallback.
+#
+def video_buffer_datetime(filename, data):
+    try:
+        date_obj = mp4_creation_datetime(file_reader(io.BytesIO(data)), len(data))
+        if(date_obj != None):
+            return date_obj
+    except (struct.error, ValueError, UnicodeDecodeError):
+        pass
+
+    with tempfile.NamedTemporaryFile(suffix="." + get_extension(filename)) as video_file:
+        video_file.write(data)
+        video_file.flush()
+        return ffprobe_creation_datetime(video_file.name)
+
+
+#
+# Metadata of many files at once, spread over a pool of processes.
+# Returns the results of file_metadata() in the same order as items.
+# max_workers defaults to the number of CPUs. Files are sent to the workers in groups of chunksize.
+#
+def extract_metadata(items, max_workers=None, chunksize=16):
+    items = list(items)
+
+    if(max_workers == 1 or len(items) <= 1):
+        return [file_metadata(item) for item in items]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(file_metadata, items, chunksize=chunksize))
+
+
+#
+# All the images and videos below a local folder
+#
+def list_media_files(folder):
+    files = []
+
+    for root, dirs, filenames in os.walk(folder):
+        dirs.sort()
+        for filename in sorted(filenames):
+            if(get_extension(filename) in IMAGE_EXTENSIONS + VIDEO_EXTENSIONS):
+                files.append(os.path.join(root, filename))
+
+    return files
+
+
+#
+# Print the name and folder of each file of a local folder (e.g. a backlog or NAS dump) as JSON lines.
+# Usage: python batch_metadata.py <folder> [workers]
+#
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] [%(name)s] %(message)s', level=logging.WARNING)
+
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    for result in extract_metadata(list_media_files(sys.argv[1]), workers):
+        print(json.dumps(result))
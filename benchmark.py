@@ -0,0 +1,300 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import argparse
+import datetime
+import io
+import json
+import logging
+import os
+import random
+import struct
+import time
+import zlib
+
+from PIL import Image
+
+import onedrive_processor
+
+from fake_onedrive import FakeDrive, FakeOneDriveClient
+from destination_index import DestinationIndex
+from rate_limiter import RateLimiter
+from graph_batch import MAX_BATCH_SIZE
+from metrics import Metrics, histogram_quantile
+from video_processing import MP4_EPOCH
+
+
+# Share of each file type in the synthetic camera roll
+DEFAULT_MIX = {"jpg": 0.7, "heic": 0.1, "png": 0.1, "mov": 0.1}
+
+# Histogram buckets of the stages: 0.1 ms to 5 minutes, 25% apart, so the estimated percentiles are close
+STAGE_BUCKETS = tuple(0.0001 * 1.25 ** index for index in range(68))
+
+CONSTANTS = {"screenshot_folder_name": "screenshots", "images_folder_name": "images", "videos_folder_name": "videos"}
+
+# No limits unless requested, so the benchmark measures the pipeline and not the limiter
+UNLIMITED_RATE = {"requests_per_second": 1000000, "burst": 1000000, "max_concurrency": 1000}
+
+
+############## Synthetic camera roll ####################
+
+def box(box_type, content):
+    return struct.pack(">I4s", 8 + len(content), box_type) + content
+
+
+def exif_block(taken, subsecond, offset):
+    exif = Image.Exif()
+    exif[0x8769] = {0x9003: taken.strftime("%Y:%m:%d %H:%M:%S"), 0x9291: subsecond, 0x9011: offset}
+    exif[0x8825] = {1: "N", 2: (38.0, 42.0, 1.5), 3: "W", 4: (9.0, 8.0, 21.7)}
+    return exif.tobytes()
+
+
+#
+# JPEG with EXIF. The image is encoded once and the APP1 segment inserted for each file.
+#
+def make_jpeg(template, taken, subsecond, offset, padding):
+    exif = exif_block(taken, subsecond, offset)
+    app1 = b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+    # A comment segment with random bytes gives each file its own size and hash
+    comment = b"\xff\xfe" + struct.pack(">H", len(padding) + 2) + padding
+    return template[0:2] + app1 + comment + template[2:]
+
+
+#
+# HEIC container with an Exif item (meta/iinf and meta/iloc) and the image data in mdat
+#
+def make_heic(taken, subsecond, offset, payload):
+    tiff = exif_block(taken, subsecond, offset)[6:]
+    exif_item = struct.pack(">I", 6) + b"Exif\x00\x00" + tiff
+
+    ftyp = box(b"ftyp", b"heic\x00\x00\x00\x00mif1heic")
+    infe_image = box(b"infe", b"\x02\x00\x00\x00" + struct.pack(">HH4s", 1, 0, b"hvc1") + b"\x00")
+    infe_exif = box(b"infe", b"\x02\x00\x00\x00" + struct.pack(">HH4s", 2, 0, b"Exif") + b"\x00")
+    iinf = box(b"iinf", b"\x00\x00\x00\x00" + struct.pack(">H", 2) + infe_image + infe_exif)
+
+    def meta(mdat_start):
+        iloc = box(b"iloc", b"\x00\x00\x00\x00\x44\x00" + struct.pack(">H", 2) +
+                   struct.pack(">HHHII", 1, 0, 1, mdat_start + len(exif_item), len(payload)) +
+                   struct.pack(">HHHII", 2, 0, 1, mdat_start, len(exif_item)))
+        hdlr = box(b"hdlr", b"\x00" * 8 + b"pict" + b"\x00" * 13)
+        return box(b"meta", b"\x00\x00\x00\x00" + hdlr + box(b"pitm", b"\x00\x00\x00\x00\x00\x01") + iinf + iloc)
+
+    header = ftyp + meta(0)
+    header = ftyp + meta(len(header) + 8)
+    return header + box(b"mdat", exif_item + payload)
+
+
+#
+# PNG screenshot. A text chunk with random bytes gives each file its own hash.
+#
+def make_png(template, padding):
+    chunk = b"tEXt" + b"Comment\x00" + padding.hex().encode("ascii")
+    text = struct.pack(">I", len(chunk) - 4) + chunk + struct.pack(">I", zlib.crc32(chunk))
+    return template[0:33] + text + template[33:]
+
+
+#
+# QuickTime movie: media data first and the movie header at the end, as phones record them
+#
+def make_mov(taken, payload):
+    seconds = int((taken.replace(tzinfo=datetime.timezone.utc) - MP4_EPOCH).total_seconds())
+    mvhd = box(b"mvhd", b"\x00\x00\x00\x00" + struct.pack(">II", seconds, seconds) + b"\x00" * 88)
+    return box(b"ftyp", b"qt  \x00\x00\x00\x00qt  ") + box(b"mdat", payload) + box(b"moov", mvhd)
+
+
+#
+# Fill the drive with files in source_path: camera files (IMG_0001.JPG, ...) and screenshots named by date.
+# Returns the number of files and bytes.
+#
+def generate_camera_roll(drive, source_path, files, image_size, video_size, mix=DEFAULT_MIX, seed=1):
+    generator = random.Random(seed)
+
+    image = Image.frombytes("RGB", (64, 64), bytes(generator.getrandbits(8) for i in range(64 * 64 * 3)))
+    jpeg_template = io.BytesIO()
+    image.save(jpeg_template, format="JPEG", quality=90)
+    png_template = io.BytesIO()
+    image.save(png_template, format="PNG")
+
+    # Random blocks reused for the bulk of the files, so generation stays fast
+    image_block = generator.randbytes(max(0, image_size))
+    video_block = generator.randbytes(max(0, video_size))
+
+    types = list(mix.keys())
+    weights = list(mix.values())
+    start = datetime.datetime(2021, 1, 1, 8, 0, 0)
+    total_bytes = 0
+
+    for number in range(1, files + 1):
+        file_type = generator.choices(types, weights)[0]
+        taken = start + datetime.timedelta(minutes=37 * number)
+        subsecond = str(generator.randrange(1000)).zfill(3)
+        unique = generator.randbytes(16)
+        folder = source_path + "/" + taken.strftime("%Y/%m")
+
+        if(file_type == "jpg"):
+            filename = "IMG_" + str(number).zfill(4) + ".JPG"
+            data = make_jpeg(jpeg_template.getvalue(), taken, subsecond, "+01:00", unique + image_block[:60000])
+            data = data + image_block[60000:]
+        elif(file_type == "heic"):
+            filename = "IMG_" + str(number).zfill(4) + ".HEIC"
+            data = make_heic(taken, subsecond, "+01:00", unique + image_block)
+        elif(file_type == "png"):
+            filename = taken.strftime("%Y%m%d_%H%M%S") + "000_iOS.png"
+            data = make_png(png_template.getvalue(), unique)
+        else:
+            filename = "IMG_" + str(number).zfill(4) + ".MOV"
+            data = make_mov(taken, unique + video_block)
+
+        drive.put(folder, filename, data)
+        total_bytes = total_bytes + len(data)
+
+    return files, total_bytes
+
+
+############## Measurements ####################
+
+#
+# Percentiles of the stage_seconds histograms of the processor (per stage, origin and media type),
+# and of file_seconds (each file, all stages included).
+# Estimated within the histogram buckets, so they are not exact. The maximum is not known.
+#
+def stage_percentiles(metrics):
+    stages = dict()
+
+    for labels, histogram in metrics.histogram_items("stage_seconds") + metrics.histogram_items("file_seconds"):
+        labels = dict(labels)
+        name = labels.pop("stage", "file")
+        if(len(labels) > 0):
+            name = name + " [" + ", ".join(str(labels[key]) for key in sorted(labels, key=lambda key: (key != "origin", key))) + "]"
+
+        stages[name] = {
+            "count": histogram["count"],
+            "mean_ms": round(histogram["sum"] / histogram["count"] * 1000, 2),
+            "p50_ms": round(histogram_quantile(histogram, 0.5, metrics.buckets) * 1000, 2),
+            "p90_ms": round(histogram_quantile(histogram, 0.9, metrics.buckets) * 1000, 2),
+            "p99_ms": round(histogram_quantile(histogram, 0.99, metrics.buckets) * 1000, 2)
+        }
+
+    return stages
+
+
+#
+# Generate a camera roll on a fake origin drive, process it into a fake destination and report the throughput,
+# the latency of each processing stage (stage_seconds metrics, per origin and media type) and of each file.
+#
+def run_benchmark(options):
+    origin_drive = FakeDrive("origin-drive")
+    destination_drive = origin_drive if options.same_drive else FakeDrive("destination-drive")
+
+    time_before = time.perf_counter()
+    files, total_bytes = generate_camera_roll(origin_drive, options.source_path, options.files, options.image_size, options.video_size, seed=options.seed)
+    generation_seconds = time.perf_counter() - time_before
+
+    rate_config = dict(UNLIMITED_RATE)
+    if(options.requests_per_second != None):
+        rate_config = {"requests_per_second": options.requests_per_second}
+    rate_limiter = RateLimiter(rate_config)
+
+    client_options = {
+        "latency": options.latency,
+        "bandwidth": options.bandwidth,
+        "throttle_rate": options.throttle_rate,
+        "failure_rate": options.failure_rate,
+        "rate_limiter": rate_limiter
+    }
+    origin_client = FakeOneDriveClient(origin_drive, account="origin", seed=options.seed, **client_options)
+    destination_client = FakeOneDriveClient(destination_drive, account="destination", seed=options.seed + 1, **client_options)
+    origin_client.set_batch_options(options.batch_size)
+    destination_client.set_batch_options(options.batch_size)
+
+    config = {"max_workers": options.workers, "constants": CONSTANTS, "profile_name": "origin"}
+    onedrive_processor.destination_index = DestinationIndex(destination_client)
+
+    # Metrics of this run only
+    metrics = onedrive_processor.metrics
+    onedrive_processor.metrics = Metrics(STAGE_BUCKETS)
+
+    try:
+        time_before = time.perf_counter()
+        summary = onedrive_processor.process_onedrive_folder(origin_client, options.source_path, destination_client, "/Pictures", config)
+        seconds = time.perf_counter() - time_before
+        stages = stage_percentiles(onedrive_processor.metrics)
+    finally:
+        onedrive_processor.destination_index = None
+        onedrive_processor.metrics = metrics
+
+    return {
+        "files": files,
+        "bytes": total_bytes,
+        "workers": options.workers,
+        "generation_seconds": round(generation_seconds, 3),
+        "seconds": round(seconds, 3),
+        "files_per_second": round(files / seconds, 2),
+        "bytes_per_second": round(total_bytes / seconds),
+        "summary": summary,
+        "stages": stages
+    }
+
+
+def print_report(report):
+    print("Files: %d (%.1f MB) in %.2f s with %d workers" % (report["files"], report["bytes"] / 1048576, report["seconds"], report["workers"]))
+    print("Throughput: %.1f files/s, %.2f MB/s" % (report["files_per_second"], report["bytes_per_second"] / 1048576))
+    print("Outcomes: %s" % report["summary"])
+    print("%-40s %8s %10s %10s %10s %10s" % ("Stage [origin, media]", "Count", "mean ms", "p50 ms", "p90 ms", "p99 ms"))
+
+    for name, stage in report["stages"].items():
+        print("%-40s %8d %10.2f %10.2f %10.2f %10.2f" % (name, stage["count"], stage["mean_ms"], stage["p50_ms"], stage["p90_ms"], stage["p99_ms"]))
+
+    print("Percentiles are estimated from the histogram buckets.")
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="End to end benchmark of the processor against an in memory OneDrive.")
+    parser.add_argument("--files", type=int, default=500, help="Number of files in the camera roll")
+    parser.add_argument("--image-size", type=int, default=2 * 1024 * 1024, help="Approximate size of each image in bytes")
+    parser.add_argument("--video-size", type=int, default=16 * 1024 * 1024, help="Approximate size of each video in bytes")
+    parser.add_argument("--workers", type=int, default=4, help="max_workers of the processor")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to each request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Bytes per second of each transfer")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of the requests answered with HTTP 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of the requests that fail")
+    parser.add_argument("--requests-per-second", type=float, default=None, help="Rate limit per account and operation type (default: no limit)")
+    parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE, help="Deletes and item details per Graph batch (1: no batching)")
+    parser.add_argument("--same-drive", action="store_true", help="Origin and destination in the same drive (server side moves)")
+    parser.add_argument("--source-path", default="/Camera Roll", help="Origin folder")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the generated files and injected errors")
+    parser.add_argument("--json", default=None, help="Also write the report to this JSON file")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] [%(name)s] %(message)s', level=logging.WARNING)
+
+    options = parse_arguments()
+    report = run_benchmark(options)
+    print_report(report)
+
+    if(options.json != None):
+        with open(options.json, "w") as json_file:
+            json.dump(report, json_file, indent=2)
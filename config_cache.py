@@ -0,0 +1,170 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError, URLError
+
+
+# Seconds to wait for the configuration server
+CONFIG_TIMEOUT = 10
+
+# Local copies of the configuration, credentials and access tokens
+DEFAULT_CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".cache", "onedrive-processor")
+
+
+#
+# Write a file only readable by the user (it holds secrets), replacing the previous one at once
+#
+def write_private_file(filename, content):
+    temporary = filename + ".tmp"
+
+    descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "w") as output:
+        output.write(content)
+
+    os.replace(temporary, filename)
+
+
+#
+# JSON files of the configuration server (config.json and the credentials), with a local copy of each.
+# The server is asked with conditional requests (ETag / Last-Modified), so unchanged files are not sent again.
+# When the server can't be reached, the local copy is used.
+#
+class ConfigCache:
+
+    def __init__(self, folder, timeout=CONFIG_TIMEOUT):
+        self.folder = folder
+        self.timeout = timeout
+
+        # Holds the credentials. An existing folder keeps its permissions with makedirs(), so they are set again.
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        os.chmod(folder, 0o700)
+
+
+    def cache_file(self, url):
+        return os.path.join(self.folder, hashlib.sha256(url.encode("utf-8")).hexdigest()[:32] + ".json")
+
+
+    def load(self, url):
+        try:
+            with open(self.cache_file(url)) as cached:
+                return json.load(cached)
+        except (OSError, ValueError):
+            return None
+
+
+    def read_json(self, url):
+        cached = self.load(url)
+
+        headers = dict()
+        if(cached != None and cached.get("etag") != None):
+            headers["If-None-Match"] = cached["etag"]
+        if(cached != None and cached.get("last_modified") != None):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=self.timeout)
+            data = json.load(response)
+
+        except HTTPError as ex:
+            if(ex.code == 304 and cached != None):
+                logging.debug("ConfigCache.read_json(): Not modified: %s", url)
+                return cached["data"]
+
+            if(cached == None):
+                raise
+
+            logging.warning("ConfigCache.read_json(): Error reading %s (HTTP %d). Using the local copy.", url, ex.code)
+            return cached["data"]
+
+        except (URLError, OSError, ValueError) as ex:
+            if(cached == None):
+                raise
+
+            logging.warning("ConfigCache.read_json(): Error reading %s (%s). Using the local copy.", url, ex)
+            return cached["data"]
+
+        write_private_file(self.cache_file(url), json.dumps({
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "data": data
+        }))
+
+        return data
+
+
+#
+# Access tokens of the accounts, kept between runs until they expire, and the latest refresh token of each account.
+# Refresh tokens are rotated on every exchange, so the newest one is written back here.
+# The tokens are linked to the refresh token of the credentials file: new credentials discard them.
+#
+class TokenStore:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+
+    def fingerprint(self, refresh_token):
+        return hashlib.sha256(refresh_token.encode("utf-8")).hexdigest()
+
+
+    def load(self):
+        try:
+            with open(self.filename) as tokens:
+                return json.load(tokens)
+        except (OSError, ValueError):
+            return dict()
+
+
+    #
+    # Saved tokens of the account ({"access_token", "expiry", "refresh_token"}), or None
+    #
+    def get(self, key, credentials_refresh_token):
+        with self.lock:
+            token = self.load().get(key)
+
+        if(token == None or token.get("credentials") != self.fingerprint(credentials_refresh_token)):
+            return None
+
+        return token
+
+
+    def set(self, key, credentials_refresh_token, access_token, expiry, refresh_token):
+        with self.lock:
+            tokens = self.load()
+            tokens[key] = {
+                "credentials": self.fingerprint(credentials_refresh_token),
+                "access_token": access_token,
+                "expiry": expiry,
+                "refresh_token": refresh_token
+            }
+            write_private_file(self.filename, json.dumps(tokens))
@@ -0,0 +1,127 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import logging
+import threading
+import time
+
+
+# Result of checking a file name against the destination folder
+FILE_NEW = "new"
+FILE_DUPLICATE = "duplicate"
+FILE_CONFLICT = "conflict"
+
+
+#
+# Cache of the files in the destination folders (name, size and hash).
+# Each folder is listed once, when first needed, and listed again after max_age seconds.
+# Uploads update the cache, so conflicts are found before sending any bytes.
+#
+class DestinationIndex:
+
+    def __init__(self, onedrive_client, max_age=3600):
+        self.onedrive_client = onedrive_client
+        self.max_age = max_age
+
+        self.folders = dict()
+        self.loaded = dict()
+        self.lock = threading.Lock()
+        self.folder_locks = dict()
+
+
+    def folder_lock(self, onedrive_folder):
+        with self.lock:
+            if(onedrive_folder not in self.folder_locks):
+                self.folder_locks[onedrive_folder] = threading.Lock()
+            return self.folder_locks[onedrive_folder]
+
+
+    #
+    # Files of a folder as a dictionary of lower case name -> details. None when the folder can't be listed.
+    #
+    def folder(self, onedrive_folder):
+        with self.folder_lock(onedrive_folder):
+            if(onedrive_folder in self.folders and time.time() - self.loaded[onedrive_folder] < self.max_age):
+                return self.folders[onedrive_folder]
+
+            result = self.onedrive_client.list_children(onedrive_folder)
+
+            if(result["status"] == False):
+                logging.error("DestinationIndex.folder(): Error listing folder %s: %s", onedrive_folder, result["message"])
+                return None
+
+            files = dict()
+            for item in result["itemlist"]:
+                files[item["name"].lower()] = item
+
+            logging.debug("DestinationIndex.folder(): Listed %d items in %s", len(files), onedrive_folder)
+
+            self.folders[onedrive_folder] = files
+            self.loaded[onedrive_folder] = time.time()
+            return files
+
+
+    #
+    # Check if filename can be used in the folder for a file with the given size and hash.
+    # Returns FILE_NEW, FILE_DUPLICATE (same file already there) or FILE_CONFLICT (name taken by another file).
+    # Returns None when the folder can't be listed or there is no hash to compare.
+    #
+    def check(self, onedrive_folder, filename, size, sha256hash):
+        files = self.folder(onedrive_folder)
+
+        if(files == None):
+            return None
+
+        existing = files.get(filename.lower())
+
+        if(existing == None):
+            return FILE_NEW
+
+        if(sha256hash == "" or existing["sha256hash"] == ""):
+            return None
+
+        if(existing["sha256hash"].upper() == sha256hash.upper() and existing["size"] == size):
+            return FILE_DUPLICATE
+
+        return FILE_CONFLICT
+
+
+    def add(self, onedrive_folder, filename, size, sha256hash):
+        with self.folder_lock(onedrive_folder):
+            if(onedrive_folder in self.folders):
+                self.folders[onedrive_folder][filename.lower()] = {
+                    "name": filename,
+                    "type": "file",
+                    "size": size,
+                    "sha256hash": sha256hash
+                }
+
+
+    #
+    # Forget a folder, so it is listed again on the next check (e.g. after an unexpected conflict)
+    #
+    def invalidate(self, onedrive_folder):
+        with self.folder_lock(onedrive_folder):
+            self.folders.pop(onedrive_folder, None)
+            self.loaded.pop(onedrive_folder, None)
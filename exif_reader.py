@@ -0,0 +1,340 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import logging
+import struct
+
+from video_processing import iterate_boxes, file_reader
+
+
+# Tags used for the naming, by IFD
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+
+EXIF_TAGS = {
+    0x9003: "DateTimeOriginal",
+    0x9291: "SubSecTimeOriginal",
+    0x9011: "OffsetTimeOriginal"
+}
+
+GPS_TAGS = {
+    0x0002: "GPSLatitude",
+    0x0004: "GPSLongitude"
+}
+
+TYPE_ASCII = 2
+TYPE_LONG = 4
+TYPE_RATIONAL = 5
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# The Exif item of a HEIC file is read whole, up to this size
+MAX_EXIF_SIZE = 1024 * 1024
+
+
+#
+# Read the few EXIF tags used by the processor (see EXIF_TAGS and GPS_TAGS) directly from the metadata segment:
+# JPEG APP1, the Exif item of HEIC (meta/iinf and meta/iloc boxes) or the PNG eXIf chunk.
+# Only the bytes of the segment are read, and only the tags needed are decoded.
+# read(offset, length) returns the bytes of the file at offset.
+# Returns a dictionary with the tags found (empty when the file has no EXIF), or None when the file
+# has something unexpected and a full EXIF library should be used instead.
+#
+def read_exif_tags(filename, read, size):
+    filename_lower = filename.lower()
+
+    try:
+        if(filename_lower.endswith(".jpg")):
+            tiff = jpeg_exif_block(read)
+        elif(filename_lower.endswith(".heic")):
+            tiff = heic_exif_block(read, size)
+        elif(filename_lower.endswith(".png")):
+            tiff = png_exif_block(read)
+        else:
+            return None
+
+        if(tiff == None):
+            return None
+
+        if(tiff == b""):
+            return dict()
+
+        return tiff_tags(tiff)
+
+    except (struct.error, ValueError, IndexError, UnicodeDecodeError) as ex:
+        logging.debug("read_exif_tags(): Can't read the EXIF of %s: %s", filename, ex)
+        return None
+
+
+#
+# Same as read_exif_tags() for a file-like object. The position of the object is kept.
+#
+def read_exif_tags_from(filename, fileobj):
+    position = fileobj.tell()
+
+    try:
+        fileobj.seek(0, 2)
+        size = fileobj.tell()
+        return read_exif_tags(filename, file_reader(fileobj), size)
+    finally:
+        fileobj.seek(position)
+
+
+#
+# The TIFF block of the EXIF segment. b"" when there is no EXIF, None when the segments are not as expected.
+#
+
+def jpeg_exif_block(read):
+    if(read(0, 2) != b"\xff\xd8"):
+        return None
+
+    offset = 2
+    while(True):
+        header = read(offset, 10)
+
+        if(len(header) < 4 or header[0] != 0xFF):
+            return None
+
+        marker = header[1]
+        length = struct.unpack(">H", header[2:4])[0]
+
+        if(marker == 0xE1 and header[4:10] == b"Exif\x00\x00"):
+            segment = read(offset + 10, length - 8)
+            if(len(segment) < length - 8):
+                raise ValueError("Incomplete EXIF segment")
+            return segment
+
+        # Start of the image data. No EXIF segment before it.
+        if(marker == 0xDA):
+            return b""
+
+        offset = offset + 2 + length
+
+
+def png_exif_block(read):
+    if(read(0, 8) != PNG_SIGNATURE):
+        return None
+
+    offset = 8
+    while(True):
+        header = read(offset, 8)
+
+        if(len(header) < 8):
+            return None
+
+        length, chunk_type = struct.unpack(">I4s", header)
+
+        if(chunk_type == b"eXIf"):
+            chunk = read(offset + 8, length)
+            if(len(chunk) < length):
+                raise ValueError("Incomplete eXIf chunk")
+            return chunk
+
+        if(chunk_type == b"IEND"):
+            return b""
+
+        # Length, type, data and CRC
+        offset = offset + 12 + length
+
+
+def heic_exif_block(read, size):
+    for box_type, start, end in iterate_boxes(read, 0, size):
+        if(box_type == b"meta"):
+            break
+        if(box_type == b"mdat"):
+            return None
+    else:
+        return None
+
+    # Full box: version and flags before the children
+    exif_item = None
+    locations = None
+
+    for box_type, box_start, box_end in iterate_boxes(read, start + 4, end):
+        if(box_type == b"iinf"):
+            exif_item = heic_exif_item(read(box_start, box_end - box_start))
+        elif(box_type == b"iloc"):
+            locations = heic_item_locations(read(box_start, box_end - box_start))
+
+    if(exif_item == None):
+        return b""
+
+    if(locations == None or exif_item not in locations):
+        return None
+
+    item_offset, item_length = locations[exif_item]
+
+    if(item_length > MAX_EXIF_SIZE):
+        return None
+
+    data = read(item_offset, item_length)
+
+    if(len(data) < item_length):
+        raise ValueError("Incomplete Exif item")
+
+    # The item starts with the offset of the TIFF header, usually after "Exif\0\0"
+    tiff_offset = struct.unpack(">I", data[0:4])[0]
+    return data[4 + tiff_offset:]
+
+
+#
+# Id of the Exif item in the item information box (iinf), or None
+#
+def heic_exif_item(iinf):
+    version = iinf[0]
+    entry_start = 6 if version == 0 else 8
+    read = lambda offset, length: iinf[offset:offset + length]
+
+    for box_type, start, end in iterate_boxes(read, entry_start, len(iinf)):
+        if(box_type != b"infe"):
+            continue
+
+        infe_version = iinf[start]
+
+        if(infe_version == 2):
+            item_id, protection, item_type = struct.unpack(">HH4s", iinf[start + 4:start + 12])
+        elif(infe_version == 3):
+            item_id, protection, item_type = struct.unpack(">IH4s", iinf[start + 4:start + 14])
+        else:
+            continue
+
+        if(item_type == b"Exif"):
+            return item_id
+
+    return None
+
+
+#
+# Offset and length in the file of the first extent of each item, from the item location box (iloc).
+# Items stored in other ways (e.g. in idat) are left out.
+#
+def heic_item_locations(iloc):
+    version = iloc[0]
+    offset_size = iloc[4] >> 4
+    length_size = iloc[4] & 0x0F
+    base_offset_size = iloc[5] >> 4
+    index_size = (iloc[5] & 0x0F) if version in (1, 2) else 0
+
+    def number(position, number_size):
+        if(number_size == 0):
+            return 0, position
+        return int.from_bytes(iloc[position:position + number_size], "big"), position + number_size
+
+    if(version == 2):
+        item_count, position = number(6, 4)
+    else:
+        item_count, position = number(6, 2)
+
+    locations = dict()
+    for i in range(item_count):
+        item_id, position = number(position, 4 if version == 2 else 2)
+
+        construction_method = 0
+        if(version in (1, 2)):
+            construction_method, position = number(position, 2)
+            construction_method = construction_method & 0x0F
+
+        data_reference_index, position = number(position, 2)
+        base_offset, position = number(position, base_offset_size)
+        extent_count, position = number(position, 2)
+
+        for extent in range(extent_count):
+            extent_index, position = number(position, index_size)
+            extent_offset, position = number(position, offset_size)
+            extent_length, position = number(position, length_size)
+
+            if(extent == 0 and extent_count == 1 and construction_method == 0 and data_reference_index == 0):
+                locations[item_id] = (base_offset + extent_offset, extent_length)
+
+        if(position > len(iloc)):
+            raise ValueError("Truncated iloc box")
+
+    return locations
+
+
+#
+# Decode the tags used from a TIFF block: IFD0, then the Exif and GPS IFDs it points to
+#
+def tiff_tags(tiff):
+    if(tiff[0:4] == b"II*\x00"):
+        byte_order = "<"
+    elif(tiff[0:4] == b"MM\x00*"):
+        byte_order = ">"
+    else:
+        return None
+
+    ifd0 = tiff_ifd(tiff, struct.unpack(byte_order + "I", tiff[4:8])[0], byte_order)
+    tags = dict()
+
+    for pointer, names in ((EXIF_IFD_POINTER, EXIF_TAGS), (GPS_IFD_POINTER, GPS_TAGS)):
+        if(pointer not in ifd0):
+            continue
+
+        ifd = tiff_ifd(tiff, tiff_value(tiff, ifd0[pointer], byte_order), byte_order)
+
+        for tag, name in names.items():
+            if(tag in ifd):
+                tags[name] = tiff_value(tiff, ifd[tag], byte_order)
+
+    return tags
+
+
+def tiff_ifd(tiff, offset, byte_order):
+    count = struct.unpack(byte_order + "H", tiff[offset:offset + 2])[0]
+    entries = dict()
+
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        tag, value_type, value_count = struct.unpack(byte_order + "HHI", tiff[entry:entry + 8])
+        entries[tag] = (value_type, value_count, tiff[entry + 8:entry + 12])
+
+    return entries
+
+
+#
+# Value of an IFD entry: ASCII as a string (up to the first null, as exifread), LONG as an int and RATIONAL as a list of floats
+#
+def tiff_value(tiff, entry, byte_order):
+    value_type, value_count, value_field = entry
+
+    if(value_type == TYPE_LONG):
+        return struct.unpack(byte_order + "I", value_field)[0]
+
+    if(value_type == TYPE_ASCII):
+        if(value_count <= 4):
+            data = value_field[0:value_count]
+        else:
+            offset = struct.unpack(byte_order + "I", value_field)[0]
+            data = tiff[offset:offset + value_count]
+            if(len(data) < value_count):
+                raise ValueError("Value outside the EXIF block")
+
+        return data.split(b"\x00", 1)[0].decode("utf-8")
+
+    if(value_type == TYPE_RATIONAL):
+        offset = struct.unpack(byte_order + "I", value_field)[0]
+        values = struct.unpack(byte_order + "I" * (2 * value_count), tiff[offset:offset + 8 * value_count])
+        return [values[i] / values[i + 1] if values[i + 1] != 0 else 0.0 for i in range(0, len(values), 2)]
+
+    raise ValueError("Unexpected type " + str(value_type))
@@ -0,0 +1,542 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import hashlib
+import random
+import threading
+import time
+
+from urllib.parse import quote, unquote
+
+from onedrive_graph import UPLOAD_CONFLICT_MESSAGE, STREAM_CHUNK_SIZE, item_details_response, item_path_response, delete_response
+from graph_batch import BatchQueue, MAX_BATCH_SIZE, BATCH_DELAY, completed_future
+from rate_limiter import RateLimiter, OPERATION_READ, OPERATION_WRITE, OPERATION_TRANSFER
+
+
+#
+# In memory OneDrive drive: files and folders by path (case insensitive, as OneDrive), with a change log for delta queries.
+# Several FakeOneDriveClient can share a drive, e.g. to test server side moves.
+#
+class FakeDrive:
+
+    def __init__(self, drive_id="fake-drive"):
+        self.drive_id = drive_id
+        self.lock = threading.Lock()
+
+        self.items = dict()
+        self.children = {"": dict()}
+        self.paths = dict()
+        self.changes = []
+        self.next_id = 1
+
+        # Called on each new or changed file, as change notifications. See subscribe().
+        self.subscribers = []
+
+
+    #
+    # Local stand-in for the change notifications of a drive, e.g. subscribe(watcher.notify).
+    # Only subscribe the origin drive: the uploads of the processor to a subscribed destination would start new cycles.
+    #
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+
+    def key(self, onedrive_path):
+        return onedrive_path.rstrip("/").lower()
+
+
+    def new_id(self):
+        item_id = self.drive_id + "!" + str(self.next_id)
+        self.next_id = self.next_id + 1
+        return item_id
+
+
+    # Must hold the lock
+    def make_folders(self, onedrive_folder):
+        parts = [part for part in onedrive_folder.split("/") if part != ""]
+        path = ""
+
+        for part in parts:
+            parent = path
+            path = path + "/" + part
+
+            if(self.key(path) not in self.items):
+                item = {"id": self.new_id(), "path": path, "name": part, "type": "folder", "data": None, "etag": "1"}
+                self.items[self.key(path)] = item
+                self.children[self.key(path)] = dict()
+                self.children[self.key(parent)][part.lower()] = self.key(path)
+                self.paths[item["id"]] = self.key(path)
+                self.changes.append((item["id"], False))
+
+            elif(self.items[self.key(path)]["type"] != "folder"):
+                raise ValueError("Not a folder: " + path)
+
+
+    #
+    # Add a file. Returns False when the name is already taken.
+    #
+    def put(self, onedrive_folder, filename, data, overwrite=False):
+        with self.lock:
+            self.make_folders(onedrive_folder)
+            path = onedrive_folder.rstrip("/") + "/" + filename
+            existing = self.items.get(self.key(path))
+
+            if(existing != None and overwrite == False):
+                return False
+
+            item_id = existing["id"] if existing != None else self.new_id()
+            etag = str(int(existing["etag"]) + 1) if existing != None else "1"
+
+            self.items[self.key(path)] = {"id": item_id, "path": path, "name": filename, "type": "file", "data": data, "etag": etag,
+                                          "sha256hash": hashlib.sha256(data).hexdigest().upper()}
+            self.children[self.key(onedrive_folder)][filename.lower()] = self.key(path)
+            self.paths[item_id] = self.key(path)
+            self.changes.append((item_id, False))
+
+        for callback in self.subscribers:
+            callback()
+
+        return True
+
+
+    def get(self, onedrive_path):
+        with self.lock:
+            return self.items.get(self.key(onedrive_path))
+
+
+    def get_by_id(self, item_id):
+        with self.lock:
+            key = self.paths.get(item_id)
+            return self.items.get(key) if key != None else None
+
+
+    def list(self, onedrive_folder):
+        with self.lock:
+            names = self.children.get(self.key(onedrive_folder))
+
+            if(names == None):
+                return None
+
+            return [self.items[key] for key in names.values()]
+
+
+    # Must hold the lock
+    def remove_key(self, key):
+        item = self.items.pop(key)
+
+        for child_key in list(self.children.pop(key, dict()).values()):
+            self.remove_key(child_key)
+
+        # The parent is gone already when it is removed with its children
+        parent = key.rsplit("/", 1)[0]
+        self.children.get(parent, dict()).pop(item["name"].lower(), None)
+        self.paths.pop(item["id"], None)
+        self.changes.append((item["id"], True))
+
+
+    def remove(self, onedrive_path):
+        with self.lock:
+            if(self.key(onedrive_path) not in self.items):
+                return False
+
+            self.remove_key(self.key(onedrive_path))
+            return True
+
+
+    #
+    # Rename or move an item. Returns False when the new name is already taken.
+    #
+    def move(self, item_id, onedrive_folder, filename):
+        with self.lock:
+            key = self.paths.get(item_id)
+            new_path = onedrive_folder.rstrip("/") + "/" + filename
+
+            if(key == None):
+                raise KeyError(item_id)
+
+            if(self.key(new_path) in self.items):
+                return False
+
+            self.make_folders(onedrive_folder)
+
+            item = self.items.pop(key)
+            self.children[key.rsplit("/", 1)[0]].pop(item["name"].lower(), None)
+
+            item = dict(item, path=new_path, name=filename, etag=str(int(item["etag"]) + 1))
+            self.items[self.key(new_path)] = item
+            self.children[self.key(onedrive_folder)][filename.lower()] = self.key(new_path)
+            self.paths[item_id] = self.key(new_path)
+            self.changes.append((item_id, False))
+            return True
+
+
+    #
+    # Items changed below a folder since a position of the change log. Returns the items and the new position.
+    #
+    def changes_since(self, onedrive_folder, position):
+        with self.lock:
+            prefix = self.key(onedrive_folder) + "/"
+            changed = dict()
+
+            for item_id, deleted in self.changes[position:]:
+                key = self.paths.get(item_id)
+
+                if(deleted or key == None):
+                    changed[item_id] = {"id": item_id, "name": "", "type": "file", "deleted": True}
+                elif(key.startswith(prefix)):
+                    item = self.items[key]
+                    changed[item_id] = {"id": item_id, "name": item["name"], "type": item["type"], "deleted": False}
+
+            return list(changed.values()), len(self.changes)
+
+
+#
+# Stand-in for OneDriveClient working on a FakeDrive.
+# Requests go through the same rate limiter as the real client, with injected latency, bandwidth,
+# throttling (HTTP 429 with Retry-After) and failures. The time of each call is kept by operation name.
+#
+class FakeOneDriveClient:
+
+    def __init__(self, drive, latency=0.0, bandwidth=None, throttle_rate=0.0, failure_rate=0.0, retry_after=0.1,
+                 rate_limiter=None, account=None, seed=None):
+        self.drive = drive
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.throttle_rate = throttle_rate
+        self.failure_rate = failure_rate
+        self.retry_after = retry_after
+
+        self.rate_limiter = rate_limiter if rate_limiter != None else RateLimiter()
+        self.account = account if account != None else drive.drive_id
+        self.random = random.Random(seed)
+
+        self.timings = dict()
+        self.stats_lock = threading.Lock()
+
+        self.batch_queue = BatchQueue(self.batch)
+
+
+    def set_upload_options(self, threshold=None, chunk_size=None, session_store=None):
+        pass
+
+
+    def set_download_options(self, threshold=None, range_size=None, workers=None):
+        pass
+
+
+    def set_batch_options(self, max_size=MAX_BATCH_SIZE, max_delay=BATCH_DELAY):
+        self.batch_queue = BatchQueue(self.batch, max_size, max_delay) if max_size > 1 else None
+
+
+    def record(self, name, elapsed):
+        with self.stats_lock:
+            self.timings.setdefault(name, []).append(elapsed)
+
+
+    #
+    # Run action() as one request: latency, transfer time for transfer_bytes, and the injected errors.
+    # Returns the result of action(), or an error result as the real client.
+    #
+    def request(self, name, operation, action, transfer_bytes=0):
+
+        def attempt():
+            if(self.latency > 0):
+                time.sleep(self.latency)
+
+            if(self.random.random() < self.throttle_rate):
+                return 429, {"Retry-After": str(self.retry_after)}, None
+
+            if(self.bandwidth != None and transfer_bytes > 0):
+                time.sleep(transfer_bytes / self.bandwidth)
+
+            if(self.random.random() < self.failure_rate):
+                return 500, {}, {"status": False, "code": 500, "message": "Injected failure"}
+
+            return 200, {}, action()
+
+        time_before = time.perf_counter()
+        code, headers, result = self.rate_limiter.limiter(self.account, operation).call(attempt)
+        self.record(name, time.perf_counter() - time_before)
+
+        if(code == 429):
+            return {"status": False, "code": 429, "message": "Throttled"}
+
+        return result
+
+
+    def file_details(self, item):
+        return {
+            "status": True,
+            "id": item["id"],
+            "name": item["name"],
+            "size": len(item["data"]),
+            "etag": item["etag"],
+            "sha256hash": item["sha256hash"],
+            "downloadurl": "fake://" + item["id"]
+        }
+
+
+    def item_details(self, onedrive_path):
+        def action():
+            item = self.drive.get(onedrive_path)
+
+            if(item == None):
+                return {"status": False, "code": 404, "message": "itemNotFound"}
+
+            if(item["type"] == "folder"):
+                return item_details_response(200, self.folder_response(onedrive_path, item))
+
+            return self.file_details(item)
+
+        return self.request("item_details", OPERATION_READ, action)
+
+
+    def filedetails(self, onedrive_path):
+        return self.item_details(onedrive_path)
+
+
+    def list_children(self, onedrive_folder):
+        def action():
+            items = self.drive.list(onedrive_folder)
+
+            if(items == None):
+                return {"status": True, "exists": False, "itemlist": []}
+
+            return {"status": True, "exists": True, "itemlist": [
+                {"id": item["id"], "name": item["name"], "type": item["type"],
+                 "size": len(item["data"]) if item["type"] == "file" else 0,
+                 "sha256hash": item.get("sha256hash", "")} for item in items]}
+
+        return self.request("list_children", OPERATION_READ, action)
+
+
+    def listfiles(self, onedrive_folder):
+        result = self.list_children(onedrive_folder)
+
+        if(result["status"] and result["exists"] == False):
+            return {"status": False, "code": 404, "message": "Folder not found: " + onedrive_folder}
+
+        return result
+
+
+    def delete(self, onedrive_path):
+        def action():
+            if(self.drive.remove(onedrive_path)):
+                return {"status": True, "message": "Item deleted"}
+            return {"status": False, "code": 404, "message": "itemNotFound"}
+
+        return self.request("delete", OPERATION_WRITE, action)
+
+
+    def item_resource(self, onedrive_path):
+        if(onedrive_path == "" or onedrive_path == "/"):
+            return "/me/drive/root"
+        return "/me/drive/root:" + quote(onedrive_path) + ":"
+
+
+    #
+    # Local $batch endpoint: the whole batch is one request, and each request in it can be throttled or fail on its own.
+    # Only the requests queued by the client are understood: GET and DELETE of an item by path, and GET of the path of an item by id.
+    #
+    def batch(self, requests):
+        def action():
+            responses = []
+
+            for request in requests:
+                responses.append(dict(self.batch_response(request), id=request["id"]))
+
+            return {"status": True, "responses": responses}
+
+        return self.request("batch", OPERATION_WRITE, action)
+
+
+    def batch_response(self, request):
+        if(self.random.random() < self.throttle_rate):
+            return {"status": 429, "headers": {"Retry-After": str(self.retry_after)}, "body": {"error": {"code": "activityLimitReached"}}}
+
+        if(self.random.random() < self.failure_rate):
+            return {"status": 500, "body": {"error": {"code": "generalException", "message": "Injected failure"}}}
+
+        if(request["url"].startswith("/me/drive/items/")):
+            item = self.drive.get_by_id(request["url"][len("/me/drive/items/"):].split("?")[0])
+
+            if(item == None):
+                return {"status": 404, "body": {"error": {"code": "itemNotFound"}}}
+
+            parent_path = item["path"].rsplit("/", 1)[0]
+            return {"status": 200, "body": {"name": item["name"], "parentReference": {"path": "/drive/root:" + quote(parent_path)}}}
+
+        onedrive_path = unquote(request["url"][len("/me/drive/root:"):-1])
+
+        if(request["method"] == "DELETE"):
+            if(self.drive.remove(onedrive_path)):
+                return {"status": 204}
+            return {"status": 404, "body": {"error": {"code": "itemNotFound"}}}
+
+        item = self.drive.get(onedrive_path)
+
+        if(item == None):
+            return {"status": 404, "body": {"error": {"code": "itemNotFound"}}}
+
+        if(item["type"] == "folder"):
+            return {"status": 200, "body": self.folder_response(onedrive_path, item)}
+
+        details = self.file_details(item)
+
+        return {"status": 200, "body": {
+            "id": details["id"],
+            "name": details["name"],
+            "size": details["size"],
+            "eTag": details["etag"],
+            "file": {"hashes": {"sha256Hash": details["sha256hash"]}},
+            "@microsoft.graph.downloadUrl": details["downloadurl"]
+        }}
+
+
+    def folder_response(self, onedrive_path, item):
+        children = self.drive.list(onedrive_path) or []
+        return {"id": item["id"], "name": item["name"], "eTag": item["etag"], "folder": {"childCount": len(children)}}
+
+
+    def delete_later(self, onedrive_path):
+        if(self.batch_queue == None):
+            return completed_future(self.delete(onedrive_path))
+
+        return self.batch_queue.submit("DELETE", self.item_resource(onedrive_path), delete_response)
+
+
+    def item_details_later(self, onedrive_path):
+        if(self.batch_queue == None):
+            return completed_future(self.item_details(onedrive_path))
+
+        return self.batch_queue.submit("GET", self.item_resource(onedrive_path), item_details_response)
+
+
+    def item_path_later(self, item_id):
+        if(self.batch_queue == None):
+            return completed_future(self.item_path(item_id))
+
+        return self.batch_queue.submit("GET", "/me/drive/items/" + item_id + "?$select=name,parentReference", item_path_response)
+
+
+    def flush_batches(self):
+        if(self.batch_queue != None):
+            self.batch_queue.flush()
+
+
+    def item_data(self, download_url):
+        item = self.drive.get_by_id(download_url[len("fake://"):])
+        return None if item == None else item["data"]
+
+
+    def download_range(self, download_url, start, end):
+        data = self.item_data(download_url)
+
+        if(data == None):
+            return {"status": False, "code": 404, "message": "Error downloading range. HTTP 404"}
+
+        def action():
+            return {"status": True, "data": data[start:end + 1]}
+
+        return self.request("download_range", OPERATION_TRANSFER, action, min(end + 1, len(data)) - start)
+
+
+    def download_to(self, download_url, fileobj, size=None):
+        data = self.item_data(download_url)
+
+        if(data == None):
+            return {"status": False, "code": 404, "message": "Error downloading file. HTTP 404"}
+
+        def action():
+            file_hash = hashlib.sha256()
+
+            for offset in range(0, len(data), STREAM_CHUNK_SIZE):
+                chunk = data[offset:offset + STREAM_CHUNK_SIZE]
+                fileobj.write(chunk)
+                file_hash.update(chunk)
+
+            return {"status": True, "size": len(data), "sha256hash": file_hash.hexdigest().upper()}
+
+        return self.request("download_to", OPERATION_TRANSFER, action, len(data))
+
+
+    def upload_from(self, fileobj, size, onedrive_folder, filename, session_key=None):
+        data = fileobj.read()
+
+        def action():
+            if(self.drive.put(onedrive_folder, filename, data) == False):
+                return {"status": False, "code": 409, "message": UPLOAD_CONFLICT_MESSAGE}
+            return {"status": True, "message": "File uploaded"}
+
+        return self.request("upload_from", OPERATION_TRANSFER, action, len(data))
+
+
+    def drive_id(self):
+        return self.drive.drive_id
+
+
+    def move_item(self, item_id, onedrive_folder, filename):
+        def action():
+            try:
+                moved = self.drive.move(item_id, onedrive_folder, filename)
+            except KeyError:
+                return {"status": False, "code": 404, "message": "itemNotFound"}
+
+            if(moved == False):
+                return {"status": False, "code": 409, "message": UPLOAD_CONFLICT_MESSAGE}
+            return {"status": True, "message": "File moved"}
+
+        return self.request("move_item", OPERATION_WRITE, action)
+
+
+    #
+    # Delta links are positions in the change log of the drive
+    #
+    def delta(self, onedrive_folder, delta_link=None, latest=False):
+        def action():
+            position = 0
+
+            if(delta_link != None):
+                position = int(delta_link.rsplit(":", 1)[1])
+
+            item_list, new_position = self.drive.changes_since(onedrive_folder, position)
+
+            if(latest):
+                item_list = []
+
+            return {"status": True, "itemlist": item_list, "deltalink": "fake-delta:" + str(new_position)}
+
+        return self.request("delta", OPERATION_READ, action)
+
+
+    def item_path(self, item_id):
+        def action():
+            item = self.drive.get_by_id(item_id)
+
+            if(item == None):
+                return {"status": False, "code": 404, "message": "itemNotFound"}
+
+            return {"status": True, "path": item["path"]}
+
+        return self.request("item_path", OPERATION_READ, action)
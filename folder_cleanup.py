@@ -0,0 +1,122 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import os
+import threading
+
+
+#
+# Children left in each source folder while its files are processed, to remove the empty folders at the end
+# without listing them again. The counts start from the listing of each folder and go down as files are moved
+# or deleted and subfolders removed.
+# A folder is uncertain when its count can't be trusted (listing failed, a delete failed, incremental scans).
+# The counts only tell which folders may be empty: files can still be added to them, so they are checked before
+# they are removed. The root folder is never removed.
+#
+class FolderCleanup:
+
+    def __init__(self, root):
+        self.root = root.rstrip("/")
+        self.lock = threading.Lock()
+        self.remaining = dict()
+        self.uncertain = set()
+        self.listing_errors = 0
+
+
+    #
+    # Register a folder with the number of children of its listing, or None when unknown
+    #
+    def add_folder(self, folder_path, children):
+        with self.lock:
+            if(children == None):
+                self.remaining[folder_path] = 0
+                self.uncertain.add(folder_path)
+            else:
+                self.remaining[folder_path] = children
+
+
+    #
+    # The folder could not be listed, so its files were not processed
+    #
+    def listing_failed(self, folder_path):
+        self.add_folder(folder_path, None)
+
+        with self.lock:
+            self.listing_errors = self.listing_errors + 1
+
+
+    #
+    # A child of a folder (file or subfolder) is no longer there
+    #
+    def removed(self, item_path):
+        parent = os.path.dirname(item_path)
+
+        with self.lock:
+            if(parent in self.remaining):
+                self.remaining[parent] = self.remaining[parent] - 1
+
+
+    #
+    # The child may or may not be there (e.g. its delete failed)
+    #
+    def mark_uncertain(self, item_path):
+        parent = os.path.dirname(item_path)
+
+        with self.lock:
+            if(parent in self.remaining):
+                self.uncertain.add(parent)
+
+
+    def is_uncertain(self, folder_path):
+        with self.lock:
+            return folder_path in self.uncertain
+
+
+    def is_empty(self, folder_path):
+        with self.lock:
+            return self.remaining.get(folder_path, 0) <= 0
+
+
+    #
+    # The folders below the root, deepest first
+    #
+    def folders(self):
+        with self.lock:
+            folders = [folder_path for folder_path in self.remaining if folder_path != self.root]
+
+        return sorted(folders, key=lambda folder_path: folder_path.count("/"), reverse=True)
+
+
+    #
+    # The folders below the root grouped by depth, deepest first. All the folders of a level can be removed together.
+    #
+    def levels(self):
+        levels = []
+
+        for folder_path in self.folders():
+            if(len(levels) == 0 or levels[-1][0].count("/") != folder_path.count("/")):
+                levels.append([])
+            levels[-1].append(folder_path)
+
+        return levels
@@ -0,0 +1,193 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import logging
+import threading
+import time
+
+from concurrent.futures import Future
+
+from rate_limiter import parse_retry_after
+
+
+# Graph accepts up to 20 requests in each $batch request
+MAX_BATCH_SIZE = 20
+
+# Seconds a request waits for others before its batch is sent
+BATCH_DELAY = 0.02
+
+# Attempts of each request throttled inside a batch, and maximum wait between them
+MAX_BATCH_ATTEMPTS = 4
+MAX_BATCH_RETRY_AFTER = 60
+
+
+#
+# Future already holding result, for the requests that are not batched
+#
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+#
+# Queue of small Graph requests (deletes, item details) sent together as JSON batches.
+# send(requests) posts one batch and returns {"status", "responses"} (or "message"), as OneDriveClient.batch().
+# Each request gets its own future, with the result of convert(code, body) for its response.
+# A batch is sent when max_size requests are queued, or max_delay seconds after the first one.
+# Requests throttled inside a batch (429/503) are sent again in the next batch, after Retry-After.
+#
+class BatchQueue:
+
+    def __init__(self, send, max_size=MAX_BATCH_SIZE, max_delay=BATCH_DELAY, max_attempts=MAX_BATCH_ATTEMPTS):
+        self.send = send
+        self.max_size = max(1, min(max_size, MAX_BATCH_SIZE))
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.in_flight = []
+        self.flushing = 0
+        self.thread = None
+
+
+    def submit(self, method, url, convert):
+        future = Future()
+
+        with self.condition:
+            self.pending.append({"method": method, "url": url, "convert": convert, "future": future, "attempts": 0})
+
+            if(self.thread == None):
+                self.thread = threading.Thread(target=self.run, name="graph-batch", daemon=True)
+                self.thread.start()
+
+            self.condition.notify_all()
+
+        return future
+
+
+    #
+    # Send the queued requests now and wait for all of them, e.g. before removing the folder of deleted files.
+    # The batches are sent without delay until they are done, retries of throttled requests included.
+    #
+    def flush(self):
+        with self.condition:
+            futures = [request["future"] for request in self.pending + self.in_flight]
+            self.flushing = self.flushing + 1
+            self.condition.notify_all()
+
+        try:
+            for future in futures:
+                future.result()
+        finally:
+            with self.condition:
+                self.flushing = self.flushing - 1
+
+
+    def next_batch(self):
+        with self.condition:
+            while(len(self.pending) == 0):
+                self.condition.wait()
+
+            deadline = time.monotonic() + self.max_delay
+
+            while(len(self.pending) < self.max_size and self.flushing == 0):
+                remaining = deadline - time.monotonic()
+                if(remaining <= 0):
+                    break
+                self.condition.wait(remaining)
+
+            batch = self.pending[:self.max_size]
+            del self.pending[:self.max_size]
+
+            self.in_flight = batch
+            return batch
+
+
+    def run(self):
+        while(True):
+            batch = self.next_batch()
+
+            try:
+                self.send_batch(batch)
+            except Exception as ex:
+                logging.exception("BatchQueue.run(): Error sending a batch of %d requests", len(batch))
+
+                # Requests already queued again for a retry get the error too, so they are not sent again
+                with self.condition:
+                    self.pending = [request for request in self.pending if any(request is failed for failed in batch) == False]
+
+                for request in batch:
+                    if(request["future"].done() == False):
+                        request["future"].set_result({"status": False, "message": str(ex)})
+
+            with self.condition:
+                self.in_flight = []
+
+
+    def send_batch(self, batch):
+        requests = [{"id": str(index), "method": request["method"], "url": request["url"]} for index, request in enumerate(batch)]
+
+        result = self.send(requests)
+
+        if(result["status"] == False):
+            # The whole batch failed. Each request gets the error.
+            for request in batch:
+                request["future"].set_result({"status": False, "code": result.get("code"), "message": result["message"]})
+            return
+
+        responses = dict((response["id"], response) for response in result["responses"])
+        retry_after = 0
+
+        for index, request in enumerate(batch):
+            response = responses.get(str(index))
+
+            if(response == None):
+                request["future"].set_result({"status": False, "message": "No response for the request in the batch"})
+                continue
+
+            headers = dict((name.lower(), value) for name, value in (response.get("headers") or {}).items())
+            request["attempts"] = request["attempts"] + 1
+
+            if((response["status"] == 429 or response["status"] == 503) and request["attempts"] < self.max_attempts):
+                # Seconds. 1 when missing or not a number (e.g. an HTTP date).
+                request_retry_after = parse_retry_after({"Retry-After": headers.get("retry-after")})
+                if(request_retry_after == None):
+                    request_retry_after = 1
+
+                retry_after = max(retry_after, min(MAX_BATCH_RETRY_AFTER, request_retry_after))
+                self.retry(request)
+                continue
+
+            request["future"].set_result(request["convert"](response["status"], response.get("body")))
+
+        if(retry_after > 0):
+            logging.info("BatchQueue.send_batch(): Requests throttled in the batch. Retrying after %s seconds.", retry_after)
+            time.sleep(retry_after)
+
+
+    def retry(self, request):
+        with self.condition:
+            self.pending.insert(0, request)
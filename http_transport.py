@@ -0,0 +1,309 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import http.client
+import io
+import logging
+import ssl
+import threading
+import time
+
+from urllib.parse import urlsplit, urljoin
+from urllib.error import HTTPError, URLError
+
+
+# Connections kept open to each host, shared by all the clients
+MAX_CONNECTIONS_PER_HOST = 16
+
+# Seconds an idle connection is kept. Servers close idle connections on their side after a while.
+IDLE_TIMEOUT = 60
+
+# Seconds a request waits for a free connection of the pool before failing
+POOL_TIMEOUT = 300
+
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Errors of a kept alive connection closed by the server while idle. The request is sent again on a new connection.
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+# Methods sent again when the connection fails after the whole request was sent, as the server may have applied it.
+# DELETE and the uploads with conflictBehavior=fail are not: sent again, they fail (404, 409) when the first one was applied.
+RETRY_AFTER_SEND_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+#
+# Response of a pooled connection. The connection goes back to the pool once the body is read to the end,
+# and is closed when the response is closed before that.
+#
+class PooledResponse:
+
+    def __init__(self, transport, key, connection, response, url):
+        self.transport = transport
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        self.released = False
+
+
+    def read(self, amount=None):
+        try:
+            data = self.response.read() if amount == None else self.response.read(amount)
+        except (OSError, http.client.HTTPException) as ex:
+            # The connection failed while reading the body (reset, timeout, incomplete read). URLError as when connecting.
+            self.release(False)
+            raise URLError(ex)
+        except Exception:
+            self.release(False)
+            raise
+
+        if(amount == None or len(data) == 0 or self.response.isclosed()):
+            self.release(self.response.will_close == False)
+
+        return data
+
+
+    def close(self):
+        self.release(False)
+
+
+    def release(self, reusable):
+        if(self.released == False):
+            self.released = True
+            self.transport.release(self.key, self.connection, reusable)
+
+
+    def __del__(self):
+        self.release(False)
+
+
+#
+# HTTP/1.1 transport with a pool of kept alive connections per host (scheme, host and port).
+# Shared by all the clients, so requests to Graph, the download and upload hosts and the token endpoint
+# reuse the TCP/TLS connections instead of opening one per request as urlopen does.
+# Errors follow urlopen: HTTPError for error status codes, URLError when the connection fails.
+#
+class HttpTransport:
+
+    def __init__(self, max_connections_per_host=MAX_CONNECTIONS_PER_HOST, idle_timeout=IDLE_TIMEOUT, pool_timeout=POOL_TIMEOUT):
+        self.max_connections_per_host = max(1, max_connections_per_host)
+        self.idle_timeout = idle_timeout
+        self.pool_timeout = pool_timeout
+        self.ssl_context = ssl.create_default_context()
+
+        self.condition = threading.Condition()
+        self.idle = dict()
+        self.open_connections = dict()
+        self.statistics = dict()
+
+
+    def host_statistics(self, key):
+        # Must hold the lock
+        if(key not in self.statistics):
+            self.statistics[key] = {"requests": 0, "connections_created": 0, "connections_reused": 0, "stale_retries": 0,
+                                    "pool_waits": 0, "pool_wait_seconds": 0.0}
+        return self.statistics[key]
+
+
+    #
+    # Take an idle connection of the host, or open a new one while below the limit. Waits for a free connection otherwise,
+    # at most pool_timeout seconds (URLError), so a connection never given back does not block the workers forever.
+    # Returns the connection and True when it was reused.
+    #
+    def acquire(self, key, timeout):
+        scheme, host, port = key
+        wait_started = None
+
+        with self.condition:
+            statistics = self.host_statistics(key)
+
+            while(True):
+                idle = self.idle.setdefault(key, [])
+
+                while(len(idle) > 0):
+                    connection, idle_since = idle.pop()
+
+                    if(time.monotonic() - idle_since < self.idle_timeout):
+                        statistics["connections_reused"] = statistics["connections_reused"] + 1
+                        self.record_wait(statistics, wait_started)
+                        connection.timeout = timeout
+                        if(connection.sock != None):
+                            connection.sock.settimeout(timeout)
+                        return connection, True
+
+                    connection.close()
+                    self.open_connections[key] = self.open_connections[key] - 1
+
+                if(self.open_connections.get(key, 0) < self.max_connections_per_host):
+                    self.open_connections[key] = self.open_connections.get(key, 0) + 1
+                    statistics["connections_created"] = statistics["connections_created"] + 1
+                    self.record_wait(statistics, wait_started)
+                    break
+
+                if(wait_started == None):
+                    wait_started = time.monotonic()
+                    statistics["pool_waits"] = statistics["pool_waits"] + 1
+
+                remaining = wait_started + self.pool_timeout - time.monotonic()
+
+                if(remaining <= 0):
+                    self.record_wait(statistics, wait_started)
+                    raise URLError("Timed out waiting for a free connection to " + host)
+
+                self.condition.wait(remaining)
+
+        if(scheme == "https"):
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self.ssl_context), False
+
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+
+    def record_wait(self, statistics, wait_started):
+        if(wait_started != None):
+            statistics["pool_wait_seconds"] = statistics["pool_wait_seconds"] + time.monotonic() - wait_started
+
+
+    def release(self, key, connection, reusable):
+        with self.condition:
+            if(reusable):
+                self.idle.setdefault(key, []).append((connection, time.monotonic()))
+            else:
+                connection.close()
+                self.open_connections[key] = self.open_connections[key] - 1
+
+            self.condition.notify()
+
+
+    #
+    # Send a request and return the response (PooledResponse) to be read by the caller. Redirects are followed.
+    #
+    def open(self, method, url, body=None, headers=None, timeout=60):
+        headers = dict(headers or {})
+
+        for redirect in range(MAX_REDIRECTS + 1):
+            response = self.send(method, url, body, headers, timeout)
+
+            if(response.status not in REDIRECT_CODES or "Location" not in response.headers):
+                break
+
+            location = urljoin(url, response.headers["Location"])
+            response.read()
+
+            # Credentials are not sent to another host
+            if(urlsplit(location).netloc != urlsplit(url).netloc):
+                headers.pop("Authorization", None)
+
+            if(response.status == 303):
+                method = "GET"
+                body = None
+
+            url = location
+
+        if(response.status >= 400):
+            content = response.read()
+            raise HTTPError(url, response.status, response.response.reason, response.headers, io.BytesIO(content))
+
+        return response
+
+
+    def send(self, method, url, body, headers, timeout):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if(parts.query != ""):
+            path = path + "?" + parts.query
+
+        if(body != None and "Content-Length" not in headers):
+            headers["Content-Length"] = str(len(body))
+
+        with self.condition:
+            statistics = self.host_statistics(key)
+            statistics["requests"] = statistics["requests"] + 1
+
+        while(True):
+            connection, reused = self.acquire(key, timeout)
+            sent = False
+
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                sent = True
+                response = connection.getresponse()
+                return PooledResponse(self, key, connection, response, url)
+
+            except STALE_CONNECTION_ERRORS as ex:
+                self.release(key, connection, False)
+
+                # A request not fully sent was not processed. Once sent, it may have been, even if no response came back.
+                if(reused == False or (sent and method not in RETRY_AFTER_SEND_METHODS)):
+                    raise URLError(ex)
+
+                # The server closed the idle connection, so send it again
+                with self.condition:
+                    statistics = self.host_statistics(key)
+                    statistics["stale_retries"] = statistics["stale_retries"] + 1
+
+            except (OSError, http.client.HTTPException) as ex:
+                self.release(key, connection, False)
+                raise URLError(ex)
+
+
+    #
+    # Statistics of each host: requests, connections created and reused, retries on stale connections,
+    # waits for a free connection, and the connections open and idle now
+    #
+    def stats(self):
+        with self.condition:
+            result = dict()
+
+            for key, statistics in self.statistics.items():
+                scheme, host, port = key
+                idle = len(self.idle.get(key, []))
+                result[scheme + "://" + host + ":" + str(port)] = dict(statistics,
+                                                                        pool_wait_seconds=round(statistics["pool_wait_seconds"], 3),
+                                                                        open=self.open_connections.get(key, 0),
+                                                                        idle=idle,
+                                                                        in_use=self.open_connections.get(key, 0) - idle)
+            return result
+
+
+    #
+    # The statistics as metrics (name, type, labels, value), for Metrics.add_source()
+    #
+    def metrics(self):
+        samples = []
+
+        for host, statistics in self.stats().items():
+            labels = (("host", host),)
+            for name in ("requests", "connections_created", "connections_reused", "stale_retries", "pool_waits"):
+                samples.append(("http_" + name + "_total", "counter", labels, statistics[name]))
+            samples.append(("http_pool_wait_seconds_total", "counter", labels, statistics["pool_wait_seconds"]))
+            samples.append(("http_connections_open", "gauge", labels, statistics["open"]))
+            samples.append(("http_connections_idle", "gauge", labels, statistics["idle"]))
+
+        return samples
@@ -27,13 +27,25 @@ import io
 import json
 import logging
 from PIL import Image
+from exif_reader import read_exif_tags_from
 
 def pretty_print(obj):
     #Pretty print
     json_formatted_str = json.dumps(obj, indent=2)
     print(json_formatted_str)
 
-def process_image(filename):
+#
+# Read the image date/time from the EXIF data.
+# When fileobj is provided the data is read from it (e.g. the first bytes of a remote file)
+# and filename is only used to determine the file type.
+# The EXIF segment is read directly first. exifread and PIL are used when the file is not as expected.
+#
+def process_image(filename, fileobj=None):
+    result = process_image_fast(filename, fileobj)
+
+    if(result != None):
+        return result
+
     # Open image file for reading (binary mode)
     file_name_lower = filename.lower()
     
@@ -46,12 +58,16 @@ def process_image(filename):
 
     if(file_name_lower.endswith(".heic") or file_name_lower.endswith(".jpg")):
 
-        f = open(filename, 'rb')
+        if(fileobj == None):
+            f = open(filename, 'rb')
+        else:
+            f = fileobj
         
         # Return Exif tags
         tags = exifread.process_file(f)
 
-        f.close()
+        if(fileobj == None):
+            f.close()
      
         #print("Latitude:", tags["GPS GPSLongitude"])
         latitude = get_key_value("GPS GPSLatitude", tags)
@@ -71,7 +87,7 @@ def process_image(filename):
     elif(file_name_lower.endswith(".png")):
         
         try:
-            image = Image.open(filename)
+            image = Image.open(filename if fileobj == None else fileobj)
             image.verify()
             result = image._getexif()
             
@@ -96,6 +112,33 @@ def process_image(filename):
 
 
 
+#
+# Same result as process_image(), from the few tags decoded by exif_reader. None when exif_reader can't read the file.
+#
+def process_image_fast(filename, fileobj=None):
+    if(fileobj == None):
+        with open(filename, 'rb') as f:
+            tags = read_exif_tags_from(filename, f)
+    else:
+        tags = read_exif_tags_from(filename, fileobj)
+
+    if(tags == None):
+        return None
+
+    logging.debug("Latitude     : %s", get_key_value("GPSLatitude", tags))
+    logging.debug("Longitude:   : %s", get_key_value("GPSLongitude", tags))
+
+    # The offset was never read for PNG. Kept the same, so the names do not change.
+    original_time_offset = ""
+    if(filename.lower().endswith(".png") == False):
+        original_time_offset = get_key_value("OffsetTimeOriginal", tags)
+
+    return {"originaltime": get_key_value("DateTimeOriginal", tags),
+            "offset": original_time_offset,
+            "originalsubsecond": get_key_value("SubSecTimeOriginal", tags)
+            }
+
+
 def get_exif(filename):
     image = Image.open(filename)
     image.verify()
@@ -109,3 +152,33 @@ def get_key_value(key, tags):
         return value
     except KeyError:
         return ""
+
+
+#
+# Find where the EXIF (APP1) segment ends in the first bytes of a JPEG file.
+# Returns the number of bytes needed to read the full EXIF block, 0 when the file has no EXIF block,
+# or None when more data is needed to find out.
+#
+def jpeg_exif_length(data):
+    if(data[0:2] != b"\xff\xd8"):
+        return None
+
+    offset = 2
+    while(offset + 4 <= len(data)):
+        if(data[offset] != 0xFF):
+            # Not a valid segment. Let the full file processing deal with it.
+            return None
+
+        marker = data[offset + 1]
+        length = int.from_bytes(data[offset + 2:offset + 4], "big")
+
+        if(marker == 0xE1 and data[offset + 4:offset + 10] == b"Exif\x00\x00"):
+            return offset + 2 + length
+
+        # Start of the image data. No EXIF block before it.
+        if(marker == 0xDA):
+            return 0
+
+        offset = offset + 2 + length
+
+    return None
@@ -0,0 +1,65 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import json
+import threading
+
+
+#
+# Manifest of a planned run, as JSON lines: one entry per source file (destination, naming and planned action)
+# and one per source folder to remove. Written by the plan mode and applied by the execute mode.
+#
+class ManifestWriter:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.output = open(filename, "w", encoding="utf-8")
+
+
+    def write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+
+        # Origins are planned in parallel
+        with self.lock:
+            self.output.write(line)
+
+
+    def close(self):
+        with self.lock:
+            self.output.close()
+
+
+#
+# Read the entries of a manifest, in the order they were written
+#
+def read_manifest(filename):
+    entries = []
+
+    with open(filename, encoding="utf-8") as manifest:
+        for line in manifest:
+            if(line.strip() != ""):
+                entries.append(json.loads(line))
+
+    return entries
@@ -0,0 +1,316 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Processing stages
+STAGE_LIST = "list"
+STAGE_DOWNLOAD = "download"
+STAGE_METADATA = "metadata"
+STAGE_NAMING = "naming"
+STAGE_CONFLICT_CHECK = "conflict_check"
+STAGE_UPLOAD = "upload"
+STAGE_DELETE = "delete"
+
+# Upper bounds (seconds) of the histogram buckets (default)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PREFIX = "onedrive_processor_"
+
+DESCRIPTIONS = {
+    "stage_seconds": "Time spent in each processing stage",
+    "file_seconds": "Time to process each file, all stages included",
+    "files_total": "Files processed, by outcome",
+    "bytes_total": "Bytes transferred, by direction",
+    "stage_errors_total": "Processing stages that raised an error",
+    "http_requests_total": "HTTP requests sent, by host",
+    "http_connections_created_total": "HTTP connections opened, by host",
+    "http_connections_reused_total": "HTTP requests sent on a kept alive connection, by host",
+    "http_stale_retries_total": "HTTP requests sent again after the server closed an idle connection",
+    "http_pool_waits_total": "HTTP requests that waited for a free connection of the pool",
+    "http_pool_wait_seconds_total": "Time waited for a free connection of the pool",
+    "http_connections_open": "HTTP connections open, by host",
+    "http_connections_idle": "HTTP connections idle in the pool, by host"
+}
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+
+    if(len(pairs) == 0):
+        return ""
+
+    return "{" + ",".join(name + "=\"" + escape_label(value) + "\"" for name, value in pairs) + "}"
+
+
+#
+# Estimate of a quantile (0 to 1) of a histogram, interpolated within its bucket as Prometheus histogram_quantile().
+# Values above the last bucket are reported as its bound.
+#
+def histogram_quantile(histogram, quantile, buckets=BUCKETS):
+    if(histogram["count"] == 0):
+        return 0.0
+
+    rank = quantile * histogram["count"]
+    lower_bound = 0.0
+    lower_count = 0
+
+    for bound, count in zip(buckets, histogram["buckets"]):
+        if(count >= rank):
+            if(count == lower_count):
+                return lower_bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+
+        lower_bound = bound
+        lower_count = count
+
+    return buckets[-1]
+
+
+#
+# Counters and histograms of the processing, labelled by origin and media type.
+# The labels of the file being processed are kept per thread (see context()), so the stages do not need to pass them.
+# Exported in the Prometheus text format (HTTP endpoint or textfile) or as a JSON summary.
+#
+class Metrics:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = dict()
+        self.histograms = dict()
+        self.sources = []
+
+
+    #
+    # Function returning metrics kept elsewhere (e.g. the HTTP connection pool) as a list of (name, type, labels, value),
+    # read each time the metrics are exported
+    #
+    def add_source(self, source):
+        self.sources.append(source)
+
+
+    def source_samples(self):
+        samples = []
+        for source in self.sources:
+            samples.extend(source())
+        return sorted(samples)
+
+
+    #
+    # Labels for the metrics recorded by the current thread, e.g. while processing a file
+    #
+    @contextmanager
+    def context(self, **labels):
+        previous = getattr(self.local, "labels", dict())
+        self.local.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+
+    def labels(self, **labels):
+        current = dict(getattr(self.local, "labels", dict()))
+        current.update(labels)
+        return tuple(sorted(current.items()))
+
+
+    def increment(self, name, value=1, **labels):
+        key = (name, self.labels(**labels))
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, seconds, **labels):
+        key = (name, self.labels(**labels))
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+
+            if(histogram == None):
+                histogram = {"buckets": [0] * len(self.buckets), "count": 0, "sum": 0.0}
+                self.histograms[key] = histogram
+
+            for index, bound in enumerate(self.buckets):
+                if(seconds <= bound):
+                    histogram["buckets"][index] = histogram["buckets"][index] + 1
+
+            histogram["count"] = histogram["count"] + 1
+            histogram["sum"] = histogram["sum"] + seconds
+
+
+    #
+    # Time a processing stage. Errors raised inside the stage are counted and raised again.
+    #
+    @contextmanager
+    def stage(self, stage):
+        time_before = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment("stage_errors_total", stage=stage)
+            raise
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - time_before, stage=stage)
+
+
+    #
+    # Copy of the histograms of a metric, as (labels, histogram) sorted by labels
+    #
+    def histogram_items(self, name):
+        with self.lock:
+            return sorted((labels, dict(value, buckets=list(value["buckets"]))) for (metric, labels), value in self.histograms.items() if metric == name)
+
+
+    #
+    # Prometheus text exposition format
+    #
+    def render_prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, metric_type):
+            if(name not in described):
+                described.add(name)
+                lines.append("# HELP " + PREFIX + name + " " + DESCRIPTIONS.get(name, name))
+                lines.append("# TYPE " + PREFIX + name + " " + metric_type)
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(PREFIX + name + format_labels(labels) + " " + str(value))
+
+        for name, metric_type, labels, value in self.source_samples():
+            describe(name, metric_type)
+            lines.append(PREFIX + name + format_labels(labels) + " " + str(value))
+
+        for (name, labels), histogram in histograms:
+            describe(name, "histogram")
+
+            for bound, count in zip(self.buckets, histogram["buckets"]):
+                lines.append(PREFIX + name + "_bucket" + format_labels(labels, [("le", str(bound))]) + " " + str(count))
+
+            lines.append(PREFIX + name + "_bucket" + format_labels(labels, [("le", "+Inf")]) + " " + str(histogram["count"]))
+            lines.append(PREFIX + name + "_sum" + format_labels(labels) + " " + repr(round(histogram["sum"], 6)))
+            lines.append(PREFIX + name + "_count" + format_labels(labels) + " " + str(histogram["count"]))
+
+        return "\n".join(lines) + "\n"
+
+
+    #
+    # Counters, gauges and histograms (count, total and mean seconds) as a dictionary, for the JSON summary
+    #
+    def summary(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        result = {"generated": datetime.datetime.now(datetime.timezone.utc).isoformat(), "counters": dict(), "gauges": dict(), "histograms": dict()}
+
+        for (name, labels), value in counters:
+            result["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+
+        for name, metric_type, labels, value in self.source_samples():
+            result["counters" if metric_type == "counter" else "gauges"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+
+        for (name, labels), histogram in histograms:
+            result["histograms"].setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": histogram["count"],
+                "seconds": round(histogram["sum"], 3),
+                "mean_seconds": round(histogram["sum"] / histogram["count"], 4) if histogram["count"] > 0 else 0
+            })
+
+        return result
+
+
+    #
+    # Write the file in a temporary file first, so a collector never reads a partial file
+    # (e.g. the textfile collector of the node exporter for cron runs)
+    #
+    def write_file(self, filename, content):
+        temporary = filename + ".tmp"
+
+        with open(temporary, "w") as output:
+            output.write(content)
+
+        os.replace(temporary, filename)
+
+
+    def write_textfile(self, filename):
+        self.write_file(filename, self.render_prometheus())
+
+
+    def write_json(self, filename):
+        self.write_file(filename, json.dumps(self.summary(), indent=2))
+
+
+    #
+    # Serve the metrics on http://<address>:<port>/metrics from a background thread. Returns the server, to shut it down.
+    #
+    def start_http_server(self, port, address=""):
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if(self.path.split("?")[0] != "/metrics"):
+                    self.send_error(404)
+                    return
+
+                body = metrics.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics endpoint: " + format, *args)
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+        logging.info("Metrics available on port %d (/metrics)", server.server_port)
+        return server
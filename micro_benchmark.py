@@ -0,0 +1,215 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import timeit
+
+from PIL import Image
+
+from onedrive_processor import parse_filename_pattern, new_file_details, get_extension, video_filename
+from image_processing import process_image
+from benchmark import make_jpeg, make_heic, make_png, make_mov
+
+
+DEFAULT_RESULTS_FILE = "micro_benchmark_results.jsonl"
+
+
+############## Fixed corpora, one per naming branch ####################
+
+FILENAME_CORPORA = {
+    "onedrive_ios": ["20210506_070809123_iOS.jpg", "20191231_235959000_iOS.heic", "20200101_000000999_iOS.png"],
+    "onedrive_not_ios": ["20210506_070809123_Android.jpg", "20191231_235959000_WP.jpg"],
+    "dropbox": ["2019-03-04 10.11.12.jpg", "2015-09-20 16.17.35.mov", "2020-02-29 23.59.59.png"],
+    "invalid_date": ["20211345_070809123_iOS.jpg", "2019-13-04 10.11.12.jpg"],
+    "unparsable": ["IMG_1234.JPG", "IMG_E5678.HEIC", "Screenshot.png", "holiday photo from the beach.jpg"]
+}
+
+# original_time, offset, subsecond
+DETAILS_CORPORA = {
+    "exif_offset": [("IMG_1234.JPG", "2021:05:06 07:08:09", "+02:00", "123"), ("IMG_1235.HEIC", "2019:12:31 23:59:59", "-05:00", "")],
+    "exif_no_offset": [("IMG_1234.JPG", "2021:05:06 07:08:09", "", "123"), ("IMG_1235.HEIC", "2019:12:31 23:59:59", "", "")],
+    "filename_onedrive": [("20210506_070809123_iOS.jpg", "", "", "")],
+    "filename_dropbox": [("2019-03-04 10.11.12.jpg", "", "", "")],
+    "original_name": [("IMG_1234.JPG", "", "", ""), ("Screenshot.png", "", "", "")]
+}
+
+EXTENSION_CORPUS = ["IMG_1234.JPG", "/Camera Roll/2021/05/20210506_070809123_iOS.heic", "video.MOV", "archive.tar.gz", "README"]
+
+
+#
+# Image files in memory: EXIF with and without offset, screenshots with and without eXIf, HEIC
+#
+def image_corpora():
+    generator = random.Random(1)
+    image = Image.frombytes("RGB", (64, 64), bytes(generator.getrandbits(8) for i in range(64 * 64 * 3)))
+
+    jpeg_template = io.BytesIO()
+    image.save(jpeg_template, format="JPEG", quality=90)
+    png_template = io.BytesIO()
+    image.save(png_template, format="PNG")
+
+    exif = Image.Exif()
+    exif[0x8769] = {0x9003: "2021:05:06 07:08:09", 0x9291: "123"}
+    png_exif = io.BytesIO()
+    image.save(png_exif, format="PNG", exif=exif)
+
+    taken = datetime.datetime(2021, 5, 6, 7, 8, 9)
+    padding = generator.randbytes(16)
+
+    return {
+        "jpeg_exif_offset": [("IMG_0001.JPG", make_jpeg(jpeg_template.getvalue(), taken, "123", "+02:00", padding))],
+        "jpeg_no_exif": [("IMG_0002.JPG", jpeg_template.getvalue())],
+        "heic_exif": [("IMG_0003.HEIC", make_heic(taken, "123", "+02:00", generator.randbytes(4096)))],
+        "png_exif": [("IMG_0004.png", png_exif.getvalue())],
+        "png_screenshot": [("20210506_070809123_iOS.png", make_png(png_template.getvalue(), padding))]
+    }
+
+
+############## Measurements ####################
+
+#
+# Time function over each input of the corpus. Returns the best and median time per call in microseconds
+# over repeat runs of number passes.
+#
+def measure(function, corpus, number, repeat):
+    def run():
+        for item in corpus:
+            function(item)
+
+    runs = timeit.Timer(run).repeat(repeat=repeat, number=number)
+    per_call = [seconds / (number * len(corpus)) * 1000000 for seconds in runs]
+
+    return {"best_us": round(min(per_call), 3), "median_us": round(statistics.median(per_call), 3)}
+
+
+def benchmarks(scratch_dir):
+    cases = dict()
+
+    for name, corpus in FILENAME_CORPORA.items():
+        cases["parse_filename_pattern." + name] = (parse_filename_pattern, corpus)
+
+    for name, corpus in DETAILS_CORPORA.items():
+        cases["new_file_details." + name] = (lambda item: new_file_details(*item), corpus)
+
+    cases["get_extension"] = (get_extension, EXTENSION_CORPUS)
+
+    for name, corpus in image_corpora().items():
+        cases["process_image." + name] = (lambda item: process_image(item[0], io.BytesIO(item[1])), corpus)
+
+    ## Videos are read from disk, as in the processor
+    video_files = []
+    for number, taken in enumerate([datetime.datetime(2015, 9, 20, 16, 17, 35), datetime.datetime(2021, 5, 6, 7, 8, 9)]):
+        video_file = os.path.join(scratch_dir, "IMG_" + str(number) + ".MOV")
+        with open(video_file, "wb") as output:
+            output.write(make_mov(taken, bytes(65536)))
+        video_files.append(video_file)
+
+    cases["video_filename.mov_file"] = (video_filename, video_files)
+    cases["video_filename.date_given"] = (lambda item: video_filename(item, datetime.datetime(2021, 5, 6, 7, 8, 9)), ["IMG_0001.MOV"])
+
+    return cases
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def previous_results(results_file):
+    if(os.path.exists(results_file) == False):
+        return None
+
+    with open(results_file) as results:
+        lines = [line for line in results if line.strip() != ""]
+
+    return json.loads(lines[-1]) if len(lines) > 0 else None
+
+
+#
+# Run all the benchmarks (or those with names containing name_filter), print them next to the previous run
+# and append the run to results_file.
+#
+def run_micro_benchmarks(number, repeat, results_file, name_filter=None, save=True):
+    scratch_dir = tempfile.mkdtemp(prefix="onedrive_bench_")
+
+    try:
+        results = dict()
+        for name, (function, corpus) in benchmarks(scratch_dir).items():
+            if(name_filter == None or name_filter in name):
+                results[name] = measure(function, corpus, number, repeat)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    run = {
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "number": number,
+        "repeat": repeat,
+        "results": results
+    }
+
+    previous = previous_results(results_file)
+    previous_values = previous["results"] if previous != None else dict()
+
+    print("%-44s %12s %12s %10s" % ("Benchmark", "best us", "median us", "change"))
+    for name, result in results.items():
+        change = ""
+        if(name in previous_values and previous_values[name]["best_us"] > 0):
+            change = "%+.1f%%" % ((result["best_us"] / previous_values[name]["best_us"] - 1) * 100)
+        print("%-44s %12.3f %12.3f %10s" % (name, result["best_us"], result["median_us"], change))
+
+    if(previous != None):
+        print("Compared with the run of %s (commit %s)" % (previous["time"], previous["commit"]))
+
+    if(save):
+        with open(results_file, "a") as results:
+            results.write(json.dumps(run) + "\n")
+
+    return run
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the naming and metadata functions.")
+    parser.add_argument("--number", type=int, default=200, help="Passes over each corpus per run")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each benchmark")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_FILE, help="JSON lines file with the results of each run")
+    parser.add_argument("--filter", default=None, help="Only the benchmarks with this text in the name")
+    parser.add_argument("--no-save", action="store_true", help="Do not append this run to the results file")
+    options = parser.parse_args()
+
+    run_micro_benchmarks(options.number, options.repeat, options.results, options.filter, options.no_save == False)
@@ -0,0 +1,852 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import hashlib
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from urllib.parse import quote, unquote, urlencode
+from urllib.error import HTTPError, URLError
+
+from rate_limiter import RateLimiter, OPERATION_READ, OPERATION_WRITE, OPERATION_TRANSFER
+from graph_batch import BatchQueue, MAX_BATCH_SIZE, BATCH_DELAY, completed_future
+from http_transport import HttpTransport
+
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+TOKEN_URL = "https://login.microsoftonline.com/common/oauth2/v2.0/token"
+TOKEN_SCOPE = "Files.ReadWrite.All offline_access"
+
+# Refresh the access token a bit before it really expires
+TOKEN_EXPIRY_MARGIN = 60
+
+# Files up to this size are uploaded with a single request, larger files use an upload session
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024
+
+# Upload session chunks must be a multiple of 320 KiB
+UPLOAD_CHUNK_SIZE = 32 * 320 * 1024
+
+UPLOAD_CHUNK_UNIT = 320 * 1024
+
+# Consecutive failures of an upload session chunk before giving up. The session is kept to resume later.
+MAX_CHUNK_FAILURES = 5
+
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Files larger than the threshold are downloaded as concurrent byte ranges
+PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+
+# Attempts for each range before the download fails
+MAX_RANGE_ATTEMPTS = 4
+
+# Same message as onedrive_simple_sdk, so conflicts are handled the same way for both
+UPLOAD_CONFLICT_MESSAGE = "File already exists. Solve conflict by changing upload policy from 'fail' to other."
+
+
+#
+# Result of an item details request, from the status code and the JSON body of the response
+#
+def item_details_response(code, item):
+    if(code != 200):
+        return {"status": False, "code": code, "message": response_message(item)}
+
+    hashes = item.get("file", {}).get("hashes", {})
+
+    return {
+        "status": True,
+        "id": item["id"],
+        "name": item["name"],
+        "size": item.get("size", 0),
+        "etag": item.get("eTag", ""),
+        "sha256hash": hashes.get("sha256Hash", ""),
+        "downloadurl": item.get("@microsoft.graph.downloadUrl", ""),
+        "childcount": item["folder"].get("childCount", 0) if "folder" in item else None
+    }
+
+
+def item_path_response(code, item):
+    if(code != 200):
+        return {"status": False, "code": code, "message": response_message(item)}
+
+    parent_path = unquote(item["parentReference"].get("path", "").split("root:", 1)[-1])
+
+    return {"status": True, "path": parent_path + "/" + item["name"]}
+
+
+def delete_response(code, body):
+    if(code == 204 or code == 200):
+        return {"status": True, "message": "Item deleted"}
+
+    return {"status": False, "code": code, "message": response_message(body)}
+
+
+def response_message(body):
+    if(isinstance(body, bytes)):
+        return body.decode("utf-8", "replace")
+
+    return body if isinstance(body, str) else json.dumps(body)
+
+
+#
+# Client for one OneDrive account, calling Microsoft Graph directly.
+# The Graph requests made here go through the rate limiter of the account, and are retried when throttled.
+# All methods return a dictionary with "status" and "message", the same way as the SDK.
+#
+class OneDriveClient:
+
+    def __init__(self, client_id, client_secret, refresh_token, timeout=60, rate_limiter=None, account=None, token_store=None, transport=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_token = refresh_token
+        self.credentials_refresh_token = refresh_token
+        self.timeout = timeout
+
+        # Access tokens kept between runs (e.g. TokenStore)
+        self.token_store = token_store
+
+        # Clients of the same account should share the limiter and account name
+        self.rate_limiter = rate_limiter if rate_limiter != None else RateLimiter()
+        self.account = account if account != None else client_id
+
+        # Pooled HTTP connections. All the clients should share the same transport.
+        self.transport = transport if transport != None else HttpTransport()
+
+        # Large file uploads. See set_upload_options().
+        self.upload_threshold = SIMPLE_UPLOAD_LIMIT
+        self.upload_chunk_size = UPLOAD_CHUNK_SIZE
+        self.session_store = None
+
+        # Large file downloads. See set_download_options().
+        self.download_threshold = PARALLEL_DOWNLOAD_THRESHOLD
+        self.download_range_size = DOWNLOAD_RANGE_SIZE
+        self.download_workers = DOWNLOAD_WORKERS
+
+        self.access_token = None
+        self.token_expiry = 0
+        self.token_lock = threading.Lock()
+
+        self.cached_drive_id = None
+
+        # Deletes and item details sent together as Graph JSON batches. See set_batch_options().
+        self.batch_queue = BatchQueue(self.batch)
+
+
+    #
+    # Files larger than threshold are uploaded in chunks of chunk_size (rounded to a multiple of 320 KiB).
+    # When a session_store is given (e.g. StateStore), upload sessions are saved so they can be resumed after a restart.
+    #
+    def set_upload_options(self, threshold=SIMPLE_UPLOAD_LIMIT, chunk_size=UPLOAD_CHUNK_SIZE, session_store=None):
+        self.upload_threshold = min(threshold, SIMPLE_UPLOAD_LIMIT)
+        self.upload_chunk_size = max(UPLOAD_CHUNK_UNIT, chunk_size - chunk_size % UPLOAD_CHUNK_UNIT)
+        self.session_store = session_store
+
+
+    #
+    # Files larger than threshold are downloaded in ranges of range_size, with up to workers ranges at a time.
+    # Less than 2 workers disables the parallel download.
+    #
+    def set_download_options(self, threshold=PARALLEL_DOWNLOAD_THRESHOLD, range_size=DOWNLOAD_RANGE_SIZE, workers=DOWNLOAD_WORKERS):
+        self.download_threshold = threshold
+        self.download_range_size = max(STREAM_CHUNK_SIZE, range_size)
+        self.download_workers = workers
+
+
+    #
+    # Up to max_size requests (maximum 20) are sent in each batch, waiting at most max_delay seconds for the others.
+    # max_size 1 sends each request on its own.
+    #
+    def set_batch_options(self, max_size=MAX_BATCH_SIZE, max_delay=BATCH_DELAY):
+        self.batch_queue = BatchQueue(self.batch, max_size, max_delay) if max_size > 1 else None
+
+
+    def token_key(self):
+        return str(self.account) + ":" + self.client_id
+
+
+    def get_access_token(self):
+        with self.token_lock:
+            if(self.access_token != None and time.time() < self.token_expiry - TOKEN_EXPIRY_MARGIN):
+                return self.access_token
+
+            ## Token of a previous run, while still valid
+            if(self.access_token == None and self.token_store != None):
+                saved = self.token_store.get(self.token_key(), self.credentials_refresh_token)
+
+                if(saved != None):
+                    self.refresh_token = saved["refresh_token"]
+
+                    if(time.time() < saved["expiry"] - TOKEN_EXPIRY_MARGIN):
+                        self.access_token = saved["access_token"]
+                        self.token_expiry = saved["expiry"]
+                        logging.debug("get_access_token(): Using the saved access token of %s", self.account)
+                        return self.access_token
+
+            try:
+                token = self.exchange_refresh_token(self.refresh_token)
+            except HTTPError:
+                if(self.refresh_token == self.credentials_refresh_token):
+                    raise
+
+                # The saved refresh token was revoked. Try the one of the credentials file.
+                logging.warning("get_access_token(): Saved refresh token rejected. Using the one of the credentials of %s", self.account)
+                self.refresh_token = self.credentials_refresh_token
+                token = self.exchange_refresh_token(self.refresh_token)
+
+            self.access_token = token["access_token"]
+            self.token_expiry = time.time() + int(token.get("expires_in", 3600))
+
+            # Refresh tokens are rotated on every exchange
+            if("refresh_token" in token):
+                self.refresh_token = token["refresh_token"]
+
+            if(self.token_store != None):
+                self.token_store.set(self.token_key(), self.credentials_refresh_token, self.access_token, self.token_expiry, self.refresh_token)
+
+            return self.access_token
+
+
+    def exchange_refresh_token(self, refresh_token):
+        data = urlencode({
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "refresh_token": refresh_token,
+            "grant_type": "refresh_token",
+            "scope": TOKEN_SCOPE
+        }).encode("utf-8")
+
+        response = self.transport.open("POST", TOKEN_URL, data, {"Content-Type": "application/x-www-form-urlencoded"}, self.timeout)
+        return json.loads(response.read())
+
+
+    #
+    # Open an HTTP request and return the response to be read by the caller.
+    # The Graph access token is only sent when authenticated is True,
+    # as pre-authenticated download and upload URLs do not accept it.
+    #
+    def http_open(self, method, url, body=None, headers=None, authenticated=True):
+        request_headers = dict(headers or {})
+
+        if(authenticated):
+            request_headers["Authorization"] = "Bearer " + self.get_access_token()
+
+        return self.transport.open(method, url, body, request_headers, self.timeout)
+
+
+    #
+    # Run a request within the limits of the account for the operation type, retrying while throttled
+    #
+    def limited(self, operation, request):
+        return self.rate_limiter.limiter(self.account, operation).call(request)
+
+
+    #
+    # Execute an HTTP request.
+    # Returns a tuple (status code, headers, body). HTTP errors are returned, not raised.
+    #
+    def http_request(self, method, url, body=None, headers=None, authenticated=True, operation=None):
+        if(operation == None):
+            operation = OPERATION_READ if method == "GET" else OPERATION_WRITE
+
+        def request():
+            try:
+                response = self.http_open(method, url, body, headers, authenticated)
+                return response.status, response.headers, response.read()
+            except HTTPError as ex:
+                return ex.code, ex.headers, ex.read()
+
+        return self.limited(operation, request)
+
+
+    def graph_request(self, method, resource, body=None, headers=None, operation=None):
+        return self.http_request(method, GRAPH_URL + resource, body, headers, operation=operation)
+
+
+    def item_resource(self, onedrive_path):
+        if(onedrive_path == "" or onedrive_path == "/"):
+            return "/me/drive/root"
+        return "/me/drive/root:" + quote(onedrive_path) + ":"
+
+
+    #
+    # Item details, including the size, hash and the pre-authenticated download URL
+    #
+    def item_details(self, onedrive_path):
+        try:
+            code, headers, body = self.graph_request("GET", self.item_resource(onedrive_path))
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        if(code != 200):
+            return item_details_response(code, body)
+
+        return item_details_response(code, json.loads(body))
+
+
+    #
+    # Same result as onedrive_simple_sdk.filedetails(), through the rate limiter
+    #
+    def filedetails(self, onedrive_path):
+        return self.item_details(onedrive_path)
+
+
+    #
+    # Same result as onedrive_simple_sdk.listfiles(), through the rate limiter
+    #
+    def listfiles(self, onedrive_folder):
+        result = self.list_children(onedrive_folder)
+
+        if(result["status"] and result["exists"] == False):
+            return {"status": False, "code": 404, "message": "Folder not found: " + onedrive_folder}
+
+        return result
+
+
+    #
+    # Same result as onedrive_simple_sdk.delete(), through the rate limiter
+    #
+    def delete(self, onedrive_path):
+        try:
+            code, headers, body = self.graph_request("DELETE", self.item_resource(onedrive_path))
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        return delete_response(code, body)
+
+
+    #
+    # Send requests ({"id", "method", "url"}, url relative to the Graph version) as one JSON batch.
+    # Returns the responses of the requests ({"id", "status", "headers", "body"}), in any order.
+    #
+    def batch(self, requests):
+        try:
+            code, headers, body = self.graph_request("POST", "/$batch", json.dumps({"requests": requests}).encode("utf-8"),
+                                                     {"Content-Type": "application/json"})
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        if(code != 200):
+            return {"status": False, "code": code, "message": body.decode("utf-8", "replace")}
+
+        return {"status": True, "responses": json.loads(body)["responses"]}
+
+
+    #
+    # Queue the delete in the next batch. Returns a future with the same result as delete().
+    #
+    def delete_later(self, onedrive_path):
+        if(self.batch_queue == None):
+            return completed_future(self.delete(onedrive_path))
+
+        return self.batch_queue.submit("DELETE", self.item_resource(onedrive_path), delete_response)
+
+
+    #
+    # Queue the item details request in the next batch. Returns a future with the same result as item_details().
+    #
+    def item_details_later(self, onedrive_path):
+        if(self.batch_queue == None):
+            return completed_future(self.item_details(onedrive_path))
+
+        return self.batch_queue.submit("GET", self.item_resource(onedrive_path), item_details_response)
+
+
+    #
+    # Send the queued requests and wait for their results
+    #
+    def flush_batches(self):
+        if(self.batch_queue != None):
+            self.batch_queue.flush()
+
+
+    #
+    # Download the bytes [start, end] (inclusive) of the file behind a download URL
+    #
+    def download_range(self, download_url, start, end):
+        headers = {"Range": "bytes=" + str(start) + "-" + str(end)}
+
+        try:
+            code, headers, body = self.http_request("GET", download_url, headers=headers, authenticated=False, operation=OPERATION_TRANSFER)
+        except (OSError, http.client.HTTPException) as ex:
+            # URLError when connecting, or the connection failing while the body is read (reset, timeout, incomplete read)
+            return {"status": False, "message": str(ex) or type(ex).__name__}
+
+        # 200 means the server ignored the range and sent the whole file
+        if(code == 206 or code == 200):
+            return {"status": True, "data": body}
+
+        return {"status": False, "code": code, "message": "Error downloading range. HTTP " + str(code)}
+
+
+    #
+    # Download the file behind a download URL into a file-like object, in chunks.
+    # The SHA-256 is calculated in the same pass, so the file never needs to be read again.
+    # When the size is known and above the threshold, the file is downloaded in parallel ranges.
+    #
+    def download_to(self, download_url, fileobj, size=None):
+        if(size != None and size > self.download_threshold and self.download_workers > 1):
+            return self.download_parallel(download_url, fileobj, size)
+
+
+        def request():
+            size = 0
+            file_hash = hashlib.sha256()
+
+            try:
+                response = self.http_open("GET", download_url, authenticated=False)
+            except HTTPError as ex:
+                return ex.code, ex.headers, {"status": False, "code": ex.code, "message": "Error downloading file. HTTP " + str(ex.code)}
+
+            while chunk := response.read(STREAM_CHUNK_SIZE):
+                fileobj.write(chunk)
+                file_hash.update(chunk)
+                size = size + len(chunk)
+
+            return response.status, response.headers, {"status": True, "size": size, "sha256hash": file_hash.hexdigest().upper()}
+
+        try:
+            code, headers, result = self.limited(OPERATION_TRANSFER, request)
+        except (OSError, http.client.HTTPException) as ex:
+            return {"status": False, "message": str(ex) or type(ex).__name__}
+
+        return result
+
+
+    #
+    # Download one range, retrying on its own when it fails or comes back incomplete
+    #
+    def download_range_retry(self, download_url, start, end):
+        for attempt in range(MAX_RANGE_ATTEMPTS):
+            result = self.download_range(download_url, start, end)
+
+            if(result["status"] and len(result["data"]) == end - start + 1):
+                return result
+
+            if(result["status"]):
+                result = {"status": False, "message": "Incomplete range. Received " + str(len(result["data"])) + " bytes."}
+
+            logging.warning("download_range_retry(): Error downloading bytes %d-%d (attempt %d): %s", start, end, attempt + 1, result["message"])
+
+            if(attempt + 1 < MAX_RANGE_ATTEMPTS):
+                time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+
+        return result
+
+
+    #
+    # Download a large file as concurrent byte ranges.
+    # Each range is written to its place in the file as soon as it arrives. The file is preallocated to the final size.
+    # The hash is calculated in order, so only a window of ranges ahead of it are downloaded at a time (bounded memory).
+    #
+    def download_parallel(self, download_url, fileobj, size):
+        ranges = [(start, min(start + self.download_range_size, size) - 1) for start in range(0, size, self.download_range_size)]
+        window = 2 * self.download_workers
+
+        file_hash = hashlib.sha256()
+        downloaded = 0
+        write_lock = threading.Lock()
+
+        fileobj.seek(0)
+        fileobj.truncate(size)
+
+        def fetch(start, end):
+            result = self.download_range_retry(download_url, start, end)
+
+            if(result["status"]):
+                with write_lock:
+                    fileobj.seek(start)
+                    fileobj.write(result["data"])
+
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.download_workers, thread_name_prefix="range") as executor:
+            pending = []
+            next_range = 0
+
+            while(next_range < len(ranges) or len(pending) > 0):
+                while(next_range < len(ranges) and len(pending) < window):
+                    pending.append(executor.submit(fetch, *ranges[next_range]))
+                    next_range = next_range + 1
+
+                result = pending.pop(0).result()
+
+                if(result["status"] == False):
+                    for future in pending:
+                        future.cancel()
+                    return {"status": False, "message": "Error downloading file. " + result["message"]}
+
+                file_hash.update(result["data"])
+                downloaded = downloaded + len(result["data"])
+
+        fileobj.seek(size)
+        logging.debug("download_parallel(): Downloaded %d bytes in %d ranges.", downloaded, len(ranges))
+
+        return {"status": True, "size": downloaded, "sha256hash": file_hash.hexdigest().upper()}
+
+
+    #
+    # Upload the content of a file-like object to onedrive_folder/filename.
+    # The upload fails when the file already exists.
+    # session_key identifies the upload (e.g. source item and destination) so an interrupted upload session can be resumed.
+    #
+    def upload_from(self, fileobj, size, onedrive_folder, filename, session_key=None):
+        resource = self.item_resource(onedrive_folder + "/" + filename)
+
+        try:
+            if(size <= self.upload_threshold):
+                code, headers, body = self.graph_request("PUT", resource + "/content?@microsoft.graph.conflictBehavior=fail",
+                                                         fileobj.read(), {"Content-Type": "application/octet-stream"}, OPERATION_TRANSFER)
+            else:
+                code, body = self.upload_session(fileobj, size, resource, session_key)
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        if(code == 200 or code == 201):
+            return {"status": True, "message": "File uploaded"}
+
+        if(code == 409):
+            return {"status": False, "code": code, "message": UPLOAD_CONFLICT_MESSAGE}
+
+        return {"status": False, "code": code, "message": body.decode("utf-8", "replace")}
+
+
+    #
+    # Offset of the next byte expected by an upload session. None when the session no longer exists.
+    #
+    def upload_session_offset(self, upload_url):
+        try:
+            code, headers, body = self.http_request("GET", upload_url, authenticated=False)
+        except (OSError, http.client.HTTPException):
+            return None
+
+        if(code != 200):
+            return None
+
+        ranges = json.loads(body).get("nextExpectedRanges", [])
+
+        if(len(ranges) == 0):
+            return None
+
+        return int(ranges[0].split("-")[0])
+
+
+    def saved_upload_session(self, session_key, size):
+        if(self.session_store == None or session_key == None):
+            return None, 0
+
+        saved = self.session_store.get_upload_session(session_key)
+
+        if(saved == None or saved["size"] != size):
+            return None, 0
+
+        offset = self.upload_session_offset(saved["url"])
+
+        if(offset == None):
+            # Expired or completed
+            self.session_store.clear_upload_session(session_key)
+            return None, 0
+
+        logging.info("upload_session(): Resuming upload at %d of %d bytes.", offset, size)
+        return saved["url"], offset
+
+
+    #
+    # Upload a large file in chunks through an upload session.
+    # Each chunk is retried on its own, resuming from the offset the server expects next.
+    # The next chunk is read from the file while the current one is sent.
+    # Returns the status code and body of the last request.
+    #
+    def upload_session(self, fileobj, size, resource, session_key=None):
+        upload_url, offset = self.saved_upload_session(session_key, size)
+
+        if(upload_url == None):
+            session_body = json.dumps({"item": {"@microsoft.graph.conflictBehavior": "fail"}}).encode("utf-8")
+            code, headers, body = self.graph_request("POST", resource + "/createUploadSession", session_body, {"Content-Type": "application/json"})
+
+            if(code != 200):
+                return code, body
+
+            upload_url = json.loads(body)["uploadUrl"]
+
+            if(self.session_store != None and session_key != None):
+                self.session_store.set_upload_session(session_key, upload_url, size)
+
+        def read_chunk(chunk_offset):
+            fileobj.seek(chunk_offset)
+            return fileobj.read(self.upload_chunk_size)
+
+        failures = 0
+
+        # A single reader thread, so the file is never read concurrently
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            prefetch_offset = offset
+            prefetch = reader.submit(read_chunk, offset)
+
+            while(True):
+                if(prefetch_offset != offset):
+                    prefetch.result()
+                    prefetch = reader.submit(read_chunk, offset)
+
+                chunk = prefetch.result()
+                chunk_end = offset + len(chunk) - 1
+
+                # Read the next chunk while sending this one
+                prefetch_offset = chunk_end + 1
+                if(prefetch_offset < size):
+                    prefetch = reader.submit(read_chunk, prefetch_offset)
+                else:
+                    prefetch_offset = None
+
+                headers = {"Content-Range": "bytes " + str(offset) + "-" + str(chunk_end) + "/" + str(size)}
+
+                try:
+                    code, headers, body = self.http_request("PUT", upload_url, chunk, headers, authenticated=False, operation=OPERATION_TRANSFER)
+                except (OSError, http.client.HTTPException) as ex:
+                    # The chunk failed, also when the connection failed while the response was read. Resumed from the server offset.
+                    code, body = None, (str(ex) or type(ex).__name__).encode("utf-8")
+
+                if(code == 200 or code == 201):
+                    self.clear_upload_session(session_key)
+                    return code, body
+
+                if(code == 202):
+                    failures = 0
+                    ranges = json.loads(body).get("nextExpectedRanges", [])
+                    offset = int(ranges[0].split("-")[0]) if len(ranges) > 0 else chunk_end + 1
+                    continue
+
+                if(code == 409 or code == 404):
+                    # Name conflict, or the session expired. The session can't be used anymore.
+                    self.http_request("DELETE", upload_url, authenticated=False)
+                    self.clear_upload_session(session_key)
+                    return code, body
+
+                failures = failures + 1
+                if(failures > MAX_CHUNK_FAILURES):
+                    logging.error("upload_session(): Chunk failed %d times. Session kept to resume later.", failures)
+                    return (code if code != None else 0), body
+
+                logging.warning("upload_session(): Error sending chunk at %d (%s). Retrying.", offset, code)
+                time.sleep(random.uniform(0, min(60, 2 ** failures)))
+
+                # Continue from what the server really received
+                server_offset = self.upload_session_offset(upload_url)
+                if(server_offset == None):
+                    self.clear_upload_session(session_key)
+                    return (code if code != None else 0), body
+
+                offset = server_offset
+
+
+    def clear_upload_session(self, session_key):
+        if(self.session_store != None and session_key != None):
+            self.session_store.clear_upload_session(session_key)
+
+
+    #
+    # Id of the drive of this account. Used to find out when two clients point to the same drive.
+    #
+    def drive_id(self):
+        if(self.cached_drive_id == None):
+            try:
+                code, headers, body = self.graph_request("GET", "/me/drive")
+            except URLError as ex:
+                logging.error("drive_id(): %s", ex)
+                return None
+
+            if(code != 200):
+                return None
+
+            self.cached_drive_id = json.loads(body)["id"]
+
+        return self.cached_drive_id
+
+
+    #
+    # Create a folder, including the missing parent folders. An existing folder is not an error.
+    #
+    def create_folder(self, onedrive_folder):
+        parent, name = onedrive_folder.rstrip("/").rsplit("/", 1)
+
+        body = json.dumps({"name": name, "folder": {}, "@microsoft.graph.conflictBehavior": "fail"}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+
+        try:
+            code, response_headers, response_body = self.graph_request("POST", self.item_resource(parent) + "/children", body, headers)
+
+            if(code == 404):
+                result = self.create_folder(parent)
+                if(result["status"] == False):
+                    return result
+                code, response_headers, response_body = self.graph_request("POST", self.item_resource(parent) + "/children", body, headers)
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        if(code == 200 or code == 201 or code == 409):
+            return {"status": True, "message": "Folder available"}
+
+        return {"status": False, "code": code, "message": response_body.decode("utf-8", "replace")}
+
+
+    #
+    # Move an item to onedrive_folder/filename on the server, without transferring the content.
+    # The destination folder is created when missing. The move fails when the file already exists.
+    #
+    def move_item(self, item_id, onedrive_folder, filename):
+        resource = "/me/drive/items/" + item_id + "?@microsoft.graph.conflictBehavior=fail"
+        body = json.dumps({"parentReference": {"path": "/drive/root:" + onedrive_folder}, "name": filename}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+
+        try:
+            code, response_headers, response_body = self.graph_request("PATCH", resource, body, headers)
+
+            if(code == 400 or code == 404):
+                # Most likely the destination folder does not exist yet
+                result = self.create_folder(onedrive_folder)
+                if(result["status"] == False):
+                    return result
+                code, response_headers, response_body = self.graph_request("PATCH", resource, body, headers)
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        if(code == 200):
+            return {"status": True, "message": "File moved"}
+
+        if(code == 409):
+            return {"status": False, "code": code, "message": UPLOAD_CONFLICT_MESSAGE}
+
+        return {"status": False, "code": code, "message": response_body.decode("utf-8", "replace")}
+
+
+    #
+    # List the children of a folder with their size and hash.
+    # A folder that does not exist is returned as empty.
+    #
+    def list_children(self, onedrive_folder):
+        url = GRAPH_URL + self.item_resource(onedrive_folder) + "/children?$select=id,name,size,file,folder&$top=1000"
+        item_list = []
+
+        try:
+            while(url != None):
+                code, headers, body = self.http_request("GET", url)
+
+                if(code == 404):
+                    return {"status": True, "exists": False, "itemlist": []}
+
+                if(code != 200):
+                    return {"status": False, "code": code, "message": body.decode("utf-8", "replace")}
+
+                page = json.loads(body)
+
+                for item in page["value"]:
+                    item_list.append({
+                        "id": item["id"],
+                        "name": item["name"],
+                        "type": "folder" if "folder" in item else "file",
+                        "size": item.get("size", 0),
+                        "sha256hash": item.get("file", {}).get("hashes", {}).get("sha256Hash", "")
+                    })
+
+                url = page.get("@odata.nextLink")
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        return {"status": True, "exists": True, "itemlist": item_list}
+
+
+    #
+    # Changes in a folder (and below) since the delta link of the previous call.
+    # Without a delta link all the items are returned, and with latest=True only a new delta link.
+    # An expired delta link returns "expired" True, meaning a full scan is needed.
+    #
+    def delta(self, onedrive_folder, delta_link=None, latest=False):
+        if(delta_link != None):
+            url = delta_link
+        elif(latest):
+            url = GRAPH_URL + self.item_resource(onedrive_folder) + "/delta?token=latest"
+        else:
+            url = GRAPH_URL + self.item_resource(onedrive_folder) + "/delta"
+
+        item_list = []
+
+        try:
+            while(True):
+                code, headers, body = self.http_request("GET", url)
+
+                if(code == 410):
+                    return {"status": False, "code": code, "expired": True, "message": "Delta link expired"}
+
+                if(code != 200):
+                    return {"status": False, "code": code, "expired": False, "message": body.decode("utf-8", "replace")}
+
+                page = json.loads(body)
+
+                for item in page["value"]:
+                    item_list.append({
+                        "id": item["id"],
+                        "name": item.get("name", ""),
+                        "type": "folder" if "folder" in item else "file",
+                        "deleted": "deleted" in item
+                    })
+
+                if("@odata.nextLink" in page):
+                    url = page["@odata.nextLink"]
+                else:
+                    return {"status": True, "itemlist": item_list, "deltalink": page["@odata.deltaLink"]}
+
+        except URLError as ex:
+            return {"status": False, "expired": False, "message": str(ex)}
+
+
+    #
+    # Path of an item, from its id. Delta responses do not include the item paths.
+    #
+    def item_path(self, item_id):
+        try:
+            code, headers, body = self.graph_request("GET", self.item_path_resource(item_id))
+        except URLError as ex:
+            return {"status": False, "message": str(ex)}
+
+        return item_path_response(code, json.loads(body) if code == 200 else body)
+
+
+    def item_path_resource(self, item_id):
+        return "/me/drive/items/" + item_id + "?$select=name,parentReference"
+
+
+    #
+    # Queue the path request in the next batch. Returns a future with the same result as item_path().
+    #
+    def item_path_later(self, item_id):
+        if(self.batch_queue == None):
+            return completed_future(self.item_path(item_id))
+
+        return self.batch_queue.submit("GET", self.item_path_resource(item_id), item_path_response)
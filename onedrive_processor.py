@@ -28,12 +28,29 @@ import time
 import json
 import datetime
 import logging
-import hashlib
-
-from onedrive import onedrive_simple_sdk
-from image_processing import process_image
+import shutil
+import tempfile
+import io
+import struct
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from onedrive_graph import OneDriveClient, UPLOAD_CONFLICT_MESSAGE, SIMPLE_UPLOAD_LIMIT, UPLOAD_CHUNK_SIZE
+from onedrive_graph import PARALLEL_DOWNLOAD_THRESHOLD, DOWNLOAD_RANGE_SIZE, DOWNLOAD_WORKERS
+from rate_limiter import RateLimiter
+from graph_batch import MAX_BATCH_SIZE, BATCH_DELAY
+from image_processing import process_image, jpeg_exif_length
 from datetime import timezone
-from video_processing import video_creation_datetime
+from video_processing import video_creation_datetime, mp4_creation_datetime
+from state_store import StateStore, STAGE_DOWNLOADED, STAGE_NAMED, STAGE_UPLOADED, STAGE_DELETED
+from destination_index import DestinationIndex, FILE_NEW, FILE_DUPLICATE, FILE_CONFLICT
+from metrics import Metrics, STAGE_LIST, STAGE_DOWNLOAD, STAGE_METADATA, STAGE_NAMING, STAGE_CONFLICT_CHECK, STAGE_UPLOAD, STAGE_DELETE
+from manifest import ManifestWriter, read_manifest
+from folder_cleanup import FolderCleanup
+from config_cache import ConfigCache, TokenStore, CONFIG_TIMEOUT, DEFAULT_CACHE_FOLDER
+from watcher import Watcher, DEFAULT_POLL_INTERVAL
+from http_transport import HttpTransport, MAX_CONNECTIONS_PER_HOST, IDLE_TIMEOUT, POOL_TIMEOUT
 from urllib.request import urlopen
 
 
@@ -44,6 +61,54 @@ class PhotoInfo:
     year = ""
     status = ""
 
+
+# Processing state of the origin items. Set by mainProcessor() when "state_file" is configured.
+state_store = None
+
+# Cache of the destination folders. Set by mainProcessor().
+destination_index = None
+
+# Local copies of the configuration and credentials, and access tokens kept between runs. Set by mainProcessor().
+config_cache = None
+token_store = None
+
+# Pooled HTTP connections shared by all the clients. Set by mainProcessor().
+http_transport = None
+
+# Cycles of the watch mode. Set by mainProcessor().
+watcher = None
+
+# Counters and timings of the processing stages, labelled by origin and media type
+metrics = Metrics()
+
+# Folder cleanup of the file processed by each worker thread. Set by track_file().
+processing = threading.local()
+
+# Attempts to send a file when the destination keeps changing under us
+MAX_CONFLICT_ATTEMPTS = 3
+
+# Outcome of processing a file, counted in the summary of each origin
+RESULT_UPLOADED = "uploaded"
+RESULT_MOVED = "moved"
+RESULT_DUPLICATE = "duplicate"
+RESULT_RESUMED = "resumed"
+RESULT_SKIPPED = "skipped"
+RESULT_ERROR = "error"
+
+# Run modes: process the files, only plan the run in a manifest (dry run), apply a manifest, or keep processing the new files
+MODE_RUN = "run"
+MODE_PLAN = "plan"
+MODE_EXECUTE = "execute"
+MODE_WATCH = "watch"
+
+# Planned action of each manifest entry
+ACTION_UPLOAD = "upload"
+ACTION_MOVE = "move"
+ACTION_DELETE_DUPLICATE = "delete-duplicate"
+ACTION_REMOVE_FOLDER = "remove-folder"
+ACTION_SKIP = "skip"
+ACTION_ERROR = "error"
+
 ############ Functions ################
 
 def get_extension(filename):
@@ -52,25 +117,32 @@ def get_extension(filename):
     return ext.lower()
 
 def read_configuration(base_url):
-    response = urlopen(base_url + "/config.json")
-    data = json.load(response)
-    return data
+    return read_json(base_url + "/config.json")
 
 
 def read_credentials(base_url, filename):
-    response = urlopen(base_url + "/" + filename)
+    return read_json(base_url + "/" + filename)
+
+
+def read_json(url):
+    if(config_cache != None):
+        return config_cache.read_json(url)
+
+    response = urlopen(url, timeout=CONFIG_TIMEOUT)
     data = json.load(response)
     return data
 
 
 
 #
-# Compare file in Onedrive with local file using HASH256 and SIZE
+# Compare file in Onedrive with a local file using HASH256 and SIZE.
+# The local hash and size are calculated during the download, so the local file is not read again.
 #
-def compare_files(onedrive_client, onedrive_path, local_file):
+def compare_files(onedrive_client, onedrive_path, local_file_hash, local_file_size):
  ## Connecting to the origin
    
-    result = onedrive_client.filedetails(onedrive_path)
+    # Queued with the lookups of the other workers, sent as one batch
+    result = onedrive_client.item_details_later(onedrive_path).result()
 
     if(result["status"] == False):
         return {
@@ -80,30 +152,6 @@ def compare_files(onedrive_client, onedrive_path, local_file):
 
     od_file_hash = result["sha256hash"].upper()
     od_file_size = result["size"]
-    
-    
-    try:
-
-        # Hash calculation in chuncks, as large files will exceed memory limits in small instances.
-        with open(local_file, "rb") as f:
-            file_hash = hashlib.sha256()
-            while chunk := f.read(8192):
-                file_hash.update(chunk)
-            local_file_hash = file_hash.hexdigest().upper()
-
-        stat = os.stat(local_file)
-        local_file_size = stat.st_size
-    except FileNotFoundError as ex:
-        return {
-            "status": False,
-            "message": "Local file not found."
-        }
-    except:
-        logging.error("compare_files() %s", sys.exc_info()[0])
-        return {
-            "status": False,
-            "message": sys.exc_info()[0]
-        }
 
     ### Compare the Files
 
@@ -111,7 +159,7 @@ def compare_files(onedrive_client, onedrive_path, local_file):
     size_comparison = False
 
     ## Hash comparison
-    if(local_file_hash == od_file_hash):
+    if(local_file_hash.upper() == od_file_hash):
         hash_comparison = True
     
     if(local_file_size == od_file_size):
@@ -133,6 +181,265 @@ def compare_files(onedrive_client, onedrive_path, local_file):
 
 
 
+#
+# Compare file in Onedrive with the details of another Onedrive file (e.g. the source) using HASH256 and SIZE
+# Used to detect duplicates before downloading the source file.
+#
+def is_remote_duplicate(onedrive_client, onedrive_path, source_details):
+    if(source_details["sha256hash"] == ""):
+        return False
+
+    result = onedrive_client.item_details_later(onedrive_path).result()
+
+    if(result["status"] == False):
+        return False
+
+    return result["sha256hash"].upper() == source_details["sha256hash"].upper() and result["size"] == source_details["size"]
+
+
+
+#
+# The watch mode is stopping: the files in progress are finished, and no new file is started
+#
+def stop_requested():
+    return watcher != None and watcher.stopping()
+
+
+#
+# Record the processing stage of a source file, when the state store is enabled
+#
+def record_stage(source_file, source_details, stage, destination=None, status=None):
+    if(state_store != None):
+        state_store.update(source_file, source_details, stage, destination, status)
+
+
+#
+# Find the state of the source file from previous runs.
+# Files already uploaded are only deleted from the source, after confirming the destination has them.
+# Returns the record (or None) and True when there is nothing else to do.
+#
+def resume_from_state(onedrive_origin_client, source_file, source_details, onedrive_destination_client):
+    if(state_store == None):
+        return None, False
+
+    record = state_store.get(source_details)
+
+    if(record != None and (record["stage"] == STAGE_UPLOADED or record["stage"] == STAGE_DELETED)):
+        if(is_remote_duplicate(onedrive_destination_client, record["destination"], source_details)):
+            logging.info("resume_from_state(): File uploaded in a previous run. Delete from the source: %s", source_file)
+            delete_source(onedrive_origin_client, source_file, source_details)
+            return record, True
+
+    if(record != None):
+        logging.debug("resume_from_state(): Resuming file at stage '%s': %s", record["stage"], source_file)
+
+    return record, False
+
+
+#
+# Deletes are queued and sent in batches. The outcome of each file is recorded when its batch completes,
+# so a failed delete only leaves that source file in place. Returns the future of the delete.
+#
+def delete_source(onedrive_origin_client, source_file, source_details):
+    labels = dict(metrics.labels())
+    cleanup = getattr(processing, "cleanup", None)
+    time_before = time.perf_counter()
+
+    future = onedrive_origin_client.delete_later(source_file)
+    future.add_done_callback(lambda done: source_deleted(source_file, source_details, done.result(), time.perf_counter() - time_before, labels, cleanup))
+
+    return future
+
+
+# Runs in the thread sending the batch, so the metric labels and folder cleanup of the file are given
+def source_deleted(source_file, source_details, result, seconds, labels, cleanup):
+    metrics.observe("stage_seconds", seconds, stage=STAGE_DELETE, **labels)
+
+    if(result["status"]):
+        record_stage(source_file, source_details, STAGE_DELETED)
+
+        if(cleanup != None):
+            cleanup.removed(source_file)
+    else:
+        metrics.increment("stage_errors_total", stage=STAGE_DELETE, **labels)
+        logging.error("delete_source(): Error deleting the source file %s: %s", source_file, result.get("message"))
+
+        # The delete may have failed after removing the file (e.g. timeout), so the folder is checked
+        if(cleanup != None):
+            cleanup.mark_uncertain(source_file)
+
+
+#
+# Check the new name against the destination folder, before sending any bytes.
+# Returns FILE_NEW, FILE_DUPLICATE or FILE_CONFLICT.
+#
+def destination_status(onedrive_destination_client, full_upload_path, new_filename, source_details):
+    if(destination_index != None):
+        status = destination_index.check(full_upload_path, new_filename, source_details["size"], source_details["sha256hash"])
+
+        if(status != None):
+            return status
+
+    # No index available for this file. Ask the destination for this file only.
+    if(is_remote_duplicate(onedrive_destination_client, full_upload_path + "/" + new_filename, source_details)):
+        return FILE_DUPLICATE
+
+    return FILE_NEW
+
+
+def index_add(full_upload_path, new_filename, source_details):
+    if(destination_index != None):
+        destination_index.add(full_upload_path, new_filename, source_details["size"], source_details["sha256hash"])
+
+
+def index_invalidate(full_upload_path):
+    if(destination_index != None):
+        destination_index.invalidate(full_upload_path)
+
+
+#
+# Origin and destination in the same OneDrive drive allow server side moves, with no transfer of the content
+#
+def is_same_account(onedrive_origin_client, onedrive_destination_client, config):
+    if(config.get("server_side_move", True) == False):
+        return False
+
+    origin_drive = onedrive_origin_client.drive_id()
+
+    return origin_drive != None and origin_drive == onedrive_destination_client.drive_id()
+
+
+#
+# Find the first free name in the destination folder: the name itself, or name_1, name_2, ...
+# Uses a single listing of the folder. When one of the names already holds the same file, it is returned as duplicate.
+#
+def next_free_filename(onedrive_destination_client, full_upload_path, new_filename, source_details):
+    if(destination_index != None):
+        files = destination_index.folder(full_upload_path)
+    else:
+        result = onedrive_destination_client.list_children(full_upload_path)
+        files = None
+        if(result["status"]):
+            files = dict()
+            for item in result["itemlist"]:
+                files[item["name"].lower()] = item
+
+    if(files == None):
+        return {"status": False, "message": "Error listing destination folder " + full_upload_path}
+
+    filename_no_ext, file_ext = os.path.splitext(new_filename)
+    candidate = new_filename
+    sequence = 0
+
+    while(True):
+        existing = files.get(candidate.lower())
+
+        if(existing == None):
+            return {"status": True, "duplicate": False, "filename": candidate}
+
+        if(existing["size"] == source_details["size"]):
+            if(existing["sha256hash"] != "" and existing["sha256hash"].upper() == source_details["sha256hash"].upper()):
+                return {"status": True, "duplicate": True, "filename": candidate}
+
+            # No hash in the listing. Compare with the hash calculated on download.
+            if(existing["sha256hash"] == "" and "localhash" in source_details):
+                result = compare_files(onedrive_destination_client, full_upload_path + "/" + candidate, source_details["localhash"], source_details["localsize"])
+                if(result["status"] and result["comparison"]):
+                    return {"status": True, "duplicate": True, "filename": candidate}
+
+        sequence = sequence + 1
+        candidate = filename_no_ext + "_" + str(sequence) + file_ext
+
+
+#
+# Send the source file to full_upload_path/new_filename and delete it from the source.
+# Same drive: server side move. Otherwise the content is uploaded from fileobj, downloaded first when needed.
+# Name conflicts are solved by appending a sequence to the name, reusing the content already downloaded.
+#
+def transfer_file(onedrive_origin_client, source_file, source_details, onedrive_destination_client, full_upload_path, new_filename, config, fileobj, downloaded):
+    same_account = is_same_account(onedrive_origin_client, onedrive_destination_client, config)
+
+    for attempt in range(MAX_CONFLICT_ATTEMPTS):
+
+        ## Check the destination before sending any bytes
+        if(attempt == 0):
+            with metrics.stage(STAGE_CONFLICT_CHECK):
+                status = destination_status(onedrive_destination_client, full_upload_path, new_filename, source_details)
+        else:
+            # The previous attempt found the name taken
+            status = FILE_CONFLICT
+
+        if(status == FILE_CONFLICT):
+            with metrics.stage(STAGE_CONFLICT_CHECK):
+                resolved = next_free_filename(onedrive_destination_client, full_upload_path, new_filename, source_details)
+
+            if(resolved["status"] == False):
+                logging.error("transfer_file(): Original file to remain in place. %s", resolved["message"])
+                return RESULT_ERROR
+
+            if(resolved["duplicate"]):
+                new_filename = resolved["filename"]
+                status = FILE_DUPLICATE
+            else:
+                logging.info("transfer_file(): Name taken by a different file. Using: %s", resolved["filename"])
+                new_filename = resolved["filename"]
+                record_stage(source_file, source_details, STAGE_NAMED, full_upload_path + "/" + new_filename)
+
+        if(status == FILE_DUPLICATE):
+            logging.info("transfer_file(): File is repeated. Delete from the source. Maintain existing in target: %s", new_filename)
+            delete_source(onedrive_origin_client, source_file, source_details)
+            return RESULT_DUPLICATE
+
+        if(same_account):
+            with metrics.stage(STAGE_UPLOAD):
+                result = onedrive_origin_client.move_item(source_details["id"], full_upload_path, new_filename)
+
+        else:
+            if(downloaded == False):
+                ## Trigger the file download
+                result = download_source(onedrive_origin_client, source_details, fileobj)
+
+                if(result["status"] == False):
+                    logging.error("transfer_file(): Error on the download. Original file to remain in place. %s", result["message"])
+                    return RESULT_ERROR
+
+                downloaded = True
+
+            # Large files are resumed from the same upload session when the upload is retried
+            session_key = source_details["id"] + ":" + full_upload_path + "/" + new_filename
+
+            fileobj.seek(0)
+            with metrics.stage(STAGE_UPLOAD):
+                result = onedrive_destination_client.upload_from(fileobj, source_details["size"], full_upload_path, new_filename, session_key)
+
+            if(result["status"]):
+                metrics.increment("bytes_total", source_details["size"], direction="upload")
+
+        if(result["status"]):
+            index_add(full_upload_path, new_filename, source_details)
+
+            if(same_account):
+                # The item is no longer in the origin
+                record_stage(source_file, source_details, STAGE_DELETED)
+                logging.debug("transfer_file(): File moved successfuly: %s", new_filename)
+                return RESULT_MOVED
+
+            record_stage(source_file, source_details, STAGE_UPLOADED)
+            delete_source(onedrive_origin_client, source_file, source_details)
+            logging.debug("transfer_file(): File uploaded successfuly: %s", new_filename)
+            return RESULT_UPLOADED
+
+        if(result["message"] != UPLOAD_CONFLICT_MESSAGE):
+            logging.error("transfer_file(): Error on the upload. Original file to remain in place. %s", result["message"])
+            return RESULT_ERROR
+
+        # The destination changed since it was indexed
+        index_invalidate(full_upload_path)
+
+    logging.error("transfer_file(): No free name found after %d attempts. Original file to remain in place: %s", MAX_CONFLICT_ATTEMPTS, source_file)
+    return RESULT_ERROR
+
+
 #
 # Parse the filname to determine the pattern type
 # This function is only used when the file metadata does not contain a date/time
@@ -289,27 +596,191 @@ def new_file_details(original_filename, original_time, offset, subsecond):
     return photo_info
 
 
-def process_image_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, sequence=0):
+#
+# Read the image EXIF data from the first bytes of the file, without downloading it.
+# The range grows until the EXIF block is complete, up to the configured limit.
+# Returns image_data as process_image() or None when the full file is needed.
+#
+def read_image_metadata_range(onedrive_origin_client, source_file, source_details, config):
+    filename = os.path.basename(source_file)
+    is_jpeg = filename.lower().endswith(".jpg")
+
+    range_size = config.get("exif_range_size", 65536)
+    range_limit = config.get("exif_range_limit", 1048576)
+    file_size = source_details["size"]
+
+    # An empty file has no range to read (bytes=0--1 is not a valid range)
+    if(file_size == 0):
+        return None
+
+    while(True):
+        range_size = min(range_size, file_size)
+        result = onedrive_origin_client.download_range(source_details["downloadurl"], 0, range_size - 1)
+
+        if(result["status"] == False):
+            logging.warning("read_image_metadata_range(): Error reading EXIF range: %s", result["message"])
+            return None
+
+        data = result["data"]
+        exif_length = None
+        if(is_jpeg):
+            exif_length = jpeg_exif_length(data)
+
+        # The EXIF block is complete (or missing) for JPEG, or the whole file was read
+        complete = (len(data) >= file_size) or (exif_length != None and exif_length <= len(data))
+
+        try:
+            image_data = process_image(filename, io.BytesIO(data))
+        except Exception:
+            logging.debug("read_image_metadata_range(): EXIF incomplete in %d bytes: %s", len(data), filename)
+            image_data = None
+
+        if(image_data != None and (image_data["originaltime"] != "" or complete)):
+            logging.debug("read_image_metadata_range(): EXIF read from %d of %d bytes: %s", len(data), file_size, filename)
+            return image_data
+
+        if(complete or range_size >= range_limit):
+            return None
+
+        if(exif_length != None and exif_length > len(data)):
+            range_size = exif_length
+        else:
+            range_size = range_size * 4
+
+
+#
+# Read the creation date-time of an MP4/MOV video with range requests, without downloading the video.
+# The file is read in blocks of exif_range_size, up to exif_range_limit bytes. Returns None when not found.
+#
+def read_video_metadata_range(onedrive_origin_client, source_file, source_details, config):
+    block_size = config.get("exif_range_size", 65536)
+    max_blocks = max(1, config.get("exif_range_limit", 1048576) // block_size)
+    file_size = source_details["size"]
+    blocks = dict()
+
+    def read(offset, length):
+        data = b""
+
+        while(len(data) < length and offset < file_size):
+            block = offset // block_size
+
+            if(block not in blocks):
+                if(len(blocks) >= max_blocks):
+                    raise ValueError("Metadata not found within the range limit.")
+
+                block_start = block * block_size
+                result = onedrive_origin_client.download_range(source_details["downloadurl"], block_start, min(block_start + block_size, file_size) - 1)
+
+                if(result["status"] == False):
+                    raise OSError(result["message"])
+
+                blocks[block] = result["data"]
+
+            chunk = blocks[block][offset - block * block_size:offset - block * block_size + length - len(data)]
+
+            if(chunk == b""):
+                break
+
+            data = data + chunk
+            offset = offset + len(chunk)
+
+        return data
+
+    try:
+        date_obj = mp4_creation_datetime(read, file_size)
+    except (OSError, struct.error, ValueError, UnicodeDecodeError) as ex:
+        logging.debug("read_video_metadata_range(): Can't read the metadata of %s: %s", source_file, ex)
+        return None
+
+    logging.debug("read_video_metadata_range(): Read %d blocks of %s", len(blocks), source_file)
+    return date_obj
+
+
+#
+# Download the source file into a file-like object.
+# The SHA-256 and size calculated during the download are kept in source_details ("localhash" and "localsize").
+#
+def download_source(onedrive_origin_client, source_details, fileobj):
+    fileobj.seek(0)
+    fileobj.truncate()
+
+    with metrics.stage(STAGE_DOWNLOAD):
+        result = onedrive_origin_client.download_to(source_details["downloadurl"], fileobj, source_details["size"])
+
+    if(result["status"] == False):
+        return result
+
+    metrics.increment("bytes_total", result["size"], direction="download")
+
+    if(result["size"] != source_details["size"]):
+        return {"status": False, "message": "Downloaded size does not match the source file size."}
+
+    if(source_details["sha256hash"] != "" and result["sha256hash"] != source_details["sha256hash"].upper()):
+        return {"status": False, "message": "Downloaded hash does not match the source file hash."}
+
+    source_details["localhash"] = result["sha256hash"]
+    source_details["localsize"] = result["size"]
+
+    # Some accounts (e.g. OneDrive for Business) do not provide the SHA-256. Use the one calculated on download.
+    if(source_details["sha256hash"] == ""):
+        source_details["sha256hash"] = result["sha256hash"]
+
+    return result
+
+
+def process_image_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config):
     logging.debug("process_image_file(): Image file: %s", source_file)
 
-    ## Data from configuration
-    path_screenshot = config["constants"]["screenshot_folder_name"]
-    path_image = config["constants"]["images_folder_name"]
-    path_video = config["constants"]["videos_folder_name"]
-    
+    ## Images are kept in memory, unless larger than the threshold. Each worker gets its own buffer.
+    memory_threshold = config.get("memory_threshold", 16777216)
+
+    with tempfile.SpooledTemporaryFile(max_size=memory_threshold) as image_buffer:
+        return process_image_buffer(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, image_buffer)
+
+
+#
+# Configuration constant with the folder of an image: screenshots (PNG or no EXIF date) or images
+#
+def image_folder_constant(filename, naming):
+    if(filename.lower().endswith(".png")):
+        return "screenshot_folder_name"
+    elif(naming == "file-naming" or naming == "original-name"):
+        return "screenshot_folder_name"
+    else:
+        return "images_folder_name"
+
+
+#
+# Determine the destination folder and name of an image. Reads the EXIF block only, when possible.
+#
+def image_destination(onedrive_origin_client, source_file, source_details, destination_path, config, image_buffer):
 
     filename = os.path.basename(source_file)
     filename_lower = filename.lower()
 
-    ## Trigger the file download
-    onedrive_origin_client.download(source_file,"/tmp")
+    ## Metadata first: read only the EXIF block when the format allows it
+    image_data = None
+    if(filename_lower.endswith(".heic") or filename_lower.endswith(".jpg")):
+        with metrics.stage(STAGE_METADATA):
+            image_data = read_image_metadata_range(onedrive_origin_client, source_file, source_details, config)
+
+    downloaded = False
+    if(image_data == None):
+        ## Trigger the file download
+        result = download_source(onedrive_origin_client, source_details, image_buffer)
+
+        if(result["status"] == False):
+            return result
+
+        downloaded = True
+        record_stage(source_file, source_details, STAGE_DOWNLOADED)
 
-    image_data = process_image(filename)
+        image_buffer.seek(0)
+        with metrics.stage(STAGE_METADATA):
+            image_data = process_image(filename, image_buffer)
   
-    processed_data = new_file_details(filename, image_data["originaltime"], image_data["offset"],image_data["originalsubsecond"])
-    #print("FILENAME: ", processed_data.filename)
-    #print("MONTH: ", processed_data.month)
-    #print("YEAR: ", processed_data.year)
+    with metrics.stage(STAGE_NAMING):
+        processed_data = new_file_details(filename, image_data["originaltime"], image_data["offset"],image_data["originalsubsecond"])
 
     logging.debug("process_image_file(): New filename: %s",processed_data.filename )
 
@@ -318,27 +789,9 @@ def process_image_file(onedrive_origin_client, source_file, onedrive_destination
     file_month = processed_data.month
 
 
-    ## When function is called recursively, to generate another name
-    # This needs to be improved to avoid the download
-    if(sequence > 0 ):
-        filename_no_ext = os.path.splitext(processed_data.filename)[0]
-        file_ext = get_extension(processed_data.filename)
-        processed_data.filename = filename_no_ext + "_" + str(sequence) + "." + file_ext
-
-
-    ### Rename the file here before uploading
-    os.rename(filename, processed_data.filename)
-
-
     ### Determine upload path 
     #Upload to another folder
-    upload_folder = ""
-    if(filename_lower.endswith(".png")):
-        upload_folder = destination_path + "/" + path_screenshot
-    elif(processed_data.status == "file-naming" or processed_data.status == "original-name"):
-        upload_folder = destination_path + "/" + path_screenshot
-    else:
-        upload_folder = destination_path + "/" + path_image
+    upload_folder = destination_path + "/" + config["constants"][image_folder_constant(filename, processed_data.status)]
 
 
 
@@ -352,29 +805,48 @@ def process_image_file(onedrive_origin_client, source_file, onedrive_destination
     full_upload_path = upload_folder + "/" + file_year + "/" + file_month
 
     logging.debug("process_image_file(): Full upload path: %s", full_upload_path)
-    
-    result = onedrive_destination_client.upload(processed_data.filename, full_upload_path)
-    
-    if(result["status"]):
-        onedrive_origin_client.delete(source_file)
-        logging.debug("process_image_file(): File uploaded successfuly: %s", processed_data.filename)
 
-    elif(result["message"] == "File already exists. Solve conflict by changing upload policy from 'fail' to other."):
-        #Check if local file is repeated
-        result = compare_files(onedrive_destination_client, full_upload_path + "/" + processed_data.filename, processed_data.filename)
-        
-        if([result["comparison"]]):
-            #File is repeated
-            logging.info("process_image_file(): File is repeated. Delete from the source. Maintain existing in target.")
-            onedrive_origin_client.delete(source_file)
+    return {
+        "status": True,
+        "path": full_upload_path,
+        "filename": processed_data.filename,
+        "naming": processed_data.status,
+        "downloaded": downloaded
+    }
+
+
+def process_image_buffer(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, image_buffer):
+
+    source_details = onedrive_origin_client.item_details(source_file)
+
+    if(source_details["status"] == False):
+        logging.error("process_image_file(): Error reading the source file details. %s", source_details["message"])
+        return RESULT_ERROR
+
+    record, completed = resume_from_state(onedrive_origin_client, source_file, source_details, onedrive_destination_client)
+
+    if(completed):
+        return RESULT_RESUMED
+
+    downloaded = False
+    if(record != None and record["stage"] == STAGE_NAMED):
+        ## The name was computed in a previous run
+        full_upload_path, new_filename = record["destination"].rsplit("/", 1)
 
-        else:
-            ## Process again to append sequence to the file name
-            process_image_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, sequence + 1)
     else:
-        logging.error("process_image_file(): Error on the upload. Original file to remain in place. %s", result["message"])
-    
-    os.remove(processed_data.filename)
+        result = image_destination(onedrive_origin_client, source_file, source_details, destination_path, config, image_buffer)
+
+        if(result["status"] == False):
+            logging.error("process_image_file(): Error on the download. Original file to remain in place. %s", result["message"])
+            return RESULT_ERROR
+
+        full_upload_path = result["path"]
+        new_filename = result["filename"]
+        downloaded = result["downloaded"]
+
+        record_stage(source_file, source_details, STAGE_NAMED, full_upload_path + "/" + new_filename, result["naming"])
+
+    return transfer_file(onedrive_origin_client, source_file, source_details, onedrive_destination_client, full_upload_path, new_filename, config, image_buffer, downloaded)
 
 
     
@@ -383,8 +855,12 @@ def process_image_file(onedrive_origin_client, source_file, onedrive_destination
 #################################################################################################################################
 #################################################################################################################################
 
-def video_filename(filename):
-    date_obj = video_creation_datetime(filename)
+#
+# Name of a video from its creation date-time. Read from the local file when not given.
+#
+def video_filename(filename, date_obj=None):
+    if(date_obj == None):
+        date_obj = video_creation_datetime(filename)
 
     new_filename = filename
 
@@ -400,26 +876,15 @@ def video_filename(filename):
 
 
 
-def process_video_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config):
-    logging.debug("process_video_file(): Video file:", source_file)
-
-    ## Data from configuration
-    path_video = config["constants"]["videos_folder_name"]
-    
-
-    filename = os.path.basename(source_file)
-    filename_lower = filename.lower()
-
-    ## Trigger the file download
-    ### TODO - Error in the download might not be processed... CHECK THIS
-    onedrive_origin_client.download(source_file,"/tmp")
-
-    new_filename = video_filename(filename)
-    logging.debug("process_video_file(): New filename: %s", new_filename)
+#
+# Final name, year and month of a video. new_filename is the name from the creation date (video_filename()), or None.
+#
+def video_file_details(filename, new_filename):
 
     # Initialize variables
     file_year = "0000"
     file_month = "00"
+    naming = "exif-name"
 
     if(new_filename == None):
         components = parse_filename_pattern(filename)
@@ -429,40 +894,126 @@ def process_video_file(onedrive_origin_client, source_file, onedrive_destination
             file_month = components["datestr"][4:6]
             extension = get_extension(filename)
             new_filename = "v_" + components["datestr"] + "_" + components["timestr"][0:6] + "." + extension
+            naming = "file-naming"
         else:
             file_year = "0000"
             file_month = "00"
             new_filename = filename
+            naming = "original-name"
 
     else:
         file_year = new_filename[2:6]
         file_month = new_filename[6:8]
 
-    os.rename(filename, new_filename)
+    return {
+        "filename": new_filename,
+        "year": file_year,
+        "month": file_month,
+        "naming": naming
+    }
 
-    full_upload_path = destination_path + "/" + path_video + "/" + file_year + "/" + file_month
 
-    result = onedrive_destination_client.upload(new_filename, full_upload_path)
- 
+def process_video_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config):
+    logging.debug("process_video_file(): Video file: %s", source_file)
 
-    if(result["status"]):
-        onedrive_origin_client.delete(source_file)
-        logging.debug("process_video_file(): File uploaded successfuly: %s", new_filename)
+    ## Each call works on its own scratch folder so concurrent workers never collide on names
+    scratch_dir = tempfile.mkdtemp(prefix="onedrive_", dir=config.get("scratch_folder"))
+
+    try:
+        return process_video_download(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, scratch_dir)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
-    elif(result["message"] == "File already exists. Solve conflict by changing upload policy from 'fail' to other."):
-        #Check if local file is repeated
-        result = compare_files(onedrive_destination_client, full_upload_path + "/" + new_filename, new_filename)
-        
-        if([result["comparison"]]):
-            #File is repeated
-            logging.info("process_video_file(): File is repeated. Delete from the source. Maintain existing in target.")
-   
-            onedrive_origin_client.delete(source_file)
+
+#
+# Determine the destination folder and name of a video.
+# The creation date is read with range requests when possible. Otherwise the video is downloaded to local_file.
+#
+def video_destination(onedrive_origin_client, source_file, source_details, destination_path, config, local_file):
+
+    ## Data from configuration
+    path_video = config["constants"]["videos_folder_name"]
+
+    filename = os.path.basename(source_file)
+    filename_lower = filename.lower()
+
+    ## Metadata first: MP4/MOV boxes can be read without the download
+    date_obj = None
+    if(filename_lower.endswith(".mp4") or filename_lower.endswith(".mov")):
+        with metrics.stage(STAGE_METADATA):
+            date_obj = read_video_metadata_range(onedrive_origin_client, source_file, source_details, config)
+
+    downloaded = False
+    if(date_obj != None):
+        new_filename = video_filename(filename, date_obj)
 
     else:
-        logging.error("process_video_file(): Error on the upload. Original file to remain in place. %s", result["message"])
-    
-    os.remove(new_filename)
+        ## Trigger the file download
+        # Videos stay on disk, as ffprobe reads them from a file
+        with open(local_file, "w+b") as video_file:
+            result = download_source(onedrive_origin_client, source_details, video_file)
+
+        if(result["status"] == False):
+            return result
+
+        record_stage(source_file, source_details, STAGE_DOWNLOADED)
+        downloaded = True
+
+        with metrics.stage(STAGE_METADATA):
+            new_filename = video_filename(local_file)
+    logging.debug("process_video_file(): New filename: %s", new_filename)
+
+    with metrics.stage(STAGE_NAMING):
+        details = video_file_details(filename, new_filename)
+
+    full_upload_path = destination_path + "/" + path_video + "/" + details["year"] + "/" + details["month"]
+
+    return {
+        "status": True,
+        "path": full_upload_path,
+        "filename": details["filename"],
+        "naming": details["naming"],
+        "downloaded": downloaded
+    }
+
+
+def process_video_download(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, scratch_dir):
+
+    filename = os.path.basename(source_file)
+    local_file = os.path.join(scratch_dir, filename)
+
+    source_details = onedrive_origin_client.item_details(source_file)
+
+    if(source_details["status"] == False):
+        logging.error("process_video_file(): Error reading the source file details. %s", source_details["message"])
+        return RESULT_ERROR
+
+    record, completed = resume_from_state(onedrive_origin_client, source_file, source_details, onedrive_destination_client)
+
+    if(completed):
+        return RESULT_RESUMED
+
+    downloaded = False
+    if(record != None and record["stage"] == STAGE_NAMED):
+        ## The name was computed in a previous run
+        full_upload_path, new_filename = record["destination"].rsplit("/", 1)
+
+    else:
+        result = video_destination(onedrive_origin_client, source_file, source_details, destination_path, config, local_file)
+
+        if(result["status"] == False):
+            logging.error("process_video_file(): Error on the download. Original file to remain in place. %s", result["message"])
+            return RESULT_ERROR
+
+        full_upload_path = result["path"]
+        new_filename = result["filename"]
+        downloaded = result["downloaded"]
+
+        record_stage(source_file, source_details, STAGE_NAMED, full_upload_path + "/" + new_filename, result["naming"])
+
+    ## Keep the file of the download above. Ranged downloads write at any position, so no append mode.
+    with open(local_file, "r+b" if downloaded else "w+b") as video_file:
+        return transfer_file(onedrive_origin_client, source_file, source_details, onedrive_destination_client, full_upload_path, new_filename, config, video_file, downloaded)
                     
 
 
@@ -474,72 +1025,610 @@ def process_video_file(onedrive_origin_client, source_file, onedrive_destination
 
 #### Process Onde Drive Camera Roll
 
+#
+# Media type of a file from its extension: image, video or other
+#
+def file_media(filename):
+    filename_lower = filename.lower()
+
+    if(filename_lower.endswith(".heic") or filename_lower.endswith(".png") or filename_lower.endswith(".jpg")):
+        return "image"
+    elif(filename_lower.endswith(".mp4") or filename_lower.endswith(".mov")):
+        return "video"
+    else:
+        return "other"
+
+
 def process_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config):
 
     
     timeBefore = time.time()
     filename = os.path.basename(source_file)
-    filename_lower = filename.lower()
 
     logging.info("process_file(): Processing file: %s", filename)
 
-    if(filename_lower.endswith(".heic") or filename_lower.endswith(".png") or filename_lower.endswith(".jpg")):
-        process_image_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config)
+    media = file_media(filename)
 
-    elif(filename_lower.endswith(".mp4") or filename_lower.endswith(".mov")):
-        process_video_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config)
+    ## Metrics recorded while processing the file get the origin and media labels
+    with metrics.context(origin=config.get("profile_name", ""), media=media):
+        outcome = process_file_type(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, media)
 
-    else:
-        logging.warning("process_file(): Unknown file type: %s", filename)
+        metrics.increment("files_total", outcome=outcome)
+        metrics.observe("file_seconds", time.time() - timeBefore)
+
+    return outcome
+
+
+def process_file_type(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, media):
+    filename = os.path.basename(source_file)
+
+    try:
+        if(media == "image"):
+            return process_image_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config)
+
+        elif(media == "video"):
+            return process_video_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config)
+
+        else:
+            logging.warning("process_file(): Unknown file type: %s", filename)
+            return RESULT_SKIPPED
+
+    except Exception:
+        # Running inside a worker, so log here and let the other files carry on
+        logging.exception("process_file(): Error processing file. Original file to remain in place: %s", source_file)
+        return RESULT_ERROR
     
 
 
 
 
+#
+# Run file_function for a file, counting the file out of its folder once it is moved or deleted from the source
+#
+def track_file(cleanup, file_function, onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config):
+    ## Files waiting for a worker are left for the next run when stopping
+    if(stop_requested()):
+        return RESULT_SKIPPED
+
+    processing.cleanup = cleanup
+    try:
+        outcome = file_function(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config)
+    finally:
+        processing.cleanup = None
+
+    ## Deleted files are counted when their delete completes (see source_deleted())
+    if(outcome == RESULT_MOVED):
+        cleanup.removed(source_file)
+
+    return outcome
+
+
 ## Recursive function to transvese the folder structure
-def process_onedrive_folder(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config):
-    logging.info("process_onedrive_camera_roll(): Starting to process the onedrive files.")
-    
-    result = onedrive_origin_client.listfiles(source_path)
+# Files are handed to the executor and their futures returned, so the caller can wait for a whole subtree.
+# Each visited folder is registered in cleanup with the number of items of its listing.
+# Each file is given to file_function: process_file, or plan_file when planning the run.
+def walk_onedrive_folder(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config, executor, cleanup, file_function=process_file):
+    futures = []
+
+    with metrics.stage(STAGE_LIST):
+        result = onedrive_origin_client.listfiles(source_path)
 
     if(result["status"]):
 
         item_list = result["itemlist"]
+        cleanup.add_folder(source_path, len(item_list))
         
         for item in item_list:
+            if(stop_requested()):
+                break
+
             if(item["type"] == "folder"):
                 logging.info("process_onedrive_camera_roll(): Processing folder: %s", item["name"])
                 new_path = source_path + "/" +  item["name"]
-                process_onedrive_folder(onedrive_origin_client, new_path, onedrive_destination_client, destination_path, config)
-                
-                ## Folder processing is complete here. And it should be empty. 
-                # TODO - Check number of itemts in the folder
-                folder_list = onedrive_origin_client.listfiles(new_path)
-
-                if(len(folder_list["itemlist"]) ==0):
-                    logging.info("process_onedrive_folder(): The folder is empty. It can be deleted now.")
-                    
-                    del_result = onedrive_origin_client.delete(new_path)
-
-                    if(del_result["status"] == False):
-                        logging.error("process_onedrive_folder(): Error deleting folder: %s", result["message"])
-
-                else:
-                    logging.info("process_onedrive_folder(): The folder not empty and can't be removed.")
-                    
+                futures.extend(walk_onedrive_folder(onedrive_origin_client, new_path, onedrive_destination_client, destination_path, config, executor, cleanup, file_function))
 
             elif(item["type"] == "file"):
-                process_file(onedrive_origin_client, source_path + "/" + item["name"], onedrive_destination_client, destination_path, config)
+                future = executor.submit(track_file, cleanup, file_function, onedrive_origin_client, source_path + "/" + item["name"], onedrive_destination_client, destination_path, config)
+                futures.append(future)
 
-    
     else:
         logging.error("Error listing files: %s", result["message"])
+        cleanup.listing_failed(source_path)
+
+    return futures
+
+
+#
+# Remove the source folders left empty, deepest first, one level at a time: a folder is only empty once its subfolders are gone.
+# Folders with children left (from the counts of the walk) are kept without asking OneDrive. The others are checked to be
+# still empty (files may have been added since the walk, and deleting a folder deletes its content), and then deleted.
+# The checks and deletes of a level are sent together in batches. No folder is listed again.
+#
+def remove_empty_folders(onedrive_origin_client, cleanup):
+
+    ## The deletes of the files may still be queued
+    onedrive_origin_client.flush_batches()
+
+    for level in cleanup.levels():
+        checks = []
+
+        for folder_path in level:
+            if(cleanup.is_uncertain(folder_path) == False and cleanup.is_empty(folder_path) == False):
+                logging.info("remove_empty_folders(): The folder is not empty and can't be removed: %s", folder_path)
+                continue
+
+            checks.append((folder_path, onedrive_origin_client.item_details_later(folder_path)))
+
+        with metrics.stage(STAGE_LIST):
+            onedrive_origin_client.flush_batches()
+
+        deletes = []
+
+        for folder_path, future in checks:
+            details = future.result()
+
+            if(details["status"] == False):
+                logging.error("remove_empty_folders(): Error reading folder %s: %s", folder_path, details["message"])
+
+            elif(details["childcount"] != 0):
+                logging.info("remove_empty_folders(): The folder is not empty and can't be removed: %s", folder_path)
+
+            else:
+                deletes.append((folder_path, onedrive_origin_client.delete_later(folder_path)))
+
+        with metrics.stage(STAGE_DELETE):
+            onedrive_origin_client.flush_batches()
+
+        for folder_path, future in deletes:
+            del_result = future.result()
+
+            if(del_result["status"]):
+                logging.info("remove_empty_folders(): Empty folder removed: %s", folder_path)
+                cleanup.removed(folder_path)
+            else:
+                logging.error("remove_empty_folders(): Error deleting folder %s: %s", folder_path, del_result["message"])
+
+
+#
+# Process only the files added or changed since the previous scan, using the delta link.
+# Returns the futures of the files, or None when the delta link can't be used and a full scan is needed.
+#
+def process_onedrive_changes(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config, executor, scan_key, delta_link):
+    with metrics.stage(STAGE_LIST):
+        result = onedrive_origin_client.delta(source_path, delta_link)
+
+    if(result["status"] == False):
+        if(result["expired"]):
+            logging.warning("process_onedrive_changes(): Delta link expired. Falling back to a full scan.")
+        else:
+            logging.warning("process_onedrive_changes(): Error reading the changes. Falling back to a full scan. %s", result["message"])
+        return None
+
+    futures = []
+    path_errors = 0
+
+    # Only the changed files are known, so the folders are checked before they are removed
+    cleanup = FolderCleanup(source_path)
+
+    # Delta responses do not include the paths. They are all requested first, together in batches.
+    # Deleted items include the files removed or moved by this processor.
+    path_futures = [(item, onedrive_origin_client.item_path_later(item["id"])) for item in result["itemlist"]
+                    if item["deleted"] == False and item["type"] == "file"]
+
+    for item, path_future in path_futures:
+        if(stop_requested()):
+            break
+
+        path_result = path_future.result()
+
+        # Deleted since the delta. It is a deleted item in the next one.
+        if(path_result["status"] == False and path_result.get("code") == 404):
+            continue
+
+        if(path_result["status"] == False):
+            logging.error("process_onedrive_changes(): Error reading the path of item %s: %s", item["id"], path_result["message"])
+            path_errors = path_errors + 1
+            continue
+
+        if(path_result["path"].startswith(source_path + "/") == False):
+            continue
 
+        source_file = path_result["path"]
+
+        # All the folders between the file and the source folder may end up empty
+        folder_path = os.path.dirname(source_file)
+        while(folder_path != source_path):
+            cleanup.add_folder(folder_path, None)
+            folder_path = os.path.dirname(folder_path)
+        futures.append(executor.submit(track_file, cleanup, process_file, onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config))
+
+    logging.info("process_onedrive_changes(): %d changed files since the previous scan.", len(futures))
+    wait(futures)
+
+    ## Remove the folders left empty, deepest first. The source folder itself is kept.
+    remove_empty_folders(onedrive_origin_client, cleanup)
+
+    ## Changes not started before stopping, or that failed, are read again next time
+    if(stop_requested() == False and path_errors == 0 and all_succeeded(futures)):
+        state_store.set_delta_link(scan_key, result["deltalink"])
+    else:
+        logging.warning("process_onedrive_changes(): Not all the changes were processed. The delta link is kept, so they are read again next time.")
+
+    return futures
+
+
+#
+# No file ended in error. The delta link is only advanced then, as the changes before it are never returned again.
+#
+def all_succeeded(futures):
+    return all(future.result() != RESULT_ERROR for future in futures)
+
+
+#
+# Count the outcome of each processed file
+#
+def summarize_results(futures):
+    summary = {"files": len(futures)}
+
+    for future in futures:
+        outcome = future.result()
+        summary[outcome] = summary.get(outcome, 0) + 1
+
+    return summary
+
+
+#
+# Process all the files of an origin folder.
+# Returns a summary with the number of files per outcome (uploaded, moved, duplicate, ...).
+#
+def process_onedrive_folder(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config):
+    logging.info("process_onedrive_camera_roll(): Starting to process the onedrive files.")
+
+    # Number of files processed in parallel. Default is one file at a time.
+    max_workers = config.get("max_workers", 1)
+
+    # Incremental scans keep the delta link in the state store
+    incremental = config.get("incremental_scan", False) and state_store != None
+    scan_key = None
+    new_delta_link = None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        if(incremental):
+            scan_key = str(onedrive_origin_client.drive_id()) + ":" + source_path
+            delta_link = state_store.get_delta_link(scan_key)
+
+            if(delta_link != None):
+                futures = process_onedrive_changes(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config, executor, scan_key, delta_link)
+
+                if(futures != None):
+                    return summarize_results(futures)
+
+            ## The delta link is taken before the full scan, so changes during the scan are seen next time
+            result = onedrive_origin_client.delta(source_path, latest=True)
+
+            if(result["status"]):
+                new_delta_link = result["deltalink"]
+            else:
+                logging.warning("process_onedrive_folder(): Incremental scan not available. %s", result["message"])
 
+        cleanup = FolderCleanup(source_path)
+        futures = walk_onedrive_folder(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config, executor, cleanup)
+        wait(futures)
+
+    ## The folders are removed after all the files are finished, using the counts of the walk
+    remove_empty_folders(onedrive_origin_client, cleanup)
+
+    if(new_delta_link != None):
+        if(stop_requested() == False and cleanup.listing_errors == 0 and all_succeeded(futures)):
+            state_store.set_delta_link(scan_key, new_delta_link)
+        else:
+            logging.warning("process_onedrive_folder(): Not all the files were processed. The next scan is a full scan again.")
+
+    return summarize_results(futures)
+
+
+
+#################################################################################################################################
+#################################################################################################################################
+#################################################################################################################################
+#################################################################################################################################
+
+#### Plan the run in a manifest and apply it later
+
+#
+# Plan one file without changing anything: destination, naming and the action the run would take.
+# Only the metadata is read when the format allows it, as in the normal run.
+# Returns the manifest entry of the file.
+#
+def plan_file(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config):
+    filename = os.path.basename(source_file)
+    media = file_media(filename)
+
+    entry = {"type": "file", "source": source_file, "media": media}
+
+    if(media == "other"):
+        entry["action"] = ACTION_SKIP
+        return entry
+
+    try:
+        with metrics.context(origin=config.get("profile_name", ""), media=media):
+            return plan_file_destination(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, entry)
+
+    except Exception as ex:
+        logging.exception("plan_file(): Error planning file: %s", source_file)
+        entry["action"] = ACTION_ERROR
+        entry["message"] = str(ex)
+        return entry
+
+
+def plan_file_destination(onedrive_origin_client, source_file, onedrive_destination_client, destination_path, config, entry):
+    filename = os.path.basename(source_file)
+
+    source_details = onedrive_origin_client.item_details(source_file)
+
+    if(source_details["status"] == False):
+        entry["action"] = ACTION_ERROR
+        entry["message"] = source_details["message"]
+        return entry
+
+    if(entry["media"] == "image"):
+        with tempfile.SpooledTemporaryFile(max_size=config.get("memory_threshold", 16777216)) as image_buffer:
+            result = image_destination(onedrive_origin_client, source_file, source_details, destination_path, config, image_buffer)
+
+    else:
+        scratch_dir = tempfile.mkdtemp(prefix="onedrive_", dir=config.get("scratch_folder"))
+        try:
+            result = video_destination(onedrive_origin_client, source_file, source_details, destination_path, config, os.path.join(scratch_dir, filename))
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    # The hash may come from the download (accounts without SHA-256)
+    entry["id"] = source_details["id"]
+    entry["size"] = source_details["size"]
+    entry["sha256hash"] = source_details["sha256hash"]
+
+    if(result["status"] == False):
+        entry["action"] = ACTION_ERROR
+        entry["message"] = result["message"]
+        return entry
+
+    full_upload_path = result["path"]
+    new_filename = result["filename"]
+    entry["naming"] = result["naming"]
+
+    ## Same checks as transfer_file(), without sending anything
+    with metrics.stage(STAGE_CONFLICT_CHECK):
+        status = destination_status(onedrive_destination_client, full_upload_path, new_filename, source_details)
+
+        if(status == FILE_CONFLICT):
+            resolved = next_free_filename(onedrive_destination_client, full_upload_path, new_filename, source_details)
+
+            if(resolved["status"] == False):
+                entry["action"] = ACTION_ERROR
+                entry["message"] = resolved["message"]
+                return entry
+
+            new_filename = resolved["filename"]
+            status = FILE_DUPLICATE if resolved["duplicate"] else FILE_NEW
+
+    if(status == FILE_DUPLICATE):
+        entry["action"] = ACTION_DELETE_DUPLICATE
+    elif(is_same_account(onedrive_origin_client, onedrive_destination_client, config)):
+        entry["action"] = ACTION_MOVE
+    else:
+        entry["action"] = ACTION_UPLOAD
+
+    entry["destination"] = full_upload_path + "/" + new_filename
+
+    logging.info("plan_file(): %s %s -> %s", entry["action"], source_file, entry["destination"])
+    return entry
+
+
+#
+# Plan all the files of an origin folder and write them to the manifest, followed by the folders to remove (bottom-up).
+# Returns a summary with the number of files per planned action.
+#
+def plan_onedrive_folder(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config, manifest):
+    logging.info("plan_onedrive_folder(): Planning the onedrive files of %s", source_path)
+
+    max_workers = config.get("max_workers", 1)
+    profile_name = config.get("profile_name", "")
+    cleanup = FolderCleanup(source_path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = walk_onedrive_folder(onedrive_origin_client, source_path, onedrive_destination_client, destination_path, config, executor, cleanup, plan_file)
+        entries = [future.result() for future in futures]
+
+    summary = {"files": len(entries)}
+
+    for entry in entries:
+        entry["origin"] = profile_name
+        manifest.write(entry)
+        summary[entry["action"]] = summary.get(entry["action"], 0) + 1
+
+    for folder_path in cleanup.folders():
+        manifest.write({"type": "folder", "origin": profile_name, "source": folder_path, "action": ACTION_REMOVE_FOLDER})
+
+    return summary
+
+
+#
+# Apply the manifest entry of one file. The file is only sent when it is still the file that was planned.
+# The destination is checked again, so files added to the destination after the plan are not overwritten.
+#
+def execute_file(onedrive_origin_client, entry, onedrive_destination_client, config):
+    if(entry["action"] not in (ACTION_UPLOAD, ACTION_MOVE, ACTION_DELETE_DUPLICATE)):
+        return RESULT_SKIPPED
+
+    timeBefore = time.time()
+
+    with metrics.context(origin=config.get("profile_name", ""), media=entry["media"]):
+        try:
+            outcome = execute_file_transfer(onedrive_origin_client, entry, onedrive_destination_client, config)
+        except Exception:
+            logging.exception("execute_file(): Error applying the manifest. Original file to remain in place: %s", entry["source"])
+            outcome = RESULT_ERROR
+
+        metrics.increment("files_total", outcome=outcome)
+        metrics.observe("file_seconds", time.time() - timeBefore)
+
+    return outcome
+
+
+def execute_file_transfer(onedrive_origin_client, entry, onedrive_destination_client, config):
+    source_file = entry["source"]
+
+    source_details = onedrive_origin_client.item_details(source_file)
+
+    if(source_details["status"] == False):
+        logging.error("execute_file(): Error reading the source file details. %s", source_details["message"])
+        return RESULT_ERROR
+
+    record, completed = resume_from_state(onedrive_origin_client, source_file, source_details, onedrive_destination_client)
+
+    if(completed):
+        return RESULT_RESUMED
+
+    if(source_details["id"] != entry["id"] or source_details["size"] != entry["size"] or
+       (source_details["sha256hash"] != "" and source_details["sha256hash"].upper() != entry["sha256hash"].upper())):
+        logging.warning("execute_file(): File changed since the plan. Original file to remain in place: %s", source_file)
+        return RESULT_SKIPPED
+
+    full_upload_path, new_filename = entry["destination"].rsplit("/", 1)
+    record_stage(source_file, source_details, STAGE_NAMED, entry["destination"], entry["naming"])
+
+    if(entry["media"] == "image"):
+        with tempfile.SpooledTemporaryFile(max_size=config.get("memory_threshold", 16777216)) as image_buffer:
+            return transfer_file(onedrive_origin_client, source_file, source_details, onedrive_destination_client, full_upload_path, new_filename, config, image_buffer, False)
+
+    with tempfile.TemporaryFile(prefix="onedrive_", dir=config.get("scratch_folder")) as video_file:
+        return transfer_file(onedrive_origin_client, source_file, source_details, onedrive_destination_client, full_upload_path, new_filename, config, video_file, False)
+
+
+#
+# Apply the manifest entries of an origin: all the files in parallel, then the folders left empty (bottom-up).
+# Files are sent grouped by destination folder, so each folder of the destination index is listed once.
+# Returns a summary with the number of files per outcome.
+#
+def execute_onedrive_manifest(onedrive_origin_client, entries, onedrive_destination_client, config):
+    file_entries = [entry for entry in entries if entry["type"] == "file"]
+    folder_entries = [entry for entry in entries if entry["type"] == "folder" and entry["action"] == ACTION_REMOVE_FOLDER]
+
+    file_entries.sort(key=lambda entry: os.path.dirname(entry.get("destination", "")))
+
+    logging.info("execute_onedrive_manifest(): Applying %d files and %d folders.", len(file_entries), len(folder_entries))
+
+    with ThreadPoolExecutor(max_workers=config.get("max_workers", 1)) as executor:
+        futures = [executor.submit(execute_file, onedrive_origin_client, entry, onedrive_destination_client, config) for entry in file_entries]
+        wait(futures)
+
+    ## Only the files of the plan are known, so the folders are checked before they are removed
+    cleanup = FolderCleanup("")
+    for entry in folder_entries:
+        cleanup.add_folder(entry["source"], None)
+
+    remove_empty_folders(onedrive_origin_client, cleanup)
+
+    return summarize_results(futures)
+
+
+
+#
+# Process one origin profile. Errors stay within the origin, so the other origins carry on.
+# The destination client is shared by all the origins.
+# In plan mode the files are written to the manifest (a ManifestWriter). In execute mode manifest has the entries of this origin.
+# origin_clients keeps the connected clients by profile between calls (watch mode).
+#
+def process_origin(base_url, origin, destination_client, destination_path, config, rate_limiter, mode=MODE_RUN, manifest=None, origin_clients=None):
+    profile_name = origin["profile_name"]
+    origin_credentials_file = origin["credentials"]
+    source_path = origin["source_path"]
+    profile_destination_folder = origin["destination_folder"]
+
+    time_before = time.time()
+
+    # Each origin can have its own number of workers
+    origin_config = dict(config)
+    origin_config["profile_name"] = profile_name
+    if("max_workers" in origin):
+        origin_config["max_workers"] = origin["max_workers"]
+
+    try:
+        origin_client = None if origin_clients == None else origin_clients.get(profile_name)
+
+        if(origin_client == None):
+            origin_client = connect_origin(base_url, origin, config, rate_limiter)
+
+            if(origin_clients != None):
+                origin_clients[profile_name] = origin_client
+
+        with metrics.context(origin=profile_name):
+            if(mode == MODE_PLAN):
+                summary = plan_onedrive_folder(origin_client, source_path, destination_client, destination_path + profile_destination_folder, origin_config, manifest)
+            elif(mode == MODE_EXECUTE):
+                summary = execute_onedrive_manifest(origin_client, manifest, destination_client, origin_config)
+            else:
+                summary = process_onedrive_folder(origin_client, source_path, destination_client, destination_path + profile_destination_folder, origin_config)
+
+    except Exception as ex:
+        logging.exception("process_origin(): Error processing profile: %s", profile_name)
+        summary = {"files": 0, "failed": str(ex)}
+
+    summary["seconds"] = round(time.time() - time_before, 1)
+    return summary
+
+
+def connect_origin(base_url, origin, config, rate_limiter):
+    origin_credentials_file = origin["credentials"]
+    origin_credentials = read_credentials(base_url, origin_credentials_file)
+
+    ## Connecting to the origin
+    origin_client = OneDriveClient(origin_credentials["clientID"], origin_credentials["clientSecret"], origin_credentials["refreshToken"],
+                                   rate_limiter=rate_limiter, account=origin_credentials_file, token_store=token_store,
+                                   transport=http_transport)
+    origin_client.set_download_options(config.get("parallel_download_threshold", PARALLEL_DOWNLOAD_THRESHOLD),
+                                       config.get("download_range_size", DOWNLOAD_RANGE_SIZE), config.get("download_workers", DOWNLOAD_WORKERS))
+    origin_client.set_batch_options(config.get("batch_size", MAX_BATCH_SIZE), config.get("batch_delay", BATCH_DELAY))
+    logging.info("Connected to origin client profile: %s", origin["profile_name"])
+
+    return origin_client
+
+
+#
+# Process all the origins in parallel, log their summaries and write the metrics files
+#
+def process_origins(base_url, origins, destination_client, destination_path, config, rate_limiter, mode=MODE_RUN, manifests=None, origin_clients=None):
+    max_parallel_origins = config.get("max_parallel_origins", len(origins))
+    summaries = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel_origins), thread_name_prefix="origin") as executor:
+        futures = [executor.submit(process_origin, base_url, origin, destination_client, destination_path, config, rate_limiter, mode, None if manifests == None else manifests.get(origin["profile_name"]), origin_clients)
+                   for origin in origins]
+
+        for origin, future in zip(origins, futures):
+            summaries.append((origin["profile_name"], future.result()))
+
+    for profile_name, summary in summaries:
+        logging.info("Summary for profile %s: %s", profile_name, summary)
+
+    if(http_transport != None):
+        logging.info("HTTP connections: %s", http_transport.stats())
+
+    ## Metrics of the run, for cron runs (e.g. node exporter textfile collector)
+    if("metrics_textfile" in config):
+        metrics.write_textfile(config["metrics_textfile"])
+
+    if("metrics_json" in config):
+        metrics.write_json(config["metrics_json"])
+
+    return summaries
 
 
 ######### MAIN FUNCTION ##########
-def mainProcessor():
+# mode is MODE_RUN, MODE_PLAN (write the manifest_file, no file is changed), MODE_EXECUTE (apply the manifest_file)
+# or MODE_WATCH (process the new files until stopped)
+def mainProcessor(mode=MODE_RUN, manifest_file=None):
     logging.basicConfig(format='%(asctime)s [%(levelname)s] [%(name)s] %(message)s', level=logging.INFO)
 
 
@@ -549,6 +1638,12 @@ def mainProcessor():
     ### Obtain the base config URL
     base_url = os.environ.get('BASE_CONFIG_URL')
     
+    ## Local copies of the configuration, credentials and tokens. An empty folder disables them.
+    global config_cache, token_store
+    cache_folder = os.environ.get('CONFIG_CACHE_FOLDER', DEFAULT_CACHE_FOLDER)
+    if(cache_folder != ""):
+        config_cache = ConfigCache(cache_folder)
+        token_store = TokenStore(os.path.join(cache_folder, "tokens.json"))
 
     ### Variables for global processing
     destination_credentials_file = ""
@@ -565,30 +1660,96 @@ def mainProcessor():
 
     origins = config["origins"]
 
+    ## Processing state from the previous runs
+    # The plan changes nothing, not even the state
+    global state_store
+    if("state_file" in config and mode != MODE_PLAN):
+        state_store = StateStore(config["state_file"])
+        logging.info("Using state file: %s", config["state_file"])
+
+    ## Metrics endpoint for Prometheus
+    if("metrics_port" in config):
+        metrics.start_http_server(config["metrics_port"])
+
+    ## Request limits shared by all the clients, per account and operation type
+    rate_limiter = RateLimiter(config.get("rate_limit"))
+
+    ## Connections kept open and shared by all the clients
+    global http_transport
+    http_transport = HttpTransport(config.get("http_pool_size", MAX_CONNECTIONS_PER_HOST), config.get("http_idle_timeout", IDLE_TIMEOUT),
+                                   config.get("http_pool_timeout", POOL_TIMEOUT))
+    metrics.add_source(http_transport.metrics)
+
     # Connect to the destination
-    destination_client = onedrive_simple_sdk(destination_credentials["clientID"], destination_credentials["clientSecret"], destination_credentials["refreshToken"])
+    destination_client = OneDriveClient(destination_credentials["clientID"], destination_credentials["clientSecret"], destination_credentials["refreshToken"],
+                                        rate_limiter=rate_limiter, account=destination_credentials_file, token_store=token_store,
+                                        transport=http_transport)
+    destination_client.set_upload_options(config.get("large_file_threshold", SIMPLE_UPLOAD_LIMIT), config.get("upload_chunk_size", UPLOAD_CHUNK_SIZE), state_store)
+    destination_client.set_batch_options(config.get("batch_size", MAX_BATCH_SIZE), config.get("batch_delay", BATCH_DELAY))
     logging.info("Connected to destination client.")
 
-    #### Cycle through all the origins and process the files
-    for origin in origins:
-        profile_name = origin["profile_name"]
-        origin_credentials_file = origin["credentials"]
-        source_path = origin["source_path"]
-        profile_destination_folder = origin["destination_folder"]
+    ## Destination folders are listed once and kept in memory
+    global destination_index
+    if(config.get("destination_index", True)):
+        destination_index = DestinationIndex(destination_client, config.get("destination_index_max_age", 3600))
 
-        origin_credentials = read_credentials(base_url,origin_credentials_file)
+    #### Process all the origins in parallel. Each origin has its own client and worker pool.
+    manifests = dict()
+    if(mode == MODE_PLAN):
+        manifest_writer = ManifestWriter(manifest_file)
+        for origin in origins:
+            manifests[origin["profile_name"]] = manifest_writer
+        logging.info("Planning the run in the manifest: %s", manifest_file)
 
-        ## Connecting to the origin
-        origin_client = onedrive_simple_sdk(origin_credentials["clientID"], origin_credentials["clientSecret"], origin_credentials["refreshToken"])
-        logging.info("Connected to origin client profile: %s", profile_name)
-    
-        process_onedrive_folder(origin_client, source_path, destination_client, destination_path + profile_destination_folder, config)
+    elif(mode == MODE_EXECUTE):
+        for entry in read_manifest(manifest_file):
+            manifests.setdefault(entry["origin"], []).append(entry)
+
+        # Only the origins of the manifest are processed
+        unknown_origins = set(manifests.keys()) - set(origin["profile_name"] for origin in origins)
+        if(len(unknown_origins) > 0):
+            logging.warning("Origins of the manifest not in the configuration, not processed: %s", ", ".join(sorted(unknown_origins)))
 
+        origins = [origin for origin in origins if origin["profile_name"] in manifests]
+        logging.info("Applying the manifest: %s", manifest_file)
+
+    if(mode == MODE_WATCH):
+        ## The clients stay connected between the cycles
+        global watcher
+        watcher = Watcher(config.get("poll_interval", DEFAULT_POLL_INTERVAL))
+        watcher.install_signal_handlers()
+
+        if("notification_port" in config):
+            watcher.start_notification_server(config["notification_port"], config.get("notification_client_state"))
+
+        origin_clients = dict()
+        logging.info("Watching the origins every %s seconds.", watcher.poll_interval)
+        watcher.run(lambda: process_origins(base_url, origins, destination_client, destination_path, config, rate_limiter, MODE_RUN, manifests, origin_clients))
+
+    else:
+        process_origins(base_url, origins, destination_client, destination_path, config, rate_limiter, mode, manifests)
+
+    if(mode == MODE_PLAN):
+        manifest_writer.close()
 
     logging.info("Completed processing the Onedrive files.")
 
 
 ##### MAIN PART ######
-mainProcessor()
+# Guarded so the functions can be imported (e.g. by the worker processes of batch_metadata)
+# Usage: python onedrive_processor.py [plan|execute <manifest file>] [watch]
+# Anything else prints the usage, so a plan without its manifest never turns into a full run
+if __name__ == "__main__":
+    arguments = sys.argv[1:]
+
+    if(len(arguments) == 0):
+        mainProcessor()
+    elif(len(arguments) == 2 and arguments[0] in (MODE_PLAN, MODE_EXECUTE)):
+        mainProcessor(arguments[0], arguments[1])
+    elif(arguments == [MODE_WATCH]):
+        mainProcessor(MODE_WATCH)
+    else:
+        print("Usage: python onedrive_processor.py [plan|execute <manifest file>] [watch]", file=sys.stderr)
+        sys.exit(2)
 
 
@@ -0,0 +1,224 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import logging
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+# HTTP status codes returned by Graph when throttling
+THROTTLED_CODES = (429, 503, 509)
+
+# Operation types. Each account has one limiter per type.
+OPERATION_READ = "read"
+OPERATION_WRITE = "write"
+OPERATION_TRANSFER = "transfer"
+
+DEFAULT_SETTINGS = {
+    "requests_per_second": 10,
+    "burst": 20,
+    "max_concurrency": 16,
+    "max_retries": 6,
+    "backoff_base": 1,
+    "backoff_max": 120
+}
+
+
+#
+# Rate and concurrency limit for one account and operation type.
+# Requests are spread by a token bucket. The number of requests in flight follows AIMD:
+# it grows by one per "window" of successful requests and is halved on throttling.
+# A Retry-After from the server stops all the requests of the limiter until it expires.
+#
+class AdaptiveLimiter:
+
+    def __init__(self, name, settings, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.rate = settings["requests_per_second"]
+        self.burst = settings["burst"]
+        self.max_concurrency = settings["max_concurrency"]
+        self.max_retries = settings["max_retries"]
+        self.backoff_base = settings["backoff_base"]
+        self.backoff_max = settings["backoff_max"]
+
+        self.clock = clock
+        self.sleep = sleep
+
+        self.condition = threading.Condition()
+        self.tokens = self.burst
+        self.last_refill = clock()
+        self.blocked_until = 0
+        self.in_flight = 0
+        self.concurrency = float(self.max_concurrency)
+
+        self.throttled_count = 0
+
+
+    #
+    # Wait until a token is available and there is room for another request in flight
+    #
+    def acquire(self):
+        with self.condition:
+            while(True):
+                now = self.clock()
+
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if(now < self.blocked_until):
+                    wait_time = self.blocked_until - now
+                elif(self.in_flight >= int(self.concurrency)):
+                    wait_time = None
+                elif(self.tokens < 1):
+                    wait_time = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens = self.tokens - 1
+                    self.in_flight = self.in_flight + 1
+                    return
+
+                if(wait_time == None):
+                    self.condition.wait()
+                else:
+                    self.condition.release()
+                    try:
+                        self.sleep(wait_time)
+                    finally:
+                        self.condition.acquire()
+
+
+    def release(self):
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            self.condition.notify_all()
+
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+    # Additive increase
+    def succeeded(self):
+        with self.condition:
+            if(self.concurrency < self.max_concurrency):
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                self.condition.notify_all()
+
+
+    #
+    # Multiplicative decrease. Returns the time to wait before retrying:
+    # the Retry-After from the server when available, otherwise an exponential backoff with full jitter.
+    #
+    def throttled(self, attempt, retry_after=None):
+        with self.condition:
+            self.throttled_count = self.throttled_count + 1
+            self.concurrency = max(1.0, self.concurrency / 2)
+
+            if(retry_after != None):
+                delay = retry_after
+            else:
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+            self.blocked_until = max(self.blocked_until, self.clock() + delay)
+
+        logging.warning("AdaptiveLimiter(%s): Throttled. Waiting %.1f seconds. Concurrency now %d.", self.name, delay, int(self.concurrency))
+        return delay
+
+
+    #
+    # Run request() within the limits, retrying while throttled.
+    # request() returns a tuple where the first element is the HTTP status code and the second the headers.
+    #
+    def call(self, request):
+        attempt = 0
+
+        while(True):
+            with self.slot():
+                response = request()
+
+            code = response[0]
+
+            if(code not in THROTTLED_CODES):
+                self.succeeded()
+                return response
+
+            if(attempt >= self.max_retries):
+                logging.error("AdaptiveLimiter(%s): Still throttled after %d retries.", self.name, attempt)
+                return response
+
+            self.throttled(attempt, parse_retry_after(response[1]))
+            attempt = attempt + 1
+
+
+def parse_retry_after(headers):
+    if(headers == None):
+        return None
+
+    value = headers.get("Retry-After")
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+#
+# Limiters shared by all the clients, one per account and operation type.
+# Settings come from the "rate_limit" configuration, optionally overridden per operation type.
+#
+class RateLimiter:
+
+    def __init__(self, config=None, clock=time.monotonic, sleep=time.sleep):
+        self.config = config or {}
+        self.clock = clock
+        self.sleep = sleep
+        self.limiters = dict()
+        self.lock = threading.Lock()
+
+
+    def settings(self, operation):
+        settings = dict(DEFAULT_SETTINGS)
+
+        for key in DEFAULT_SETTINGS:
+            if(key in self.config):
+                settings[key] = self.config[key]
+
+        settings.update(self.config.get("operations", {}).get(operation, {}))
+        return settings
+
+
+    def limiter(self, account, operation):
+        key = (account, operation)
+
+        with self.lock:
+            if(key not in self.limiters):
+                self.limiters[key] = AdaptiveLimiter(account + "/" + operation, self.settings(operation), self.clock, self.sleep)
+            return self.limiters[key]
@@ -0,0 +1,195 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import sqlite3
+import threading
+import time
+
+
+# Processing stages of an item, in order
+STAGE_DOWNLOADED = "downloaded"
+STAGE_NAMED = "named"
+STAGE_UPLOADED = "uploaded"
+STAGE_DELETED = "deleted"
+
+
+#
+# Local SQLite store with the processing state of each origin item.
+# Allows a run to skip the work already done by a previous run, and keeps the history of where each file went.
+# Items are identified by the OneDrive item id. A record only applies while the eTag, or the size and hash, still match.
+#
+class StateStore:
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    item_id TEXT PRIMARY KEY,
+                    etag TEXT,
+                    size INTEGER,
+                    sha256hash TEXT,
+                    source_path TEXT,
+                    stage TEXT,
+                    destination TEXT,
+                    status TEXT,
+                    updated REAL
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS upload_sessions (
+                    session_key TEXT PRIMARY KEY,
+                    url TEXT,
+                    size INTEGER,
+                    updated REAL
+                )""")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS delta_links (
+                    scan_key TEXT PRIMARY KEY,
+                    delta_link TEXT,
+                    updated REAL
+                )""")
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+    #
+    # Returns the record of the item as a dictionary, or None when there is no valid record.
+    #
+    def get(self, source_details):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT etag, size, sha256hash, source_path, stage, destination, status FROM items WHERE item_id = ?",
+                (source_details["id"],)).fetchone()
+
+        if(row == None):
+            return None
+
+        record = {
+            "etag": row[0],
+            "size": row[1],
+            "sha256hash": row[2],
+            "source_path": row[3],
+            "stage": row[4],
+            "destination": row[5],
+            "status": row[6]
+        }
+
+        same_etag = record["etag"] != "" and record["etag"] == source_details["etag"]
+        same_content = record["sha256hash"] != "" and record["sha256hash"] == source_details["sha256hash"] and record["size"] == source_details["size"]
+
+        if(same_etag or same_content):
+            return record
+
+        # The file changed since it was recorded
+        return None
+
+
+    #
+    # Record the stage of an item. Destination and status are kept from the previous record when not provided.
+    #
+    def update(self, source_path, source_details, stage, destination=None, status=None):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO items (item_id, etag, size, sha256hash, source_path, stage, destination, status, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(item_id) DO UPDATE SET
+                    etag = excluded.etag,
+                    size = excluded.size,
+                    sha256hash = excluded.sha256hash,
+                    source_path = excluded.source_path,
+                    stage = excluded.stage,
+                    destination = COALESCE(excluded.destination, items.destination),
+                    status = COALESCE(excluded.status, items.status),
+                    updated = excluded.updated""",
+                (source_details["id"], source_details["etag"], source_details["size"], source_details["sha256hash"],
+                 source_path, stage, destination, status, time.time()))
+
+
+    #
+    # Delta link of an incremental scan (one per origin folder), or None before the first full scan
+    #
+    def get_delta_link(self, scan_key):
+        with self.lock:
+            row = self.connection.execute("SELECT delta_link FROM delta_links WHERE scan_key = ?", (scan_key,)).fetchone()
+
+        if(row == None):
+            return None
+
+        return row[0]
+
+
+    def set_delta_link(self, scan_key, delta_link):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO delta_links (scan_key, delta_link, updated) VALUES (?, ?, ?)
+                ON CONFLICT(scan_key) DO UPDATE SET delta_link = excluded.delta_link, updated = excluded.updated""",
+                (scan_key, delta_link, time.time()))
+
+
+    #
+    # Upload sessions of large files, kept until the upload completes so it can resume after a restart
+    #
+    def get_upload_session(self, session_key):
+        with self.lock:
+            row = self.connection.execute("SELECT url, size FROM upload_sessions WHERE session_key = ?", (session_key,)).fetchone()
+
+        if(row == None):
+            return None
+
+        return {"url": row[0], "size": row[1]}
+
+
+    def set_upload_session(self, session_key, url, size):
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO upload_sessions (session_key, url, size, updated) VALUES (?, ?, ?, ?)
+                ON CONFLICT(session_key) DO UPDATE SET url = excluded.url, size = excluded.size, updated = excluded.updated""",
+                (session_key, url, size, time.time()))
+
+
+    def clear_upload_session(self, session_key):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM upload_sessions WHERE session_key = ?", (session_key,))
+
+
+    #
+    # History of the processed items, e.g. to find where a file went
+    #
+    def history(self, source_path=None):
+        query = "SELECT source_path, stage, destination, status, updated FROM items"
+        parameters = ()
+
+        if(source_path != None):
+            query = query + " WHERE source_path = ?"
+            parameters = (source_path,)
+
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY updated", parameters).fetchall()
+
+        return [{"source_path": row[0], "stage": row[1], "destination": row[2], "status": row[3], "updated": row[4]} for row in rows]
@@ -0,0 +1,193 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the destination index: new, duplicate and conflicting names, the listing of each folder once until max_age,
+# and the uploads of the processor added to the index
+
+import hashlib
+import time
+import unittest
+
+import onedrive_processor
+
+from benchmark import generate_camera_roll, CONSTANTS, UNLIMITED_RATE
+from destination_index import DestinationIndex, FILE_NEW, FILE_DUPLICATE, FILE_CONFLICT
+from fake_onedrive import FakeDrive, FakeOneDriveClient
+from rate_limiter import RateLimiter
+
+
+FOLDER = "/Pictures/images/2021/01"
+
+
+def sha256hash(data):
+    return hashlib.sha256(data).hexdigest().upper()
+
+
+#
+# Fake client failing the listing of the folders
+#
+class FailingListClient(FakeOneDriveClient):
+
+    def list_children(self, onedrive_folder):
+        return {"status": False, "code": 500, "message": "Injected failure"}
+
+
+class DestinationIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive("destination")
+        self.drive.put(FOLDER, "a.jpg", b"first file")
+        self.client = FakeOneDriveClient(self.drive, rate_limiter=RateLimiter(UNLIMITED_RATE))
+
+
+    def listings(self):
+        return len(self.client.timings.get("list_children", []))
+
+
+    def test_new_duplicate_and_conflict(self):
+        index = DestinationIndex(self.client)
+
+        self.assertEqual(index.check(FOLDER, "b.jpg", 10, sha256hash(b"first file")), FILE_NEW)
+        self.assertEqual(index.check(FOLDER, "a.jpg", 10, sha256hash(b"first file")), FILE_DUPLICATE)
+        self.assertEqual(index.check(FOLDER, "a.jpg", 11, sha256hash(b"other file!")), FILE_CONFLICT)
+
+        # Names are case insensitive, as in OneDrive, and hashes are compared in any case
+        self.assertEqual(index.check(FOLDER, "A.JPG", 10, sha256hash(b"first file").lower()), FILE_DUPLICATE)
+
+        # Same hash with another size is not the same file
+        self.assertEqual(index.check(FOLDER, "a.jpg", 20, sha256hash(b"first file")), FILE_CONFLICT)
+
+        self.assertEqual(self.listings(), 1)
+
+
+    def test_no_hash_to_compare(self):
+        index = DestinationIndex(self.client)
+
+        self.assertEqual(index.check(FOLDER, "a.jpg", 10, ""), None)
+        self.assertEqual(index.check(FOLDER, "b.jpg", 10, ""), FILE_NEW)
+
+
+    def test_folder_not_created_yet(self):
+        index = DestinationIndex(self.client)
+
+        self.assertEqual(index.check("/Pictures/images/2022/01", "a.jpg", 10, sha256hash(b"first file")), FILE_NEW)
+
+
+    def test_listing_failed(self):
+        index = DestinationIndex(FailingListClient(self.drive, rate_limiter=RateLimiter(UNLIMITED_RATE)))
+
+        self.assertEqual(index.check(FOLDER, "a.jpg", 10, sha256hash(b"first file")), None)
+
+
+    def test_folder_listed_again_after_max_age(self):
+        index = DestinationIndex(self.client, max_age=0.2)
+        index.check(FOLDER, "b.jpg", 5, sha256hash(b"other"))
+
+        # Added by another process: not seen until the folder is listed again
+        self.drive.put(FOLDER, "b.jpg", b"other")
+        self.assertEqual(index.check(FOLDER, "b.jpg", 5, sha256hash(b"other")), FILE_NEW)
+        self.assertEqual(self.listings(), 1)
+
+        time.sleep(0.3)
+
+        self.assertEqual(index.check(FOLDER, "b.jpg", 5, sha256hash(b"other")), FILE_DUPLICATE)
+        self.assertEqual(self.listings(), 2)
+
+
+    def test_add_and_invalidate(self):
+        index = DestinationIndex(self.client)
+
+        # Not listed yet: nothing is cached, the folder is listed when first checked
+        index.add(FOLDER, "c.jpg", 5, sha256hash(b"third"))
+        self.assertEqual(index.check(FOLDER, "c.jpg", 5, sha256hash(b"third")), FILE_NEW)
+
+        index.add(FOLDER, "c.jpg", 5, sha256hash(b"third"))
+        self.assertEqual(index.check(FOLDER, "c.jpg", 5, sha256hash(b"third")), FILE_DUPLICATE)
+        self.assertEqual(self.listings(), 1)
+
+        index.invalidate(FOLDER)
+        self.assertEqual(index.check(FOLDER, "c.jpg", 5, sha256hash(b"third")), FILE_NEW)
+        self.assertEqual(self.listings(), 2)
+
+
+class ProcessorIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin_drive = FakeDrive("origin")
+        self.destination_drive = FakeDrive("destination")
+        generate_camera_roll(self.origin_drive, "/Camera Roll", 1, 2000, 5000, mix={"jpg": 1.0}, seed=2)
+
+        self.source_folder = "/Camera Roll/2021/01"
+        self.data = self.origin_drive.get(self.source_folder + "/IMG_0001.JPG")["data"]
+
+        self.origin_client = self.client(self.origin_drive)
+        self.destination_client = self.client(self.destination_drive)
+
+        onedrive_processor.destination_index = DestinationIndex(self.destination_client)
+
+
+    def tearDown(self):
+        onedrive_processor.destination_index = None
+
+
+    def client(self, drive):
+        client = FakeOneDriveClient(drive, account=drive.drive_id, rate_limiter=RateLimiter(UNLIMITED_RATE))
+        client.set_batch_options(1)
+        return client
+
+
+    def process(self, data):
+        self.origin_drive.put(self.source_folder, "IMG_0001.JPG", data, overwrite=True)
+        return onedrive_processor.process_file(self.origin_client, self.source_folder + "/IMG_0001.JPG", self.destination_client,
+                                               "/Pictures", {"constants": CONSTANTS})
+
+
+    def count(self, name):
+        return len(self.destination_client.timings.get(name, []))
+
+
+    def destination_names(self):
+        return sorted(item["name"] for item in self.destination_drive.list(FOLDER))
+
+
+    def test_uploads_added_to_the_index(self):
+        self.assertEqual(self.process(self.data), onedrive_processor.RESULT_UPLOADED)
+        names = self.destination_names()
+        self.assertEqual(len(names), 1)
+
+        # The same file again: found in the index without listing the folder again
+        self.assertEqual(self.process(self.data), onedrive_processor.RESULT_DUPLICATE)
+
+        # Same metadata, other content: a new name, chosen from the index before uploading
+        self.assertEqual(self.process(self.data + b"\x00"), onedrive_processor.RESULT_UPLOADED)
+
+        filename, extension = names[0].rsplit(".", 1)
+        self.assertEqual(self.destination_names(), sorted(names + [filename + "_1." + extension]))
+        self.assertEqual(self.count("upload_from"), 2)
+        self.assertEqual(self.count("list_children"), 1)
+        self.assertEqual(self.origin_drive.list(self.source_folder), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the EXIF reader: the tags of JPEG (APP1), HEIC (Exif item) and PNG (eXIf) files built as benchmark.py does,
+# and the truncated or unexpected files that are left to exifread and PIL
+
+import datetime
+import io
+import struct
+import unittest
+
+from unittest import mock
+
+import exifread
+
+from PIL import Image
+
+from benchmark import box, make_heic, make_jpeg
+from exif_reader import read_exif_tags, read_exif_tags_from
+from image_processing import process_image, process_image_fast
+from video_processing import file_reader
+
+
+TAKEN = datetime.datetime(2021, 5, 6, 7, 8, 9)
+
+EXPECTED_TAGS = {
+    "DateTimeOriginal": "2021:05:06 07:08:09",
+    "SubSecTimeOriginal": "123",
+    "OffsetTimeOriginal": "+02:00",
+    "GPSLatitude": [38.0, 42.0, 1.5],
+    "GPSLongitude": [9.0, 8.0, 21.7]
+}
+
+EXPECTED_RESULT = {"originaltime": "2021:05:06 07:08:09", "offset": "+02:00", "originalsubsecond": "123"}
+
+
+def image_bytes(image_format, **options):
+    image = Image.new("RGB", (16, 16), (200, 10, 10))
+    data = io.BytesIO()
+    image.save(data, format=image_format, **options)
+    return data.getvalue()
+
+
+def sample_jpeg():
+    return make_jpeg(image_bytes("JPEG"), TAKEN, "123", "+02:00", b"padding")
+
+
+def sample_heic():
+    return make_heic(TAKEN, "123", "+02:00", b"\x00" * 1000)
+
+
+def sample_png():
+    exif = Image.Exif()
+    exif[0x8769] = {0x9003: "2021:05:06 07:08:09", 0x9291: "123", 0x9011: "+02:00"}
+    return image_bytes("PNG", exif=exif)
+
+
+def read_tags(filename, data):
+    return read_exif_tags_from(filename, io.BytesIO(data))
+
+
+class ExifReaderTest(unittest.TestCase):
+
+    def assertTags(self, tags, expected):
+        self.assertEqual(set(tags.keys()), set(expected.keys()))
+
+        for name, value in expected.items():
+            if(isinstance(value, list)):
+                for read_value, expected_value in zip(tags[name], value):
+                    self.assertAlmostEqual(read_value, expected_value, places=5)
+            else:
+                self.assertEqual(tags[name], value)
+
+    def test_jpeg(self):
+        data = sample_jpeg()
+        self.assertTags(read_tags("IMG_0001.JPG", data), EXPECTED_TAGS)
+        self.assertEqual(process_image_fast("IMG_0001.JPG", io.BytesIO(data)), EXPECTED_RESULT)
+
+    def test_heic(self):
+        data = sample_heic()
+        self.assertTags(read_tags("IMG_0001.HEIC", data), EXPECTED_TAGS)
+        self.assertEqual(process_image_fast("IMG_0001.HEIC", io.BytesIO(data)), EXPECTED_RESULT)
+
+    def test_png(self):
+        data = sample_png()
+        self.assertIn(b"eXIf", data)
+        self.assertTags(read_tags("Screenshot.png", data), {
+            "DateTimeOriginal": "2021:05:06 07:08:09",
+            "SubSecTimeOriginal": "123",
+            "OffsetTimeOriginal": "+02:00"
+        })
+
+        # The offset is not used for PNG files
+        self.assertEqual(process_image_fast("Screenshot.png", io.BytesIO(data)),
+                         {"originaltime": "2021:05:06 07:08:09", "offset": "", "originalsubsecond": "123"})
+
+    def test_file_position_kept(self):
+        fileobj = io.BytesIO(sample_jpeg())
+        fileobj.seek(10)
+        read_exif_tags_from("IMG_0001.JPG", fileobj)
+        self.assertEqual(fileobj.tell(), 10)
+
+    def test_no_exif(self):
+        self.assertEqual(read_tags("IMG_0001.JPG", image_bytes("JPEG")), {})
+        self.assertEqual(read_tags("Screenshot.png", image_bytes("PNG")), {})
+
+        # HEIC with the image item only
+        data = sample_heic()
+        data = data.replace(struct.pack(">HH4s", 2, 0, b"Exif"), struct.pack(">HH4s", 2, 0, b"mime"))
+        self.assertEqual(read_tags("IMG_0001.HEIC", data), {})
+
+        self.assertEqual(process_image("IMG_0001.JPG", io.BytesIO(image_bytes("JPEG"))),
+                         {"originaltime": "", "offset": "", "originalsubsecond": ""})
+
+    def test_only_the_exif_segment_read(self):
+        data = sample_heic()
+        reads = []
+
+        def read(offset, length):
+            reads.append((offset, length))
+            return data[offset:offset + length]
+
+        self.assertTags(read_exif_tags("IMG_0001.HEIC", read, len(data)), EXPECTED_TAGS)
+        self.assertLess(sum(length for offset, length in reads), len(data) - 1000)
+
+    def test_other_types_not_read(self):
+        self.assertEqual(read_tags("IMG_0001.MOV", sample_jpeg()), None)
+
+    def test_unexpected_signature(self):
+        self.assertEqual(read_tags("IMG_0001.JPG", sample_png()), None)
+        self.assertEqual(read_tags("Screenshot.png", sample_jpeg()), None)
+        self.assertEqual(read_tags("IMG_0001.HEIC", b"\x00" * 100), None)
+
+    def test_truncated_jpeg_falls_back(self):
+        data = sample_jpeg()
+        # Cut in the middle of the APP1 segment
+        truncated = data[0:200]
+
+        self.assertEqual(read_tags("IMG_0001.JPG", truncated), None)
+        self.assertEqual(process_image_fast("IMG_0001.JPG", io.BytesIO(truncated)), None)
+        self.assertEqual(process_image("IMG_0001.JPG", io.BytesIO(truncated)), EXPECTED_RESULT)
+
+    def test_truncated_heic_falls_back(self):
+        data = sample_heic()
+        # Cut in the middle of the Exif item
+        truncated = data[0:len(data) - 1150]
+
+        self.assertEqual(read_tags("IMG_0001.HEIC", truncated), None)
+
+        with mock.patch("exifread.process_file", wraps=exifread.process_file) as process_file:
+            result = process_image("IMG_0001.HEIC", io.BytesIO(truncated))
+
+        process_file.assert_called_once()
+        self.assertEqual(set(result.keys()), set(EXPECTED_RESULT.keys()))
+
+    def test_truncated_png(self):
+        data = sample_png()
+        start = data.index(b"eXIf")
+        truncated = data[0:start + 20]
+
+        self.assertEqual(read_tags("Screenshot.png", truncated), None)
+
+    def test_heic_exif_after_media_data_falls_back(self):
+        data = sample_heic()
+        # mdat before meta: the Exif item can't be found without reading the media data
+        ftyp_end = struct.unpack(">I", data[0:4])[0]
+        with_mdat_first = data[0:ftyp_end] + box(b"mdat", b"") + data[ftyp_end:]
+
+        self.assertEqual(read_tags("IMG_0001.HEIC", with_mdat_first), None)
+
+    def test_unexpected_value_type_falls_back(self):
+        data = sample_jpeg()
+        # GPSLatitude (3 rationals) stored as signed rationals, which the reader does not decode
+        entry = struct.pack(">HHI", 0x0002, 5, 3)
+        self.assertEqual(data.count(entry), 1)
+        data = data.replace(entry, struct.pack(">HHI", 0x0002, 10, 3))
+
+        self.assertEqual(read_tags("IMG_0001.JPG", data), None)
+        self.assertEqual(process_image("IMG_0001.JPG", io.BytesIO(data)), EXPECTED_RESULT)
+
+    def test_file_reader(self):
+        read = file_reader(io.BytesIO(b"0123456789"))
+        self.assertEqual(read(2, 3), b"234")
+        self.assertEqual(read(8, 10), b"89")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,225 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the Graph JSON batches: results of each request in a batch, retries of the throttled ones,
+# and the source files and folders left when a delete in a batch fails
+
+import threading
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import onedrive_processor
+
+from benchmark import generate_camera_roll, CONSTANTS, UNLIMITED_RATE
+from fake_onedrive import FakeDrive, FakeOneDriveClient
+from folder_cleanup import FolderCleanup
+from graph_batch import BatchQueue
+from onedrive_graph import delete_response
+from rate_limiter import RateLimiter
+
+
+#
+# $batch endpoint answering each request with the next status code of its url (204 when none is left).
+# The batches sent are kept.
+#
+class ScriptedBatch:
+
+    def __init__(self, statuses, retry_after="0.05"):
+        self.statuses = dict((url, list(codes)) for url, codes in statuses.items())
+        self.retry_after = retry_after
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def send(self, requests):
+        responses = []
+
+        with self.lock:
+            self.batches.append([request["url"] for request in requests])
+
+            for request in requests:
+                codes = self.statuses.get(request["url"], [])
+                status = codes.pop(0) if len(codes) > 0 else 204
+                response = {"id": request["id"], "status": status}
+
+                if(status == 429 or status == 503):
+                    response["headers"] = {"Retry-After": self.retry_after}
+                elif(status >= 400):
+                    response["body"] = {"error": {"code": "generalException"}}
+
+                responses.append(response)
+
+        return {"status": True, "responses": responses}
+
+
+class BatchQueueTest(unittest.TestCase):
+
+    def test_result_of_each_request(self):
+        endpoint = ScriptedBatch({"/items/2": [500], "/items/3": [404]})
+        queue = BatchQueue(endpoint.send, max_size=20, max_delay=0.05)
+
+        futures = [queue.submit("DELETE", "/items/" + str(index), delete_response) for index in range(5)]
+        results = [future.result(timeout=5) for future in futures]
+
+        self.assertEqual([result["status"] for result in results], [True, True, False, False, True])
+        self.assertEqual(results[2]["code"], 500)
+        self.assertEqual(len(endpoint.batches), 1)
+
+
+    def test_throttled_requests_retried(self):
+        endpoint = ScriptedBatch({"/items/1": [429, 503], "/items/4": [429]})
+        queue = BatchQueue(endpoint.send, max_size=20, max_delay=0.05)
+
+        futures = [queue.submit("DELETE", "/items/" + str(index), delete_response) for index in range(5)]
+        results = [future.result(timeout=5) for future in futures]
+
+        self.assertTrue(all(result["status"] for result in results))
+        self.assertEqual([sorted(urls) for urls in endpoint.batches[1:]], [["/items/1", "/items/4"], ["/items/1"]])
+
+
+    def test_retry_after_date(self):
+        endpoint = ScriptedBatch({"/items/1": [429]}, retry_after="Wed, 21 Oct 2026 07:28:00 GMT")
+        queue = BatchQueue(endpoint.send, max_size=20, max_delay=0.05)
+
+        futures = [queue.submit("DELETE", "/items/" + str(index), delete_response) for index in range(3)]
+        time_before = time.monotonic()
+        results = [future.result(timeout=5) for future in futures]
+
+        # Retried after the default second, and each request has one result
+        self.assertTrue(all(result["status"] for result in results))
+        self.assertEqual(endpoint.batches[1:], [["/items/1"]])
+        self.assertGreaterEqual(time.monotonic() - time_before, 0.9)
+
+
+    def test_throttled_requests_fail_after_max_attempts(self):
+        endpoint = ScriptedBatch({"/items/0": [429] * 10})
+        queue = BatchQueue(endpoint.send, max_size=20, max_delay=0.01, max_attempts=3)
+
+        result = queue.submit("DELETE", "/items/0", delete_response).result(timeout=5)
+
+        self.assertFalse(result["status"])
+        self.assertEqual(result["code"], 429)
+        self.assertEqual(len(endpoint.batches), 3)
+
+
+    def test_flush_waits_for_retried_requests(self):
+        endpoint = ScriptedBatch({"/items/0": [429, 429]}, retry_after="0.2")
+        queue = BatchQueue(endpoint.send, max_size=20, max_delay=10)
+
+        future = queue.submit("DELETE", "/items/0", delete_response)
+        time_before = time.monotonic()
+        queue.flush()
+
+        # Sent at once instead of after max_delay, and done only after the two retries
+        self.assertTrue(future.done())
+        self.assertTrue(future.result()["status"])
+        self.assertEqual(len(endpoint.batches), 3)
+        self.assertLess(time.monotonic() - time_before, 5)
+
+
+#
+# Fake client failing the batched delete of one path
+#
+class FailingDeleteClient(FakeOneDriveClient):
+
+    def __init__(self, drive, failing_path, **options):
+        super().__init__(drive, **options)
+        self.failing_path = failing_path.lower()
+
+    def batch_response(self, request):
+        if(request["method"] == "DELETE" and request["url"].lower() == self.item_resource(self.failing_path).lower()):
+            return {"status": 500, "body": {"error": {"code": "generalException", "message": "Injected failure"}}}
+
+        return super().batch_response(request)
+
+
+class BatchedDeleteTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin_drive = FakeDrive("origin")
+        self.destination_drive = FakeDrive("destination")
+        generate_camera_roll(self.origin_drive, "/Camera Roll", 8, 2000, 5000, seed=3)
+
+        self.folder = "/Camera Roll/2021/01"
+        self.files = [item["name"] for item in self.origin_drive.list(self.folder)]
+
+
+    def process(self, origin_client):
+        destination_client = FakeOneDriveClient(self.destination_drive, account="destination", rate_limiter=RateLimiter(UNLIMITED_RATE))
+        cleanup = FolderCleanup("/Camera Roll")
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = onedrive_processor.walk_onedrive_folder(origin_client, "/Camera Roll", destination_client, "/Pictures",
+                                                              {"constants": CONSTANTS}, executor, cleanup)
+            wait(futures)
+
+        onedrive_processor.remove_empty_folders(origin_client, cleanup)
+        return [future.result() for future in futures], cleanup
+
+
+    def test_failed_delete_leaves_only_its_file(self):
+        failing_file = self.folder + "/" + self.files[3]
+        origin_client = FailingDeleteClient(self.origin_drive, failing_file, account="origin", rate_limiter=RateLimiter(UNLIMITED_RATE))
+
+        results, cleanup = self.process(origin_client)
+
+        self.assertEqual(len(results), len(self.files))
+        self.assertEqual([item["name"] for item in self.origin_drive.list(self.folder)], [self.files[3]])
+
+        # The folder of the file is uncertain, checked and kept with its parent
+        self.assertTrue(cleanup.is_uncertain(self.folder))
+        self.assertNotEqual(self.origin_drive.get(self.folder), None)
+        self.assertNotEqual(self.origin_drive.get("/Camera Roll/2021"), None)
+
+        # Every file was uploaded, the failed one included
+        self.assertEqual(len(self.destination_files()), len(self.files))
+
+
+    def test_deleted_files_and_empty_folders_removed(self):
+        origin_client = FakeOneDriveClient(self.origin_drive, account="origin", rate_limiter=RateLimiter(UNLIMITED_RATE))
+
+        results, cleanup = self.process(origin_client)
+
+        self.assertEqual(self.origin_drive.list("/Camera Roll"), [])
+        self.assertEqual(len(self.destination_files()), len(self.files))
+
+
+    def destination_files(self):
+        files = []
+        folders = ["/Pictures"]
+
+        while(len(folders) > 0):
+            folder = folders.pop()
+            for item in self.destination_drive.list(folder) or []:
+                if(item["type"] == "folder"):
+                    folders.append(folder + "/" + item["name"])
+                else:
+                    files.append(folder + "/" + item["name"])
+
+        return files
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the EXIF read with range requests, before downloading the whole image
+
+import unittest
+
+import onedrive_processor
+
+from benchmark import generate_camera_roll, UNLIMITED_RATE
+from fake_onedrive import FakeDrive, FakeOneDriveClient
+from rate_limiter import RateLimiter
+
+
+class MetadataRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.drive = FakeDrive("origin")
+        self.client = FakeOneDriveClient(self.drive, rate_limiter=RateLimiter(UNLIMITED_RATE))
+
+
+    def read(self, source_file, config):
+        details = self.client.item_details(source_file)
+        return onedrive_processor.read_image_metadata_range(self.client, source_file, details, config)
+
+
+    def ranges(self):
+        return len(self.client.timings.get("download_range", []))
+
+
+    def test_exif_read_from_the_first_bytes(self):
+        generate_camera_roll(self.drive, "/Camera Roll", 1, 200000, 5000, mix={"jpg": 1.0}, seed=2)
+
+        image_data = self.read("/Camera Roll/2021/01/IMG_0001.JPG", {"exif_range_size": 65536})
+
+        self.assertEqual(image_data["originaltime"], "2021:01:01 08:37:00")
+        self.assertEqual(image_data["offset"], "+01:00")
+        self.assertEqual(self.ranges(), 1)
+
+
+    def test_empty_file_not_requested(self):
+        self.drive.put("/Camera Roll", "IMG_0001.JPG", b"")
+
+        self.assertEqual(self.read("/Camera Roll/IMG_0001.JPG", {}), None)
+        self.assertEqual(self.ranges(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+'''------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the adaptive rate limiter, with a fake clock so no test waits
+
+import unittest
+
+from fake_onedrive import FakeDrive, FakeOneDriveClient
+from rate_limiter import AdaptiveLimiter, RateLimiter, DEFAULT_SETTINGS, OPERATION_READ
+
+
+#
+# Clock advanced by the sleeps of the limiter
+#
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now = self.now + seconds
+
+
+#
+# Request returning the given status codes in turn, then 200
+#
+def responses(*codes, retry_after=None):
+    codes = list(codes)
+    calls = []
+
+    def request():
+        calls.append(len(calls))
+        code = codes.pop(0) if len(codes) > 0 else 200
+        headers = {"Retry-After": str(retry_after)} if retry_after != None else {}
+        return code, headers, None
+
+    return request, calls
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+
+    def limiter(self, **settings):
+        self.fake_clock = FakeClock()
+        return AdaptiveLimiter("test", dict(DEFAULT_SETTINGS, **settings), self.fake_clock.clock, self.fake_clock.sleep)
+
+
+    def test_retry_after_blocks_every_caller(self):
+        limiter = self.limiter()
+        throttled_request, calls = responses(429, retry_after=5)
+
+        self.assertEqual(limiter.call(throttled_request)[0], 200)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.fake_clock.sleeps, [5])
+
+        # Another caller throttled at the same time waits for the Retry-After too, before sending anything
+        limiter.throttled(0, 7)
+        request_times = []
+        limiter.call(lambda: (request_times.append(self.fake_clock.now), (200, {}, None))[1])
+
+        self.assertEqual(self.fake_clock.sleeps, [5, 7])
+        self.assertGreaterEqual(request_times[0], limiter.blocked_until)
+
+
+    def test_concurrency_halved_on_throttling_and_grows_additively(self):
+        limiter = self.limiter(max_concurrency=16)
+        throttled_request, calls = responses(429, retry_after=1)
+
+        limiter.call(throttled_request)
+        # Halved by the 429, then the successful retry adds 1/8
+        self.assertEqual(int(limiter.concurrency), 8)
+        self.assertAlmostEqual(limiter.concurrency, 8.125)
+
+        # One more request in flight after about a window of successes
+        for index in range(7):
+            limiter.call(lambda: (200, {}, None))
+        self.assertEqual(int(limiter.concurrency), 8)
+
+        limiter.call(lambda: (200, {}, None))
+        self.assertEqual(int(limiter.concurrency), 9)
+
+        limiter.throttled(0, 0)
+        self.assertEqual(int(limiter.concurrency), 4)
+
+
+    def test_max_retries(self):
+        limiter = self.limiter(max_retries=3)
+        throttled_request, calls = responses(*([503] * 10), retry_after=2)
+
+        self.assertEqual(limiter.call(throttled_request)[0], 503)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(self.fake_clock.sleeps, [2, 2, 2])
+        self.assertEqual(limiter.throttled_count, 3)
+
+
+    def test_backoff_without_retry_after(self):
+        limiter = self.limiter(backoff_base=1, backoff_max=4)
+        throttled_request, calls = responses(429, 429, 429, 429)
+
+        self.assertEqual(limiter.call(throttled_request)[0], 200)
+        self.assertEqual(len(calls), 5)
+
+        for attempt, seconds in enumerate(self.fake_clock.sleeps):
+            self.assertLessEqual(seconds, min(4, 2 ** attempt))
+
+
+class FakeClientThrottlingTest(unittest.TestCase):
+
+    def test_throttled_requests_retried(self):
+        fake_clock = FakeClock()
+        rate_limiter = RateLimiter({"max_retries": 20}, fake_clock.clock, fake_clock.sleep)
+
+        drive = FakeDrive()
+        for index in range(20):
+            drive.put("/Camera Roll", "IMG_%04d.JPG" % index, b"image " + str(index).encode())
+
+        client = FakeOneDriveClient(drive, throttle_rate=0.5, retry_after=3, rate_limiter=rate_limiter, seed=1)
+
+        for index in range(20):
+            result = client.item_details("/Camera Roll/IMG_%04d.JPG" % index)
+            self.assertTrue(result["status"])
+            self.assertEqual(result["size"], len(b"image " + str(index).encode()))
+
+        limiter = rate_limiter.limiter(client.account, OPERATION_READ)
+        self.assertGreater(limiter.throttled_count, 0)
+        self.assertEqual(fake_clock.sleeps.count(3), limiter.throttled_count)
+        self.assertLess(int(limiter.concurrency), DEFAULT_SETTINGS["max_concurrency"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the state store: when a record still applies to an item (eTag, or size and hash), the destination kept
+# between stages, and the files of a previous run skipped or resumed by the processor
+
+import unittest
+
+import onedrive_processor
+
+from benchmark import generate_camera_roll, CONSTANTS, UNLIMITED_RATE
+from fake_onedrive import FakeDrive, FakeOneDriveClient
+from graph_batch import completed_future
+from rate_limiter import RateLimiter
+from state_store import StateStore, STAGE_DOWNLOADED, STAGE_NAMED, STAGE_UPLOADED, STAGE_DELETED
+
+
+DETAILS = {"id": "origin!1", "etag": "1", "size": 1000, "sha256hash": "AB12"}
+
+SOURCE_FILE = "/Camera Roll/IMG_0001.JPG"
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = StateStore(":memory:")
+        self.addCleanup(self.store.close)
+
+
+    def test_no_record(self):
+        self.assertEqual(self.store.get(DETAILS), None)
+
+
+    def test_record_applies_while_the_etag_matches(self):
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_NAMED, "/Pictures/a.jpg")
+
+        # Same eTag, even with other hash (e.g. not calculated yet)
+        record = self.store.get(dict(DETAILS, sha256hash="CD34"))
+        self.assertEqual(record["stage"], STAGE_NAMED)
+        self.assertEqual(record["destination"], "/Pictures/a.jpg")
+
+
+    def test_record_applies_while_the_size_and_hash_match(self):
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_UPLOADED, "/Pictures/a.jpg")
+
+        # The eTag changes on metadata updates (e.g. renames) that keep the content
+        self.assertEqual(self.store.get(dict(DETAILS, etag="2"))["stage"], STAGE_UPLOADED)
+
+        # Hashes are compared as stored
+        self.assertEqual(self.store.get(dict(DETAILS, etag="2", sha256hash="ab12")), None)
+
+
+    def test_record_ignored_when_the_file_changed(self):
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_UPLOADED, "/Pictures/a.jpg")
+
+        self.assertEqual(self.store.get(dict(DETAILS, etag="2", sha256hash="CD34")), None)
+        self.assertEqual(self.store.get(dict(DETAILS, etag="2", size=2000)), None)
+
+
+    def test_empty_etag_and_hash_never_match(self):
+        details = dict(DETAILS, etag="", sha256hash="")
+        self.store.update(SOURCE_FILE, details, STAGE_NAMED, "/Pictures/a.jpg")
+
+        self.assertEqual(self.store.get(details), None)
+
+
+    def test_destination_and_status_kept_between_stages(self):
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_DOWNLOADED)
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_NAMED, "/Pictures/a.jpg", "exif-name")
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_UPLOADED)
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_DELETED)
+
+        record = self.store.get(DETAILS)
+        self.assertEqual(record["stage"], STAGE_DELETED)
+        self.assertEqual(record["destination"], "/Pictures/a.jpg")
+        self.assertEqual(record["status"], "exif-name")
+
+        # A new name replaces the destination
+        self.store.update(SOURCE_FILE, DETAILS, STAGE_NAMED, "/Pictures/a_1.jpg")
+        self.assertEqual(self.store.get(DETAILS)["destination"], "/Pictures/a_1.jpg")
+        self.assertEqual(len(self.store.history(SOURCE_FILE)), 1)
+
+
+    def test_delta_links_and_upload_sessions(self):
+        self.assertEqual(self.store.get_delta_link("origin:/Camera Roll"), None)
+        self.store.set_delta_link("origin:/Camera Roll", "link1")
+        self.store.set_delta_link("origin:/Camera Roll", "link2")
+        self.assertEqual(self.store.get_delta_link("origin:/Camera Roll"), "link2")
+
+        self.store.set_upload_session("origin!1:/Pictures/a.mov", "https://upload/1", 5000)
+        self.assertEqual(self.store.get_upload_session("origin!1:/Pictures/a.mov"), {"url": "https://upload/1", "size": 5000})
+        self.store.clear_upload_session("origin!1:/Pictures/a.mov")
+        self.assertEqual(self.store.get_upload_session("origin!1:/Pictures/a.mov"), None)
+
+
+#
+# Fake client whose deletes fail, as when a run stops between the upload and the delete
+#
+class FailingDeleteClient(FakeOneDriveClient):
+
+    def delete_later(self, onedrive_path):
+        return completed_future({"status": False, "code": 500, "message": "Injected failure"})
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin_drive = FakeDrive("origin")
+        self.destination_drive = FakeDrive("destination")
+        generate_camera_roll(self.origin_drive, "/Camera Roll", 1, 2000, 5000, mix={"jpg": 1.0}, seed=2)
+
+        self.source_file = "/Camera Roll/2021/01/IMG_0001.JPG"
+        self.origin_client = self.client(FakeOneDriveClient, self.origin_drive)
+        self.destination_client = self.client(FakeOneDriveClient, self.destination_drive)
+
+        onedrive_processor.state_store = StateStore(":memory:")
+
+
+    def tearDown(self):
+        onedrive_processor.state_store.close()
+        onedrive_processor.state_store = None
+
+
+    def client(self, client_class, drive):
+        client = client_class(drive, account=drive.drive_id, rate_limiter=RateLimiter(UNLIMITED_RATE))
+        client.set_batch_options(1)
+        return client
+
+
+    def process(self, origin_client=None):
+        return onedrive_processor.process_file(origin_client or self.origin_client, self.source_file, self.destination_client,
+                                               "/Pictures", {"constants": CONSTANTS})
+
+
+    def uploads(self):
+        return len(self.destination_client.timings.get("upload_from", []))
+
+
+    def record(self):
+        return onedrive_processor.state_store.get(self.origin_client.item_details(self.source_file))
+
+
+    def test_uploaded_file_only_deleted_on_the_next_run(self):
+        result = self.process(self.client(FailingDeleteClient, self.origin_drive))
+
+        self.assertEqual(result, onedrive_processor.RESULT_UPLOADED)
+        self.assertEqual(self.record()["stage"], STAGE_UPLOADED)
+        destination = self.record()["destination"]
+
+        result = self.process()
+
+        self.assertEqual(result, onedrive_processor.RESULT_RESUMED)
+        self.assertEqual(self.uploads(), 1)
+        self.assertEqual(self.origin_drive.get(self.source_file), None)
+        self.assertNotEqual(self.destination_drive.get(destination), None)
+        self.assertEqual(onedrive_processor.state_store.history(self.source_file)[0]["stage"], STAGE_DELETED)
+
+
+    def test_uploaded_file_missing_from_the_destination_sent_again(self):
+        self.process(self.client(FailingDeleteClient, self.origin_drive))
+        destination = self.record()["destination"]
+        self.destination_drive.remove(destination)
+
+        result = self.process()
+
+        self.assertEqual(result, onedrive_processor.RESULT_UPLOADED)
+        self.assertEqual(self.uploads(), 2)
+        self.assertNotEqual(self.destination_drive.get(destination), None)
+
+
+    def test_named_file_uses_the_recorded_destination(self):
+        details = self.origin_client.item_details(self.source_file)
+        onedrive_processor.state_store.update(self.source_file, details, STAGE_NAMED, "/Pictures/resumed/IMG_0001.jpg", "exif-name")
+
+        result = self.process()
+
+        self.assertEqual(result, onedrive_processor.RESULT_UPLOADED)
+        self.assertNotEqual(self.destination_drive.get("/Pictures/resumed/IMG_0001.jpg"), None)
+        self.assertEqual(self.origin_drive.get(self.source_file), None)
+
+        # The naming of the first run is kept
+        self.assertEqual(onedrive_processor.state_store.history(self.source_file)[0]["status"], "exif-name")
+
+
+    def test_changed_file_processed_again(self):
+        details = self.origin_client.item_details(self.source_file)
+        onedrive_processor.state_store.update(self.source_file, details, STAGE_NAMED, "/Pictures/resumed/IMG_0001.jpg")
+
+        # Same name, new content: new eTag and hash
+        data = self.origin_drive.get(self.source_file)["data"]
+        self.origin_drive.put("/Camera Roll/2021/01", "IMG_0001.JPG", data + b"\x00", overwrite=True)
+
+        result = self.process()
+
+        self.assertEqual(result, onedrive_processor.RESULT_UPLOADED)
+        self.assertEqual(self.destination_drive.get("/Pictures/resumed/IMG_0001.jpg"), None)
+        self.assertNotEqual(onedrive_processor.state_store.history(self.source_file)[0]["destination"], "/Pictures/resumed/IMG_0001.jpg")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the creation date of MP4/MOV files read from the boxes: movie header (mvhd) versions 0 and 1,
+# the QuickTime creation date when the movie header has none, and files that are not ISO base media
+
+import datetime
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+from unittest import mock
+
+import video_processing
+
+from benchmark import box, make_mov
+from video_processing import MP4_EPOCH, QUICKTIME_CREATIONDATE, file_reader, mp4_creation_datetime, video_creation_datetime
+
+
+TAKEN = datetime.datetime(2021, 5, 6, 7, 8, 9, tzinfo=datetime.timezone.utc)
+
+FTYP = box(b"ftyp", b"qt  \x00\x00\x00\x00qt  ")
+
+
+def mvhd(taken, version=0):
+    seconds = 0 if taken == None else int((taken - MP4_EPOCH).total_seconds())
+
+    if(version == 1):
+        return box(b"mvhd", b"\x01\x00\x00\x00" + struct.pack(">QQ", seconds, seconds) + b"\x00" * 96)
+
+    return box(b"mvhd", b"\x00\x00\x00\x00" + struct.pack(">II", seconds, seconds) + b"\x00" * 88)
+
+
+#
+# QuickTime metadata box with the creation date as the second key. ISO adds version and flags before the children.
+#
+def quicktime_meta(value, iso=False):
+    keys = [b"com.apple.quicktime.make", QUICKTIME_CREATIONDATE]
+    entries = b"".join(struct.pack(">I4s", 8 + len(key), b"mdta") + key for key in keys)
+    keys_box = box(b"keys", b"\x00\x00\x00\x00" + struct.pack(">I", len(keys)) + entries)
+
+    # Type indicator (UTF-8) and locale before the value
+    make_item = box(struct.pack(">I", 1), box(b"data", struct.pack(">II", 1, 0) + b"Apple"))
+    date_item = box(struct.pack(">I", 2), box(b"data", struct.pack(">II", 1, 0) + value.encode("utf-8")))
+    hdlr = box(b"hdlr", b"\x00" * 8 + b"mdta" + b"\x00" * 13)
+
+    return box(b"meta", (b"\x00\x00\x00\x00" if iso else b"") + hdlr + keys_box + box(b"ilst", make_item + date_item))
+
+
+def creation_datetime(data):
+    return mp4_creation_datetime(file_reader(io.BytesIO(data)), len(data))
+
+
+class Mp4CreationDatetimeTest(unittest.TestCase):
+
+    def test_mvhd_version_0(self):
+        data = FTYP + box(b"moov", mvhd(TAKEN))
+        self.assertEqual(creation_datetime(data), TAKEN)
+
+    def test_mvhd_version_1(self):
+        data = FTYP + box(b"moov", mvhd(TAKEN, version=1))
+        self.assertEqual(creation_datetime(data), TAKEN)
+
+    def test_moov_after_mdat(self):
+        data = make_mov(TAKEN.replace(tzinfo=None), b"\x00" * 10000)
+        self.assertEqual(creation_datetime(data), TAKEN)
+
+    def test_64_bit_box_size(self):
+        payload = b"\x00" * 1000
+        mdat = struct.pack(">I4sQ", 1, b"mdat", 16 + len(payload)) + payload
+        data = FTYP + mdat + box(b"moov", mvhd(TAKEN))
+        self.assertEqual(creation_datetime(data), TAKEN)
+
+    def test_only_the_boxes_read(self):
+        data = make_mov(TAKEN.replace(tzinfo=None), b"\x00" * 100000)
+        reads = []
+
+        def read(offset, length):
+            reads.append(length)
+            return data[offset:offset + length]
+
+        self.assertEqual(mp4_creation_datetime(read, len(data)), TAKEN)
+        self.assertLess(sum(reads), 1000)
+
+    def test_quicktime_date_in_moov_meta(self):
+        data = FTYP + box(b"moov", mvhd(None) + quicktime_meta("2021-05-06T09:08:09+0200"))
+        self.assertEqual(creation_datetime(data), TAKEN)
+
+    def test_quicktime_date_in_udta_meta(self):
+        udta = box(b"udta", quicktime_meta("2021-05-06T09:08:09+0200", iso=True))
+        data = FTYP + box(b"moov", mvhd(None) + udta)
+        self.assertEqual(creation_datetime(data), TAKEN)
+
+    def test_quicktime_date_converted_to_utc(self):
+        data = FTYP + box(b"moov", mvhd(None) + quicktime_meta("2021-05-05T23:08:09-0800"))
+        result = creation_datetime(data)
+
+        self.assertEqual(result, TAKEN)
+        self.assertEqual(result.utcoffset(), datetime.timedelta(0))
+
+    def test_quicktime_date_without_offset_taken_as_utc(self):
+        data = FTYP + box(b"moov", mvhd(None) + quicktime_meta("2021-05-06T07:08:09"))
+        result = creation_datetime(data)
+
+        self.assertEqual(result, TAKEN)
+        self.assertEqual(result.tzinfo, datetime.timezone.utc)
+
+    def test_mvhd_before_quicktime_date(self):
+        data = FTYP + box(b"moov", quicktime_meta("2020-01-01T00:00:00+0000") + mvhd(TAKEN))
+        self.assertEqual(creation_datetime(data), TAKEN)
+
+    def test_no_creation_time(self):
+        data = FTYP + box(b"moov", mvhd(None))
+        self.assertEqual(creation_datetime(data), None)
+
+    def test_not_iso_media(self):
+        self.assertEqual(creation_datetime(b""), None)
+        self.assertEqual(creation_datetime(b"\xff\xd8\xff\xe0" + b"\x00" * 1000), None)
+        self.assertEqual(creation_datetime(b"RIFF\x10\x00\x00\x00AVI LIST" + b"\x00" * 100), None)
+
+    def test_truncated_moov(self):
+        data = FTYP + box(b"moov", mvhd(TAKEN))
+        self.assertEqual(creation_datetime(data[0:-20]), None)
+
+
+class VideoCreationDatetimeTest(unittest.TestCase):
+
+    def write_file(self, data):
+        handle, filepath = tempfile.mkstemp(suffix=".mov")
+        with os.fdopen(handle, "wb") as video_file:
+            video_file.write(data)
+        self.addCleanup(os.remove, filepath)
+        return filepath
+
+    def test_read_from_the_boxes(self):
+        filepath = self.write_file(make_mov(TAKEN.replace(tzinfo=None), b"\x00" * 1000))
+
+        with mock.patch.object(video_processing, "ffprobe_creation_datetime") as ffprobe_creation_datetime:
+            self.assertEqual(video_creation_datetime(filepath), TAKEN)
+
+        ffprobe_creation_datetime.assert_not_called()
+
+    def test_ffprobe_when_not_found(self):
+        filepath = self.write_file(b"\x00" * 100)
+
+        with mock.patch.object(video_processing, "ffprobe_creation_datetime", return_value=TAKEN) as ffprobe_creation_datetime:
+            self.assertEqual(video_creation_datetime(filepath), TAKEN)
+
+        ffprobe_creation_datetime.assert_called_once_with(filepath)
+
+
+if __name__ == "__main__":
+    unittest.main()
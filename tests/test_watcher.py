@@ -0,0 +1,122 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+# Tests of the watch mode against the in-memory OneDrive, with the fake drive standing in for the change notifications
+
+import threading
+import time
+import unittest
+
+import onedrive_processor
+
+from benchmark import generate_camera_roll, CONSTANTS, UNLIMITED_RATE
+from fake_onedrive import FakeDrive, FakeOneDriveClient
+from rate_limiter import RateLimiter
+from watcher import Watcher
+
+
+def file_names(drive, folder):
+    names = []
+
+    for item in drive.list(folder) or []:
+        if(item["type"] == "folder"):
+            names.extend(file_names(drive, folder + "/" + item["name"]))
+        else:
+            names.append(item["name"])
+
+    return names
+
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+
+    while(condition() == False and time.monotonic() < deadline):
+        time.sleep(0.01)
+
+    return condition()
+
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin_drive = FakeDrive("origin")
+        self.destination_drive = FakeDrive("destination")
+        self.origin_client = FakeOneDriveClient(self.origin_drive, account="origin", rate_limiter=RateLimiter(UNLIMITED_RATE))
+        self.destination_client = FakeOneDriveClient(self.destination_drive, account="destination", rate_limiter=RateLimiter(UNLIMITED_RATE))
+
+        # Only notifications can start a cycle before the end of the test
+        self.watcher = Watcher(poll_interval=3600)
+        onedrive_processor.watcher = self.watcher
+        self.origin_drive.subscribe(self.watcher.notify)
+
+        self.summaries = []
+        self.thread = threading.Thread(target=self.watcher.run, args=(self.cycle,), daemon=True)
+
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.thread.join(10)
+        onedrive_processor.watcher = None
+
+
+    def cycle(self):
+        summary = onedrive_processor.process_onedrive_folder(self.origin_client, "/Camera Roll", self.destination_client, "/Pictures",
+                                                             {"max_workers": 2, "constants": CONSTANTS})
+        self.summaries.append(summary)
+
+
+    def test_notification_starts_a_cycle(self):
+        generate_camera_roll(self.origin_drive, "/Camera Roll", 4, 2000, 5000, seed=1)
+        self.thread.start()
+
+        # First cycle at start, for the files already there (the notifications of the setup are cleared)
+        self.assertTrue(wait_until(lambda: len(self.summaries) == 1))
+        self.assertEqual(self.summaries[0].get("uploaded"), 4)
+        self.assertEqual(file_names(self.origin_drive, "/Camera Roll"), [])
+
+        # The uploads to the destination and the deletes of the origin did not start another cycle
+        time.sleep(0.2)
+        self.assertEqual(len(self.summaries), 1)
+
+        # A new file on the origin notifies the watcher, which processes it straight away
+        generate_camera_roll(self.origin_drive, "/Camera Roll", 1, 2000, 5000, seed=2)
+        self.assertTrue(wait_until(lambda: len(self.summaries) == 2))
+        self.assertEqual(self.summaries[1].get("uploaded"), 1)
+        self.assertEqual(file_names(self.origin_drive, "/Camera Roll"), [])
+        self.assertEqual(len(file_names(self.destination_drive, "/Pictures")), 5)
+
+
+    def test_stop_ends_the_watch(self):
+        self.thread.start()
+        self.assertTrue(wait_until(lambda: len(self.summaries) == 1))
+
+        self.watcher.stop()
+        self.thread.join(10)
+
+        self.assertFalse(self.thread.is_alive())
+        self.assertEqual(len(self.summaries), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,13 +23,203 @@
 '''
 
 import sys
-from ffprobe import FFProbe
+import os
+import struct
+import logging
 import datetime
 
+# Times in the mvhd box are seconds since 1904-01-01 UTC
+MP4_EPOCH = datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc)
+
+QUICKTIME_CREATIONDATE = b"com.apple.quicktime.creationdate"
+
+# The metadata box is read whole, up to this size
+MAX_META_SIZE = 1024 * 1024
+
+# Top level boxes walked before giving up (e.g. not an MP4/MOV file)
+MAX_TOP_LEVEL_BOXES = 1000
+
+
 #
-# Use FFprobe to determine the video creation date-time
+# Header of the box at offset: returns (type, content start, box end), or None when there is no valid box.
+# read(offset, length) returns the bytes of the file at offset.
+#
+def read_box_header(read, offset, end):
+    header = read(offset, 16)
+
+    if(len(header) < 8):
+        return None
+
+    size, box_type = struct.unpack(">I4s", header[0:8])
+    header_size = 8
+
+    if(size == 1):
+        # 64 bit size
+        if(len(header) < 16):
+            return None
+        size = struct.unpack(">Q", header[8:16])[0]
+        header_size = 16
+
+    elif(size == 0):
+        # The box extends to the end of the file
+        size = end - offset
+
+    if(size < header_size or offset + size > end):
+        return None
+
+    return box_type, offset + header_size, offset + size
+
+
+def iterate_boxes(read, start, end):
+    offset = start
+
+    while(offset + 8 <= end):
+        box = read_box_header(read, offset, end)
+
+        if(box == None):
+            return
+
+        yield box
+        offset = box[2]
+
+
+#
+# Creation time of the movie header box (mvhd). None when not set.
+#
+def mvhd_creation_datetime(data):
+    if(len(data) < 12):
+        return None
+
+    if(data[0] == 1):
+        seconds = struct.unpack(">Q", data[4:12])[0]
+    else:
+        seconds = struct.unpack(">I", data[4:8])[0]
+
+    if(seconds == 0):
+        return None
+
+    return MP4_EPOCH + datetime.timedelta(seconds=seconds)
+
+
+#
+# QuickTime creation date from the keys and ilst boxes of a metadata box.
+# It is stored as the local time with the offset. Converted to UTC like the movie header and ffprobe dates,
+# so a video gets the same name whichever box has the date. A date without offset is taken as UTC.
+#
+def quicktime_creation_datetime(meta):
+    # The ISO metadata box has version and flags before the children. The QuickTime one does not.
+    if(meta[0:4] == b"\0\0\0\0"):
+        meta = meta[4:]
+
+    read = lambda offset, length: meta[offset:offset + length]
+
+    key_index = None
+    for box_type, start, end in iterate_boxes(read, 0, len(meta)):
+
+        if(box_type == b"keys"):
+            entry_count = struct.unpack(">I", meta[start + 4:start + 8])[0]
+            offset = start + 8
+
+            for index in range(1, entry_count + 1):
+                key_size = struct.unpack(">I", meta[offset:offset + 4])[0]
+                if(meta[offset + 8:offset + key_size] == QUICKTIME_CREATIONDATE):
+                    key_index = index
+                offset = offset + key_size
+
+        elif(box_type == b"ilst" and key_index != None):
+            for item_type, item_start, item_end in iterate_boxes(read, start, end):
+                if(struct.unpack(">I", item_type)[0] != key_index):
+                    continue
+
+                for data_type, data_start, data_end in iterate_boxes(read, item_start, item_end):
+                    if(data_type == b"data"):
+                        # Type indicator and locale before the value
+                        value = meta[data_start + 8:data_end].decode("utf-8").strip()
+                        creation_datetime = datetime.datetime.fromisoformat(value)
+
+                        if(creation_datetime.tzinfo == None):
+                            return creation_datetime.replace(tzinfo=datetime.timezone.utc)
+
+                        return creation_datetime.astimezone(datetime.timezone.utc)
+
+    return None
+
+
+#
+# Creation date-time of an MP4/MOV (ISO base media) file, read from the boxes without a full probe.
+# The movie header (moov/mvhd) is used first, as ffprobe does for creation_time, then the QuickTime creation date.
+# read(offset, length) returns bytes of the file, so it can be a local file or ranges of a remote one.
+# Returns None when the file has no creation time or is not an ISO base media file.
+#
+def mp4_creation_datetime(read, size):
+    for count, (box_type, start, end) in enumerate(iterate_boxes(read, 0, size)):
+
+        if(count >= MAX_TOP_LEVEL_BOXES or box_type.isalnum() == False):
+            return None
+
+        if(box_type != b"moov"):
+            continue
+
+        movie_datetime = None
+        meta_boxes = []
+
+        for child_type, child_start, child_end in iterate_boxes(read, start, end):
+            if(child_type == b"mvhd"):
+                movie_datetime = mvhd_creation_datetime(read(child_start, 12))
+            elif(child_type == b"meta"):
+                meta_boxes.append((child_start, child_end))
+            elif(child_type == b"udta"):
+                meta_boxes.extend([(meta_start, meta_end) for meta_type, meta_start, meta_end in iterate_boxes(read, child_start, child_end) if meta_type == b"meta"])
+
+        if(movie_datetime != None):
+            return movie_datetime
+
+        for meta_start, meta_end in meta_boxes:
+            if(meta_end - meta_start <= MAX_META_SIZE):
+                quicktime_datetime = quicktime_creation_datetime(read(meta_start, meta_end - meta_start))
+                if(quicktime_datetime != None):
+                    return quicktime_datetime
+
+        return None
+
+    return None
+
+
+#
+# Read function for mp4_creation_datetime() on an open file
+#
+def file_reader(fileobj):
+    def read(offset, length):
+        fileobj.seek(offset)
+        return fileobj.read(length)
+
+    return read
+
+
+#
+# Determine the video creation date-time. Parses the file directly, and uses FFprobe for the formats it can't read.
 #
 def video_creation_datetime(filepath):
+    try:
+        with open(filepath, "rb") as video_file:
+            dt_obj = mp4_creation_datetime(file_reader(video_file), os.path.getsize(filepath))
+
+        if(dt_obj != None):
+            return dt_obj
+
+    except (struct.error, ValueError, UnicodeDecodeError) as ex:
+        logging.debug("video_creation_datetime(): Can't parse the file, using FFprobe: %s", ex)
+
+    return ffprobe_creation_datetime(filepath)
+
+
+#
+# Use FFprobe to determine the video creation date-time
+#
+def ffprobe_creation_datetime(filepath):
+    # Only needed when the boxes have no creation time, so ffprobe is not required otherwise
+    from ffprobe import FFProbe
+
     metadata=FFProbe(filepath)
 
     if("creation_time" not in metadata.metadata.keys()):
@@ -41,7 +231,7 @@ def video_creation_datetime(filepath):
         return dt_obj
 
     except ValueError as ex:
-        logging.error ("video_creation_datetime(): %s", ex)
+        logging.error ("ffprobe_creation_datetime(): %s", ex)
         return None
 
 
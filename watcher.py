@@ -0,0 +1,144 @@
+'''
+------------------------------------------------------------------------------
+ Copyright (c) 2021 - 2023 Hugo Cruz - hugo.m.cruz@gmail.com
+
+ Permission is hereby granted, free of charge, to any person obtaining a copy
+ of this software and associated documentation files (the "Software"), to deal
+ in the Software without restriction, including without limitation the rights
+ to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+ copies of the Software, and to permit persons to whom the Software is
+ furnished to do so, subject to the following conditions:
+
+ The above copyright notice and this permission notice shall be included in
+ all copies or substantial portions of the Software.
+
+ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+ THE SOFTWARE.
+------------------------------------------------------------------------------
+'''
+
+import json
+import logging
+import signal
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# Seconds between the scans of the origins
+DEFAULT_POLL_INTERVAL = 60
+
+
+#
+# Run the processing in cycles until stopped: one cycle every poll_interval seconds, or as soon as a change
+# notification arrives (notify()). stop() (or SIGTERM / SIGINT) lets the cycle in progress finish the files
+# already started, and no new cycle is run.
+#
+class Watcher:
+
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+
+
+    def notify(self):
+        self.wake_event.set()
+
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+
+
+    def stopping(self):
+        return self.stop_event.is_set()
+
+
+    #
+    # Must be called from the main thread
+    #
+    def install_signal_handlers(self):
+        def handler(signum, frame):
+            logging.info("Watcher: Signal %d received. Finishing the files in progress before stopping.", signum)
+            self.stop()
+
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(signal.SIGINT, handler)
+
+
+    def run(self, cycle):
+        cycles = 0
+
+        while(self.stopping() == False):
+            # Notifications received during the cycle trigger the next one straight away
+            self.wake_event.clear()
+
+            try:
+                cycle()
+            except Exception:
+                # Keep watching. The next cycle may work (e.g. network errors).
+                logging.exception("Watcher.run(): Error in the processing cycle")
+
+            cycles = cycles + 1
+
+            if(self.stopping() == False):
+                self.wake_event.wait(self.poll_interval)
+
+        logging.info("Watcher: Stopped after %d cycles.", cycles)
+        return cycles
+
+
+    #
+    # Receive change notifications on http://<address>:<port>/ and start a cycle for each.
+    # Follows the Microsoft Graph webhooks: the validationToken of a new subscription is echoed back,
+    # and notifications with a different clientState (when client_state is given) are ignored.
+    # Any local process can also POST to it, e.g. a sync client or a test.
+    #
+    def start_notification_server(self, port, client_state=None, address=""):
+        watcher = self
+
+        class NotificationHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                query = parse_qs(urlparse(self.path).query)
+
+                if("validationToken" in query):
+                    body = query["validationToken"][0].encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                length = int(self.headers.get("Content-Length", 0))
+
+                try:
+                    notifications = json.loads(self.rfile.read(length) or b"{}").get("value", [])
+                except ValueError:
+                    self.send_error(400)
+                    return
+
+                if(client_state == None or any(notification.get("clientState") == client_state for notification in notifications)):
+                    watcher.notify()
+
+                self.send_response(202)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logging.debug("Notification endpoint: " + format, *args)
+
+        server = ThreadingHTTPServer((address, port), NotificationHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="notifications", daemon=True).start()
+
+        logging.info("Change notifications received on port %d", server.server_port)
+        return server